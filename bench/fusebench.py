@@ -0,0 +1,280 @@
+#! /usr/bin/python
+
+"""
+fusebench mounts tagfs over a temporary back-store and measures whole
+workloads through the kernel, the FUSE binding, TagFS and TagDB.
+
+Usage:
+    fusebench.py [options] [workload ...]
+
+Workloads (all of them if none is given):
+    meta        mkdir tags, create files in them, ls -l every tag dir
+                (one readdir and a getattr per entry), retag every file by
+                rename, then unlink them
+    seqio       write a large file sequentially, then read it back
+    small       create, write and close many small files, then open,
+                read and close each
+    parallel    clients stat-ing and reading the small files from several
+                threads at once
+
+Every system call is timed on its own and reported per operation with
+ops/sec and the mean, median and 99th percentile latency. -o writes the
+results as JSON like bench/tagdb.py does. Needs fuse and fusermount; the
+mount is undone whatever happens.
+"""
+import os
+import sys
+import time
+import random
+import tempfile
+import shutil
+import subprocess
+import threading
+from optparse import OptionParser
+
+import tagdb
+
+TagFSScript = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                           '..', 'tagfs', 'TagFS.py')
+
+# seconds to wait for the mount to show up
+MountTimeout = 10
+
+class Timer:
+    """Latencies of each operation name, may be shared by threads"""
+
+    def __init__(self):
+        self.lats = {}
+        self.errors = {}
+        self.lock = threading.Lock()
+
+    def __add(self, name, lat, failed):
+        self.lock.acquire()
+        try:
+            self.lats.setdefault(name, []).append(lat)
+            if failed:
+                self.errors[name] = self.errors.get(name, 0) + 1
+        finally:
+            self.lock.release()
+
+    def call(self, name, func, *args):
+        begin = time.time()
+        try:
+            rs = func(*args)
+        except (IOError, OSError):
+            self.__add(name, time.time() - begin, True)
+            return None
+        self.__add(name, time.time() - begin, False)
+        return rs
+
+    def results(self, prefix):
+        return [tagdb.Result(prefix + '.' + name, self.lats[name],
+                             self.errors.get(name, 0))
+                for name in sorted(self.lats)]
+
+class Mount:
+    """tagfs mounted in the foreground over a fresh back-store"""
+
+    def __init__(self, mountopts, single):
+        self.tmpdir = tempfile.mkdtemp(prefix='tagfs-bench-')
+        self.store = os.path.join(self.tmpdir, 'store')
+        self.mnt = os.path.join(self.tmpdir, 'mnt')
+        os.mkdir(self.store)
+        os.mkdir(self.mnt)
+        opts = 'root=' + self.store
+        if mountopts:
+            opts += ',' + mountopts
+        cmd = [sys.executable, TagFSScript, '-f', '-o', opts]
+        if single:
+            cmd.append('-s')
+        self.proc = subprocess.Popen(cmd + [self.mnt])
+        deadline = time.time() + MountTimeout
+        while not os.path.ismount(self.mnt):
+            if self.proc.poll() != None or time.time() > deadline:
+                self.close()
+                raise Exception('tagfs did not mount: ' + ' '.join(cmd))
+            time.sleep(0.05)
+
+    def close(self):
+        if os.path.ismount(self.mnt):
+            subprocess.call(['fusermount', '-u', self.mnt])
+        if self.proc.poll() == None:
+            deadline = time.time() + MountTimeout
+            while self.proc.poll() == None and time.time() < deadline:
+                time.sleep(0.05)
+            if self.proc.poll() == None:
+                self.proc.kill()
+                self.proc.wait()
+        shutil.rmtree(self.tmpdir, True)
+
+def _write(path, data):
+    f = open(path, 'wb')
+    try:
+        f.write(data)
+    finally:
+        f.close()
+
+def _create(path):
+    os.close(os.open(path, os.O_CREAT | os.O_WRONLY, 0644))
+
+def _read(path, size):
+    f = open(path, 'rb')
+    try:
+        return f.read(size)
+    finally:
+        f.close()
+
+def meta(mnt, opts):
+    t = Timer()
+    tags = ['tag%d' % i for i in range(opts.tags)]
+    for tag in tags:
+        t.call('mkdir', os.mkdir, os.path.join(mnt, tag))
+    files = []
+    for i in range(opts.files):
+        path = os.path.join(mnt, tags[i % len(tags)], 'm%d' % i)
+        t.call('create', _create, path)
+        files.append(path)
+    for tag in tags:
+        d = os.path.join(mnt, tag)
+        names = t.call('readdir', os.listdir, d)
+        for name in names or []:
+            t.call('getattr', os.lstat, os.path.join(d, name))
+    moved = []
+    for i, path in enumerate(files):
+        to = os.path.join(mnt, tags[(i + 1) % len(tags)], 'm%d' % i)
+        t.call('rename', os.rename, path, to)
+        moved.append(to)
+    for path in moved:
+        t.call('unlink', os.unlink, path)
+    return t.results('meta')
+
+def seqio(mnt, opts):
+    t = Timer()
+    path = os.path.join(mnt, 'big.bin')
+    block = os.urandom(opts.block)
+    nblocks = opts.size * 1024 * 1024 / opts.block
+    f = open(path, 'wb')
+    begin = time.time()
+    for i in xrange(nblocks):
+        t.call('write', f.write, block)
+    t.call('flush', f.close)
+    wsecs = time.time() - begin
+    f = open(path, 'rb')
+    begin = time.time()
+    for i in xrange(nblocks):
+        t.call('read', f.read, opts.block)
+    f.close()
+    rsecs = time.time() - begin
+    print 'seqio: write %.1f MB/s, read %.1f MB/s' % \
+          (opts.size / max(wsecs, 1e-6), opts.size / max(rsecs, 1e-6))
+    t.call('unlink', os.unlink, path)
+    return t.results('seqio')
+
+def _small_files(mnt, opts):
+    return [os.path.join(mnt, 's%d' % i) for i in range(opts.files)]
+
+def small(mnt, opts):
+    t = Timer()
+    data = 'x' * opts.small
+    paths = _small_files(mnt, opts)
+    for path in paths:
+        t.call('create_write', _write, path, data)
+    for path in paths:
+        t.call('open_read', _read, path, opts.small)
+    return t.results('small')
+
+def parallel(mnt, opts):
+    paths = _small_files(mnt, opts)
+    data = 'x' * opts.small
+    for path in paths:
+        if not os.path.exists(path):
+            _write(path, data)
+    t = Timer()
+    stop = threading.Event()
+
+    def client(seed):
+        rnd = random.Random(seed)
+        while not stop.isSet():
+            path = rnd.choice(paths)
+            t.call('getattr', os.stat, path)
+            t.call('open_read', _read, path, opts.small)
+
+    clients = [threading.Thread(target=client, args=(i,))
+               for i in range(opts.clients)]
+    for c in clients:
+        c.start()
+    time.sleep(opts.seconds)
+    stop.set()
+    for c in clients:
+        c.join()
+    print 'parallel: %.1f ops/s from %d clients' % \
+          (sum([len(l) for l in t.lats.values()]) / opts.seconds,
+           opts.clients)
+    return t.results('parallel%d' % opts.clients)
+
+Workloads = [('meta', meta), ('seqio', seqio), ('small', small),
+             ('parallel', parallel)]
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%prog [options] [workload ...]')
+    parser.add_option('-n', '--files', type='int', default=1000,
+                      help='files of meta and small [default: %default]')
+    parser.add_option('-t', '--tags', type='int', default=20,
+                      help='tag dirs of meta [default: %default]')
+    parser.add_option('--size', type='int', default=64,
+                      help='MB written and read by seqio [default: %default]')
+    parser.add_option('--block', type='int', default=128 * 1024,
+                      help='block size of seqio [default: %default]')
+    parser.add_option('--small', type='int', default=4096,
+                      help='size of small files [default: %default]')
+    parser.add_option('-c', '--clients', type='int', default=8,
+                      help='threads of parallel [default: %default]')
+    parser.add_option('--seconds', type='float', default=5,
+                      help='duration of parallel [default: %default]')
+    parser.add_option('-m', '--mountopts', default='',
+                      help='more -o options for tagfs, e.g. fdio,engine=sqlite')
+    parser.add_option('-s', '--single', action='store_true', default=False,
+                      help='mount single threaded')
+    parser.add_option('-o', '--output', metavar='FILE',
+                      help='write the results as JSON into FILE')
+    opts, args = parser.parse_args()
+    names = [name for name, func in Workloads]
+    for a in args:
+        if a not in names:
+            parser.error('unknown workload ' + a)
+    if len(args) == 0:
+        args = names
+
+    mount = Mount(opts.mountopts, opts.single)
+    results = []
+    try:
+        for name, func in Workloads:
+            if name in args:
+                results.extend(func(mount.mnt, opts))
+    finally:
+        mount.close()
+
+    print '%-26s %8s %12s %10s %10s %10s %6s' % \
+          ('operation', 'ops', 'ops/sec', 'mean us', 'p50 us', 'p99 us',
+           'errors')
+    for r in results:
+        print '%-26s %8d %12.1f %10.1f %10.1f %10.1f %6d' % \
+              (r.name, r.ops, r.opsps(), r.mean * 1e6, r.p50 * 1e6,
+               r.p99 * 1e6, r.errors)
+
+    if opts.output != None:
+        report = {'commit': tagdb.git_commit(), 'time': time.time(),
+                  'python': sys.version.split()[0],
+                  'params': {'files': opts.files, 'tags': opts.tags,
+                             'size': opts.size, 'block': opts.block,
+                             'small': opts.small, 'clients': opts.clients,
+                             'seconds': opts.seconds,
+                             'mountopts': opts.mountopts,
+                             'single': opts.single, 'workloads': args},
+                  'results': dict((r.name, r.todict()) for r in results)}
+        out = open(opts.output, 'w')
+        try:
+            tagdb.json.dump(report, out, indent=2, sort_keys=True)
+            out.write('\n')
+        finally:
+            out.close()
@@ -0,0 +1,126 @@
+#! /usr/bin/python
+
+"""
+logbench measures what logging costs the getattr and readdir paths.
+
+Usage:
+    logbench.py [-n files] [-p ops] [--tagfs DIR]
+
+A getattr is the handler's trace line plus its path lookup in the tag
+db, a readdir the trace line plus opening and listing a tag dir, both
+run without FUSE and with the path cache off. They are timed with the
+log set up as:
+    sync-debug      debug records written by the calling thread, what
+                    tagfs always did before -o loglevel
+    queue-debug     debug records handed to the writer thread
+    warning         the default level, debug records are skipped
+
+For before/after numbers run it once more with --tagfs pointing at the
+tagfs dir of an older checkout, where only sync-debug is possible.
+"""
+import os
+import sys
+import time
+import random
+import tempfile
+import shutil
+import logging
+from optparse import OptionParser
+
+def setup_log(mode, filename):
+    root = logging.getLogger()
+    for h in root.handlers[:]:
+        root.removeHandler(h)
+        h.close()
+    try:
+        import TagLog
+    except ImportError:
+        TagLog = None
+    level = logging.DEBUG
+    if mode == 'warning':
+        level = logging.WARNING
+    if TagLog != None:
+        return TagLog.setup(level, filename, mode == 'queue-debug')
+    if mode == 'queue-debug':
+        return None
+    handler = logging.FileHandler(filename, 'w')
+    handler.setFormatter(logging.Formatter(
+            '%(asctime)s %(levelname)s %(message)s'))
+    root.addHandler(handler)
+    root.setLevel(level)
+    return handler
+
+def build(TagDB, nfiles, ntags, seed):
+    rnd = random.Random(seed)
+    db = TagDB.TagDB(logging.getLogger())
+    db.pathcache.size = 0
+    tags = ['t%d' % i for i in range(ntags)]
+    paths = []
+    for i in range(nfiles):
+        ftags = rnd.sample(tags, rnd.randint(1, 3))
+        fname = 'f%d' % i
+        db.add_file('%032x' % i, fname, ftags)
+        paths.append('/' + '/'.join(ftags) + '/' + fname)
+    return db, tags, paths
+
+def bench(db, tags, paths, ops, seed):
+    rnd = random.Random(seed)
+    gpaths = [rnd.choice(paths) for i in range(ops)]
+    dpaths = ['/' + rnd.choice(tags) + '/' for i in range(ops / 10 + 1)]
+    log = logging.getLogger()
+
+    begin = time.time()
+    for path in gpaths:
+        log.debug('getattr: %s', path)
+        db.find_by_path(path, 'unsure')
+    getattr_us = (time.time() - begin) * 1e6 / len(gpaths)
+
+    begin = time.time()
+    for path in dpaths:
+        log.debug('readdir: %s from %s', path, 0)
+        if hasattr(db, 'open_dir'):
+            dh = db.open_dir([path.strip('/')])
+            db.dir_entries(dh, 0, len(dh.fids))
+        else:
+            db.find_by_path(path, 'dir')
+    readdir_us = (time.time() - begin) * 1e6 / len(dpaths)
+    return getattr_us, readdir_us
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-n', '--files', type='int', default=5000,
+                      help='files in the store [default: %default]')
+    parser.add_option('-t', '--tags', type='int', default=50,
+                      help='distinct tags [default: %default]')
+    parser.add_option('-p', '--ops', type='int', default=20000,
+                      help='getattrs per mode, a tenth as many readdirs '
+                      '[default: %default]')
+    parser.add_option('-s', '--seed', type='int', default=1)
+    parser.add_option('--tagfs', metavar='DIR',
+                      default=os.path.join(os.path.dirname(
+                              os.path.realpath(__file__)), '..', 'tagfs'),
+                      help='tagfs dir to import the tag db from')
+    opts, args = parser.parse_args()
+    sys.path.insert(0, os.path.realpath(opts.tagfs))
+    import TagDB
+
+    tmpdir = tempfile.mkdtemp(prefix='tagfs-logbench-')
+    try:
+        logfile = os.path.join(tmpdir, 'tagfs.log')
+        setup_log('warning', logfile)
+        db, tags, paths = build(TagDB, opts.files, opts.tags, opts.seed)
+        print '%-12s %14s %14s %12s' % ('mode', 'getattr us', 'readdir us',
+                                        'log bytes')
+        for mode in ('sync-debug', 'queue-debug', 'warning'):
+            handler = setup_log(mode, logfile)
+            if handler == None:
+                print '%-12s %14s %14s %12s' % (mode, '-', '-', '-')
+                continue
+            g, r = bench(db, tags, paths, opts.ops, opts.seed)
+            # what is still queued is written out by close
+            handler.close()
+            logging.getLogger().removeHandler(handler)
+            print '%-12s %14.1f %14.1f %12d' % (mode, g, r,
+                                                os.path.getsize(logfile))
+    finally:
+        shutil.rmtree(tmpdir, True)
@@ -0,0 +1,125 @@
+#! /usr/bin/python
+
+"""
+membench measures what the in-memory tag db costs per file.
+
+Usage:
+    membench.py [-n files] [-o results.json] ...
+
+The synthetic store of tagdb.py (same options, same seed, same store) is
+built, stored as a db image and loaded again into a fresh TagDB, as a
+mount does. The resident memory the load takes is reported per file,
+with the part of it the DBFile records take: the objects themselves,
+their tags containers, fuuids and ids. Names and tag names are shared by
+all files and not counted there. Run it on two commits to compare, -o
+writes the results as JSON with the git commit.
+"""
+import os
+import sys
+import gc
+import time
+import shutil
+import tempfile
+import logging
+from optparse import OptionParser
+try:
+    import json
+except ImportError:
+    json = None
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                '..', 'tagfs'))
+import TagDB
+from tagdb import Workload, git_commit
+
+def rss():
+    """Resident bytes of this process, from /proc"""
+    f = open('/proc/self/statm')
+    try:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    finally:
+        f.close()
+
+def dbfile_bytes(f):
+    """Bytes of DBFile f which no other file shares"""
+    n = sys.getsizeof(f) + sys.getsizeof(f.tags) + sys.getsizeof(f.fuuid) \
+        + sys.getsizeof(f.fid)
+    d = getattr(f, '__dict__', None)
+    if d != None:
+        n += sys.getsizeof(d)
+        if 'mode' in d:
+            n += sys.getsizeof(d['mode'])
+    return n
+
+def run(opts):
+    logger = logging.getLogger('bench')
+    wl = Workload(opts.files, opts.tags, opts.maxtags, opts.collide,
+                  opts.zipf, opts.seed)
+    tmpdir = tempfile.mkdtemp(prefix='tagdb-membench-')
+    try:
+        dbfile = os.path.join(tmpdir, 'stored.db')
+        db = TagDB.TagDB(logger)
+        for fuuid, fname, ftags in wl.files:
+            try:
+                db.add_file(fuuid, fname, ftags)
+            except TagDB.NoUniqueTagException:
+                pass
+        db.store_db(dbfile)
+        db.close()
+        del db, wl
+        gc.collect()
+
+        before = rss()
+        db = TagDB.TagDB(logger)
+        db.load_db(dbfile)
+        gc.collect()
+        loaded = rss() - before
+        nfiles = len(db.files)
+        records = sum([dbfile_bytes(f) for f in db.flist if f != None])
+        db.close()
+    finally:
+        shutil.rmtree(tmpdir, True)
+    return {'files': nfiles, 'loaded_bytes_per_file': float(loaded) / nfiles,
+            'dbfile_bytes_per_file': float(records) / nfiles}
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-n', '--files', type='int', default=200000,
+                      help='files in the store [default: %default]')
+    parser.add_option('-t', '--tags', type='int', default=200,
+                      help='distinct tags [default: %default]')
+    parser.add_option('-k', '--maxtags', type='int', default=4,
+                      help='most tags of a file [default: %default]')
+    parser.add_option('-c', '--collide', type='float', default=0.2,
+                      help='fraction of files with a shared name '
+                      '[default: %default]')
+    parser.add_option('-z', '--zipf', type='float', default=1.1,
+                      help='Zipf exponent of tag popularity '
+                      '[default: %default]')
+    parser.add_option('-s', '--seed', type='int', default=1)
+    parser.add_option('-o', '--output', metavar='FILE',
+                      help='write the results as JSON into FILE')
+    opts, args = parser.parse_args()
+
+    logging.basicConfig(level = logging.CRITICAL)
+    rs = run(opts)
+    print '%d files' % rs['files']
+    print '%-26s %10.1f' % ('loaded db bytes/file', rs['loaded_bytes_per_file'])
+    print '%-26s %10.1f' % ('DBFile bytes/file', rs['dbfile_bytes_per_file'])
+
+    if opts.output != None:
+        if json == None:
+            print 'json is not available, no output written'
+            sys.exit(1)
+        report = {'commit': git_commit(), 'time': time.time(),
+                  'python': sys.version.split()[0],
+                  'params': dict((k, getattr(opts, k)) for k in
+                                 ('files', 'tags', 'maxtags', 'collide',
+                                  'zipf', 'seed')),
+                  'results': rs}
+        out = open(opts.output, 'w')
+        try:
+            json.dump(report, out, indent=2, sort_keys=True)
+            out.write('\n')
+        finally:
+            out.close()
@@ -0,0 +1,120 @@
+#! /usr/bin/python
+
+"""
+storebench measures what the back-store layout costs the system calls
+tagfs makes on its data files, without FUSE or the tag db.
+
+Usage:
+    storebench.py [-n files] [-f fanouts] [-d dir] [--cold]
+
+For each fanout a fresh store of n empty <uuid>_<name> files is made in
+dir, then random files are lstat-ed, as getattr does, and opened and
+closed, as open and release do, and all of them are listed, as tagfsck
+does. The caches are warm, dentries included, which is the steady state
+of a mounted store; --cold drops them (as root) before each measure.
+Put dir on the file system to measure, ext4 and xfs behave differently
+with big flat dirs.
+"""
+import os
+import sys
+import time
+import uuid
+import random
+import shutil
+import tempfile
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                '..', 'tagfs'))
+import StoreLayout
+
+def fstype(path):
+    """Type of the file system path is on, from /proc/mounts"""
+    path = os.path.realpath(path)
+    best, rs = '', '?'
+    try:
+        for line in open('/proc/mounts'):
+            words = line.split()
+            if len(words) > 2 and path.startswith(words[1]) and \
+                   len(words[1]) > len(best):
+                best, rs = words[1], words[2]
+    except IOError:
+        pass
+    return rs
+
+def drop_caches():
+    os.system('sync')
+    f = open('/proc/sys/vm/drop_caches', 'w')
+    try:
+        f.write('3\n')
+    finally:
+        f.close()
+
+def bench(d, fanout, nfiles, ops, seed, cold):
+    layout = StoreLayout.StoreLayout(d, fanout)
+    names = [uuid.UUID(int=random.Random(seed + i).getrandbits(128)).hex
+             + '_f' + str(i) for i in xrange(nfiles)]
+    begin = time.time()
+    for name in names:
+        os.close(layout.create(name, os.O_CREAT | os.O_WRONLY, 0644))
+    create = (time.time() - begin) * 1e6 / nfiles
+
+    rnd = random.Random(seed)
+    picked = [rnd.choice(names) for i in xrange(ops)]
+    if cold:
+        drop_caches()
+    begin = time.time()
+    for name in picked:
+        layout.call(os.lstat, name)
+    lstat = (time.time() - begin) * 1e6 / ops
+
+    rnd.shuffle(picked)
+    if cold:
+        drop_caches()
+    begin = time.time()
+    for name in picked:
+        os.close(layout.call(os.open, name, os.O_RDONLY))
+    openclose = (time.time() - begin) * 1e6 / ops
+
+    if cold:
+        drop_caches()
+    begin = time.time()
+    n = 0
+    for name in layout.names():
+        n += 1
+    scan = time.time() - begin
+    assert n == nfiles
+    return create, lstat, openclose, scan
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-n', '--files', type='int', default=200000,
+                      help='files in each store [default: %default]')
+    parser.add_option('-p', '--ops', type='int', default=50000,
+                      help='lookups per measure [default: %default]')
+    parser.add_option('-f', '--fanouts', default='0,1,2',
+                      help='fanouts to compare [default: %default]')
+    parser.add_option('-d', '--dir', default=None,
+                      help='dir the stores are made in [default: a temp dir]')
+    parser.add_option('--cold', action='store_true', default=False,
+                      help='drop the caches before each measure, as root')
+    parser.add_option('-s', '--seed', type='int', default=1)
+    opts, args = parser.parse_args()
+
+    top = tempfile.mkdtemp(prefix='tagfs-storebench-', dir=opts.dir)
+    print '%d files on %s at %s' % (opts.files, fstype(top), top)
+    print '%-8s %12s %12s %12s %12s' % ('fanout', 'create us', 'lstat us',
+                                        'open us', 'scan s')
+    try:
+        for fanout in [int(f) for f in opts.fanouts.split(',')]:
+            d = os.path.join(top, 'fanout%d' % fanout)
+            os.mkdir(d)
+            try:
+                print '%-8d %12.1f %12.1f %12.1f %12.2f' % \
+                      ((fanout,) + bench(d, fanout, opts.files, opts.ops,
+                                         opts.seed, opts.cold))
+                sys.stdout.flush()
+            finally:
+                shutil.rmtree(d, True)
+    finally:
+        shutil.rmtree(top, True)
@@ -0,0 +1,100 @@
+#! /usr/bin/python
+
+"""
+stress drives a mounted tagfs from many client threads at once, to see
+whether throughput scales with the number of clients.
+
+Usage:
+    stress.py <mount point> [seconds per round] [max threads]
+
+The files directly under the mount point and under each tag are
+collected first. Then every client loops over them doing a stat and a
+read of the first block. A round is run for 1, 2, 4, ... up to max
+threads clients and its ops/sec is printed. Mount tagfs with -s to
+compare against single threaded serving.
+"""
+import os
+import sys
+import time
+import threading
+
+BlockSize = 64 * 1024
+
+def collect(mnt):
+    """Files at the root and one tag deep, tag dirs are not walked further."""
+    files = []
+    for name in os.listdir(mnt):
+        path = os.path.join(mnt, name)
+        if os.path.isdir(path):
+            for sub in os.listdir(path):
+                subpath = os.path.join(path, sub)
+                if not os.path.isdir(subpath):
+                    files.append(subpath)
+        else:
+            files.append(path)
+    return files
+
+class Client(threading.Thread):
+
+    def __init__(self, files, start, stop):
+        threading.Thread.__init__(self)
+        self.files = files
+        self.next = start
+        self.stop = stop
+        self.ops = 0
+        self.errors = 0
+
+    def run(self):
+        while not self.stop.isSet():
+            path = self.files[self.next % len(self.files)]
+            self.next += 1
+            try:
+                os.stat(path)
+                f = open(path, 'rb')
+                f.read(BlockSize)
+                f.close()
+                self.ops += 2
+            except (IOError, OSError):
+                self.errors += 1
+
+def run_round(files, nthreads, seconds):
+    stop = threading.Event()
+    clients = [Client(files, i * len(files) / nthreads, stop)
+               for i in range(nthreads)]
+    begin = time.time()
+    for c in clients:
+        c.start()
+    time.sleep(seconds)
+    stop.set()
+    for c in clients:
+        c.join()
+    elapsed = time.time() - begin
+    ops = sum([c.ops for c in clients])
+    errors = sum([c.errors for c in clients])
+    return (ops / elapsed, errors)
+
+def stress(mnt, seconds, maxthreads):
+    files = collect(mnt)
+    if len(files) == 0:
+        print 'no files under '+mnt
+        return 1
+    print str(len(files))+' files'
+    print 'threads\tops/sec\terrors'
+    nthreads = 1
+    while nthreads <= maxthreads:
+        opsps, errors = run_round(files, nthreads, seconds)
+        print '%d\t%.1f\t%d' % (nthreads, opsps, errors)
+        nthreads *= 2
+    return 0
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print __doc__
+        sys.exit(1)
+    seconds = 5
+    maxthreads = 16
+    if len(sys.argv) > 2:
+        seconds = float(sys.argv[2])
+    if len(sys.argv) > 3:
+        maxthreads = int(sys.argv[3])
+    sys.exit(stress(sys.argv[1], seconds, maxthreads))
@@ -0,0 +1,279 @@
+#! /usr/bin/python
+
+"""
+tagdb benchmarks the tag db hot paths directly, without FUSE, on a
+synthetic store.
+
+Usage:
+    tagdb.py [options]
+
+The store has N files. Each has 1 to K tags drawn from T tags with Zipf
+distributed popularity, so a few tags are on most files and most tags on
+a few. A fraction of the files share their name with others, which is
+what makes the names of a dir listing need disambiguation. The same seed
+gives the same store and the same operations.
+
+Every benchmark runs a number of operations and reports ops/sec and the
+mean, median and 99th percentile latency. Operations which fail, such as
+lookups of dirs whose same named files can not be told apart, take an
+early exit: they are counted in errors and timed apart, as <name>_error.
+-o writes the results as JSON, with the parameters and the git commit,
+to compare across commits. Lookups bypass the path cache unless --cache
+is given.
+"""
+import os
+import sys
+import time
+import random
+import tempfile
+import shutil
+import subprocess
+import logging
+from bisect import bisect
+from optparse import OptionParser
+try:
+    import json
+except ImportError:
+    json = None
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                '..', 'tagfs'))
+import TagDB
+import SQLiteTagDB
+
+class Workload:
+    """Synthetic files and the paths to look them up by"""
+
+    def __init__(self, nfiles, ntags, maxtags, collide, zipf, seed):
+        self.rnd = random.Random(seed)
+        self.tags = ['t%d' % i for i in range(ntags)]
+        cum = []
+        total = 0.0
+        for rank in range(1, ntags + 1):
+            total += 1.0 / rank ** zipf
+            cum.append(total)
+        self.cum = cum
+        self.files = []
+        for i in range(nfiles):
+            if self.rnd.random() < collide:
+                fname = 'shared%d.jpg' % self.rnd.randrange(64)
+            else:
+                fname = 'file%d.jpg' % i
+            ftags = self.pick_tags(self.rnd.randint(1, maxtags))
+            self.files.append(('%032x' % i, fname, ftags))
+
+    def pick_tag(self):
+        return self.tags[bisect(self.cum, self.rnd.random() * self.cum[-1])]
+
+    def pick_tags(self, n):
+        tags = []
+        while len(tags) < n:
+            t = self.pick_tag()
+            if t not in tags:
+                tags.append(t)
+        return tags
+
+    def dir_path(self):
+        return '/' + '/'.join(self.pick_tags(self.rnd.randint(1, 2))) + '/'
+
+    def file_path(self, f):
+        return '/' + ''.join([t + '/' for t in f.tags]) + f.fname
+
+class Result:
+    def __init__(self, name, lats, errors = 0):
+        lats.sort()
+        self.name = name
+        self.ops = len(lats)
+        self.errors = errors
+        self.secs = sum(lats)
+        self.mean = 0.0
+        self.p50 = 0.0
+        self.p99 = 0.0
+        if self.ops != 0:
+            self.mean = self.secs / self.ops
+            self.p50 = lats[self.ops / 2]
+            self.p99 = lats[min(self.ops - 1, self.ops * 99 / 100)]
+
+    def opsps(self):
+        if self.secs == 0:
+            return 0.0
+        return self.ops / self.secs
+
+    def todict(self):
+        return {'ops': self.ops, 'errors': self.errors,
+                'ops_per_sec': self.opsps(), 'mean_us': self.mean * 1e6,
+                'p50_us': self.p50 * 1e6, 'p99_us': self.p99 * 1e6}
+
+def timed(name, ops, op):
+    """
+    Run op(i) for i in range(ops), each one timed on its own.
+    @return: [Result of the ops which succeeded, and of the others if any]
+    """
+    lats = []
+    errlats = []
+    for i in xrange(ops):
+        begin = time.time()
+        try:
+            op(i)
+            lats.append(time.time() - begin)
+        except (TagDB.NoTagException, TagDB.NoUniqueTagException,
+                TagDB.NameConflictionException, TagDB.NoFileException):
+            errlats.append(time.time() - begin)
+    rs = [Result(name, lats, len(errlats))]
+    if len(errlats) != 0:
+        rs.append(Result(name + '_error', errlats))
+    return rs
+
+def distinct(db, fids):
+    """
+    fids without the same named files make_unique can not tell apart,
+    but the first of each such name, so that make_unique(fids) succeeds.
+    Names are made unique one at a time, a name can be checked alone.
+    """
+    make_unique = db._TagDB__make_unique
+    byname = {}
+    for fid in fids:
+        byname.setdefault(db.flist[fid].fname, []).append(fid)
+    keep = set()
+    for group in byname.itervalues():
+        try:
+            make_unique(group)
+            keep.update(group)
+        except TagDB.NoUniqueTagException:
+            keep.add(group[0])
+    return [fid for fid in fids if fid in keep]
+
+def open_db(engine, tmpdir):
+    logger = logging.getLogger('bench')
+    if engine == 'sqlite':
+        return SQLiteTagDB.SQLiteTagDB(logger, os.path.join(
+                tmpdir, SQLiteTagDB.DefaultSQLiteDBFile))
+    return TagDB.TagDB(logger)
+
+def run(opts):
+    wl = Workload(opts.files, opts.tags, opts.maxtags, opts.collide,
+                  opts.zipf, opts.seed)
+    tmpdir = tempfile.mkdtemp(prefix='tagdb-bench-')
+    results = []
+    try:
+        db = open_db(opts.engine, tmpdir)
+        if opts.engine == 'memory' and not opts.cache:
+            # every lookup is evicted right away
+            db.pathcache.size = 0
+
+        results.extend(timed('add_file', len(wl.files),
+                             lambda i: db.add_file(*wl.files[i])))
+        fuuids = [f[0] for f in wl.files if f[0] in db.files]
+        if len(fuuids) == 0:
+            raise Exception('no file could be added')
+
+        dirs = [wl.dir_path() for i in range(opts.ops)]
+        paths = [wl.file_path(db.files[wl.rnd.choice(fuuids)])
+                 for i in range(opts.ops)]
+        results.extend(timed('find_by_path_dir', opts.ops,
+                             lambda i: db.find_by_path(dirs[i], 'dir')))
+        results.extend(timed('find_by_path_file', opts.ops,
+                             lambda i: db.find_by_path(paths[i], 'file')))
+        mixed = [(dirs[i][:-1], paths[i])[i % 2] for i in range(opts.ops)]
+        results.extend(timed('find_by_path_unsure', opts.ops,
+                             lambda i: db.find_by_path(mixed[i], 'unsure')))
+
+        if opts.engine == 'memory':
+            # names of the biggest dirs, where collisions pile up
+            big = sorted([t for t in wl.tags if t in db.tags],
+                         key=lambda t: -len(db.postings[db.tags[t]]))
+            lists = [distinct(db, db.postings[db.tags[t]]) for t in big[:8]]
+            make_unique = db._TagDB__make_unique
+            results.extend(timed('make_unique', opts.ops / 10 + 1,
+                                 lambda i: make_unique(lists[i % len(lists)])))
+
+        changes = []
+        for i in range(opts.ops):
+            f = db.files[wl.rnd.choice(fuuids)]
+            changes.append((f.fuuid, [wl.rnd.choice(f.tags)],
+                            [wl.pick_tag()]))
+        results.extend(timed('change_file_tags', opts.ops,
+                             lambda i: db.change_file_tags(*changes[i])))
+
+        dbfile = os.path.join(tmpdir, 'stored.db')
+        results.extend(timed('store_db', opts.rounds,
+                             lambda i: db.store_db(dbfile)))
+        db.close()
+        db2 = open_db(opts.engine, tmpdir)
+        results.extend(timed('load_db', opts.rounds,
+                             lambda i: db2.load_db(dbfile)))
+        db2.close()
+    finally:
+        shutil.rmtree(tmpdir, True)
+    return results
+
+def git_commit():
+    try:
+        p = subprocess.Popen(['git', 'rev-parse', 'HEAD'],
+                             cwd=os.path.dirname(os.path.realpath(__file__)),
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out = p.communicate()[0].strip()
+        if p.returncode == 0:
+            return out
+    except OSError:
+        pass
+    return None
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-n', '--files', type='int', default=20000,
+                      help='files in the store [default: %default]')
+    parser.add_option('-t', '--tags', type='int', default=200,
+                      help='distinct tags [default: %default]')
+    parser.add_option('-k', '--maxtags', type='int', default=4,
+                      help='most tags of a file [default: %default]')
+    parser.add_option('-c', '--collide', type='float', default=0.2,
+                      help='fraction of files with a shared name '
+                      '[default: %default]')
+    parser.add_option('-z', '--zipf', type='float', default=1.1,
+                      help='Zipf exponent of tag popularity '
+                      '[default: %default]')
+    parser.add_option('-p', '--ops', type='int', default=2000,
+                      help='operations per benchmark [default: %default]')
+    parser.add_option('-r', '--rounds', type='int', default=3,
+                      help='store_db/load_db rounds [default: %default]')
+    parser.add_option('-s', '--seed', type='int', default=1)
+    parser.add_option('-e', '--engine', default='memory',
+                      help='memory or sqlite [default: %default]')
+    parser.add_option('--cache', action='store_true', default=False,
+                      help='let lookups hit the path cache')
+    parser.add_option('-o', '--output', metavar='FILE',
+                      help='write the results as JSON into FILE')
+    opts, args = parser.parse_args()
+    if opts.engine not in ('memory', 'sqlite'):
+        parser.error('unknown engine ' + opts.engine)
+
+    # the tag db logs lookups that miss as errors
+    logging.basicConfig(level = logging.CRITICAL)
+    results = run(opts)
+
+    print '%-26s %8s %12s %10s %10s %10s %6s' % \
+          ('benchmark', 'ops', 'ops/sec', 'mean us', 'p50 us', 'p99 us',
+           'errors')
+    for r in results:
+        print '%-26s %8d %12.1f %10.1f %10.1f %10.1f %6d' % \
+              (r.name, r.ops, r.opsps(), r.mean * 1e6, r.p50 * 1e6,
+               r.p99 * 1e6, r.errors)
+
+    if opts.output != None:
+        if json == None:
+            print 'json is not available, no output written'
+            sys.exit(1)
+        report = {'commit': git_commit(), 'time': time.time(),
+                  'python': sys.version.split()[0],
+                  'params': dict((k, getattr(opts, k)) for k in
+                                 ('files', 'tags', 'maxtags', 'collide',
+                                  'zipf', 'ops', 'rounds', 'seed', 'engine',
+                                  'cache')),
+                  'results': dict((r.name, r.todict()) for r in results)}
+        out = open(opts.output, 'w')
+        try:
+            json.dump(report, out, indent=2, sort_keys=True)
+            out.write('\n')
+        finally:
+            out.close()
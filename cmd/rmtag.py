@@ -0,0 +1,34 @@
+#! /usr/bin/python
+
+"""
+rmtag removes tags from a mounted tagfs: each tag is taken off all its
+files and the files left without tags are removed, like rm -r on the
+tag dir does, but in one metadata operation instead of an unlink per
+file.
+
+We use xattr to implement rmtag: writing rmtag on a top level tag dir.
+"""
+import xattr
+import sys
+import os
+
+def rmtag(path):
+    xattr.set(path, 'rmtag', '')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 1:
+        print 'usage: rmtag.py <tag dir>...'
+        sys.exit(2)
+
+    rc = 0
+    for path in sys.argv[1:]:
+        try:
+            rmtag(os.path.realpath(path))
+        except IOError as ioe:
+            print path + ': ' + ioe.strerror
+            rc = 1
+        except Exception as e:
+            print path + ': ' + str(e)
+            rc = 1
+    sys.exit(rc)
@@ -0,0 +1,204 @@
+#! /usr/bin/python
+
+"""
+tagfsck checks a tagfs back-store while it is not mounted.
+
+Checks:
+    1 the tag db indexes agree with the file records (postings pointing
+      to removed files, files missing from the postings of their tags,
+      name and co-tag indexes)
+    2 every file of the db has its <uuid>_<name> file in the back-store,
+      where its layout puts it, stat-ed from a pool of threads
+    3 every <uuid>_<name> file of the back-store is in the db
+
+With --repair the indexes are rebuilt, files missing from the back-store
+are taken out of the db and orphan files are added back with the tag
+lost+found. --rebuild rebuilds the indexes even when they look fine.
+
+--export writes a csv manifest of the store which tagimport.py can import
+into another back-store.
+"""
+import sys
+import os
+import csv
+import time
+import threading
+import Queue
+import logging
+
+import tagimport
+import TagDB
+import StoreLayout
+
+# tag orphan files get when repaired
+LostTag = 'lost+found'
+
+StatThreads = 8
+
+def _rate(n, secs):
+    return str(n)+' files in '+('%.2f' % secs)+'s ('+ \
+           ('%.0f' % (n / max(secs, 1e-6)))+' files/s)'
+
+def stat_files(layout, fullnames, nthreads = StatThreads):
+    """Names of fullnames which are not regular files in the store"""
+    q = Queue.Queue(nthreads * 64)
+    bad = []
+    badlock = threading.Lock()
+
+    def worker():
+        while True:
+            name = q.get()
+            if name == None:
+                return
+            try:
+                ok = os.path.isfile(layout.path(name))
+            except Exception:
+                ok = False
+            if not ok:
+                badlock.acquire()
+                try:
+                    bad.append(name)
+                finally:
+                    badlock.release()
+
+    workers = [threading.Thread(target=worker) for i in range(nthreads)]
+    for w in workers:
+        w.setDaemon(True)
+        w.start()
+    for name in fullnames:
+        q.put(name)
+    for w in workers:
+        q.put(None)
+    for w in workers:
+        w.join()
+    return bad
+
+def scan_store(layout):
+    """{fuuid=>fname} of the files in the store named as tagfs names them"""
+    found = {}
+    for name, path in layout.all_names():
+        fuuid, fname = StoreLayout.split_store_name(name)
+        found[fuuid] = fname
+    return found
+
+def export_store(tdb, layout, mfile):
+    mf = open(mfile, 'wb')
+    try:
+        w = csv.writer(mf)
+        n = 0
+        for f in tdb.files.itervalues():
+            w.writerow([os.path.abspath(layout.path(f.getfullname())),
+                        '/'.join(f.tags), f.fname])
+            n += 1
+    finally:
+        mf.close()
+    return n
+
+def tagfsck(backstore, repair = False, rebuild = False, nthreads = StatThreads):
+    """@return: the number of problems found"""
+    layout = StoreLayout.load_layout(backstore)
+    tdb = tagimport.open_tagdb(backstore)
+    try:
+        nproblems = 0
+        t = time.time()
+        problems = tdb.check_index()
+        for p in problems:
+            print 'index: ' + p
+        nproblems += len(problems)
+        print 'index checked in ' + ('%.2f' % (time.time() - t)) + 's'
+        if (repair and len(problems) != 0) or rebuild:
+            t = time.time()
+            tdb.rebuild_index()
+            print 'index rebuilt: ' + _rate(len(tdb.files), time.time() - t)
+
+        t = time.time()
+        known = {}
+        for f in tdb.files.itervalues():
+            known[f.fuuid] = f.fname
+        missing = stat_files(layout,
+                             [fuuid + '_' + fname
+                              for fuuid, fname in known.iteritems()],
+                             nthreads)
+        print 'stat: ' + _rate(len(known), time.time() - t)
+        for name in missing:
+            print 'missing: ' + name
+        nproblems += len(missing)
+
+        orphans = [(fuuid, fname)
+                   for fuuid, fname in scan_store(layout).iteritems()
+                   if known.get(fuuid) != fname]
+        for fuuid, fname in orphans:
+            print 'orphan: ' + fuuid + '_' + fname
+        nproblems += len(orphans)
+
+        if repair:
+            missing = set(missing)
+            for fuuid, fname in orphans:
+                name = fuuid + '_' + known.get(fuuid, '')
+                if name in missing:
+                    # the db has another name for it, rename it back
+                    layout.rename(fuuid + '_' + fname, name)
+                    missing.remove(name)
+            for name in missing:
+                tdb.rm_file(StoreLayout.split_store_name(name)[0])
+            for fuuid, fname in orphans:
+                if fuuid in known:
+                    continue
+                try:
+                    tdb.add_files([(fuuid, fname, [LostTag])])
+                except TagDB.NoUniqueTagException:
+                    print 'can not add back ' + fuuid + '_' + fname \
+                          + ', name taken in ' + LostTag
+            tdb.commit()
+        if (repair and nproblems != 0) or rebuild:
+            # the rebuilt index is not journaled, snapshot it
+            tdb.store_db(tdb.dbfile)
+    finally:
+        tdb.close()
+    return nproblems
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    opts = {'--repair': False, '--rebuild': False}
+    nthreads = StatThreads
+    mfile = None
+    backstore = None
+    while len(args) != 0:
+        a = args.pop(0)
+        if a in opts:
+            opts[a] = True
+        elif a == '--threads' and len(args) != 0:
+            nthreads = int(args.pop(0))
+        elif a == '--export' and len(args) != 0:
+            mfile = args.pop(0)
+        elif backstore == None:
+            backstore = a
+        else:
+            backstore = None
+            break
+    if backstore == None:
+        print 'usage: tagfsck.py <back-store> [--repair] [--rebuild]' \
+              + ' [--threads N] [--export manifest.csv]'
+        sys.exit(2)
+
+    # the tag db logs lookups that miss as errors, only ours matter here
+    logging.basicConfig(level = logging.CRITICAL)
+    try:
+        n = tagfsck(backstore, opts['--repair'], opts['--rebuild'], nthreads)
+        print str(n) + ' problems found'
+        if mfile != None:
+            tdb = tagimport.open_tagdb(backstore)
+            try:
+                t = time.time()
+                n2 = export_store(tdb, StoreLayout.load_layout(backstore),
+                                  mfile)
+                print 'exported: ' + _rate(n2, time.time() - t)
+            finally:
+                tdb.close()
+        if n == 0 or opts['--repair']:
+            sys.exit(0)
+    except Exception as e:
+        print str(e)
+
+    sys.exit(1)
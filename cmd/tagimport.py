@@ -0,0 +1,143 @@
+#! /usr/bin/python
+
+"""
+tagimport brings many files into a tagfs back-store at once, instead of
+copying them one by one through the mount point.
+
+Sources can be:
+    1 a directory tree, the dirs above a file become its tags
+    2 a csv manifest, one file per row: path,tags[,name] with the tags
+      separated by '/' and name defaulting to the file's own name
+
+All files are added to the tag db in a single batch: if one of them is not
+unique, none is imported. Files are copied into the back-store, or moved
+with --move. The file system must not be mounted meanwhile.
+"""
+import sys
+import os
+import csv
+import shutil
+import uuid
+import logging
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                '..', 'tagfs'))
+import TagDB
+import TagJournal
+import SQLiteTagDB
+import StoreLayout
+import tagfsutils
+
+def _clean_tags(tags):
+    rs = []
+    for t in tags:
+        if t != '' and t not in rs:
+            rs.append(t)
+    return rs
+
+def scan_tree(srcdir):
+    """(path, tags, name) of every file under srcdir"""
+    entries = []
+    for dirpath, dirnames, filenames in os.walk(srcdir):
+        rel = os.path.relpath(dirpath, srcdir)
+        tags = []
+        if rel != '.':
+            tags = _clean_tags(rel.split(os.sep))
+        for fname in filenames:
+            entries.append((os.path.join(dirpath, fname), tags, fname))
+    return entries
+
+def read_manifest(mfile):
+    """(path, tags, name) of every row of a csv manifest"""
+    entries = []
+    mf = open(mfile, 'rb')
+    try:
+        for row in csv.reader(mf):
+            if len(row) == 0:
+                continue
+            path = row[0]
+            tags = []
+            if len(row) > 1:
+                tags = _clean_tags(row[1].split('/'))
+            fname = os.path.basename(path)
+            if len(row) > 2 and row[2] != '':
+                fname = row[2]
+            entries.append((path, tags, fname))
+    finally:
+        mf.close()
+    return entries
+
+def open_tagdb(backstore):
+    """The tag db of a back-store, sqlite if it has been mounted so"""
+    logger = logging.getLogger('tagimport')
+    sqlitedb = os.path.join(backstore, SQLiteTagDB.DefaultSQLiteDBFile)
+    if os.path.exists(sqlitedb):
+        tdb = SQLiteTagDB.SQLiteTagDB(logger)
+        tdb.load_db(sqlitedb)
+    else:
+        tdb = TagDB.TagDB(logger)
+        tdb.load_db(os.path.join(backstore, TagDB.DefaultMetaDBFile),
+                    os.path.join(backstore, TagJournal.DefaultJournalFile))
+    return tdb
+
+def tagimport(backstore, entries, move = False):
+    for path, tags, fname in entries:
+        if not os.path.isfile(path):
+            raise Exception('not a file: ' + path)
+        reserved = tagfsutils.reserved_names(tags + [fname])
+        if len(reserved) != 0:
+            raise Exception(reserved[0] + ' is reserved: ' + path)
+
+    layout = StoreLayout.load_layout(backstore)
+    tdb = open_tagdb(backstore)
+    try:
+        files = []
+        placed = []
+        try:
+            for path, tags, fname in entries:
+                fuuid = uuid.uuid4().hex
+                dst = layout.new_path(fuuid + '_' + fname)
+                if move:
+                    shutil.move(path, dst)
+                else:
+                    shutil.copy2(path, dst)
+                placed.append((path, dst))
+                files.append((fuuid, fname, tags))
+            tdb.add_files(files)
+            tdb.commit()
+        except:
+            for path, dst in reversed(placed):
+                if move:
+                    shutil.move(dst, path)
+                else:
+                    os.remove(dst)
+            raise
+    finally:
+        tdb.close()
+    return len(files)
+
+
+if __name__ == '__main__':
+    args = [a for a in sys.argv[1:] if a != '--move']
+    if len(args) != 2:
+        print 'usage: tagimport.py <back-store> <source dir | manifest.csv>' \
+              + ' [--move]'
+        sys.exit(2)
+
+    backstore, source = args
+    # the tag db logs lookups that miss as errors, only ours matter here
+    logging.basicConfig(level = logging.CRITICAL)
+    try:
+        if os.path.isdir(source):
+            entries = scan_tree(source)
+        else:
+            entries = read_manifest(source)
+        n = tagimport(backstore, entries, '--move' in sys.argv)
+        print 'imported ' + str(n) + ' files'
+        sys.exit(0)
+    except TagDB.NoUniqueTagException as ne:
+        print 'nothing imported: ' + ne.msg
+    except Exception as e:
+        print 'nothing imported: ' + str(e)
+
+    sys.exit(1)
@@ -0,0 +1,57 @@
+#! /usr/bin/python
+
+"""
+tagrelayout moves the files of a tagfs back-store, while it is not
+mounted, to another fanout: 0 keeps them all in the back-store root,
+1 to 3 spreads them over that many levels of 256 dirs named after their
+uuid. A mounted store is moved in the background with -o fanout instead.
+
+Without a fanout it prints the layout of the back-store. A move that was
+interrupted, here or while mounted, is finished first.
+"""
+import sys
+import os
+import time
+import logging
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                '..', 'tagfs'))
+import StoreLayout
+
+def tagrelayout(backstore, fanout):
+    """@return: the number of files moved"""
+    layout = StoreLayout.load_layout(backstore)
+    n = 0
+    if layout.oldfanout != None and layout.fanout != fanout:
+        print 'finishing the move from fanout ' + str(layout.oldfanout) \
+              + ' to ' + str(layout.fanout)
+        n += layout.migrate()
+    layout.begin(fanout)
+    n += layout.migrate()
+    return n
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    if len(args) == 0 or len(args) > 2 or not os.path.isdir(args[0]):
+        print 'usage: tagrelayout.py <back-store> [fanout]'
+        sys.exit(2)
+
+    logging.basicConfig(level = logging.CRITICAL)
+    backstore = args[0]
+    if len(args) == 1:
+        layout = StoreLayout.load_layout(backstore)
+        print 'fanout ' + str(layout.fanout)
+        if layout.oldfanout != None:
+            print 'moving from fanout ' + str(layout.oldfanout)
+        sys.exit(0)
+    try:
+        t = time.time()
+        n = tagrelayout(backstore, int(args[1]))
+        secs = time.time() - t
+        print 'moved ' + str(n) + ' files in ' + ('%.2f' % secs) + 's (' \
+              + ('%.0f' % (n / max(secs, 1e-6))) + ' files/s)'
+        sys.exit(0)
+    except Exception as e:
+        print 'move failed: ' + str(e)
+    sys.exit(1)
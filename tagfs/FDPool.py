@@ -0,0 +1,122 @@
+# Pool of open back-store files
+
+import os
+import threading
+import LRUCache
+
+# open flags whose effect is more than getting an fd, never pooled
+Unpooled = os.O_CREAT | os.O_EXCL | os.O_TRUNC | os.O_APPEND
+
+class PooledFile:
+    """
+    A back-store file opened once for all the handles of the same file
+    and flags. They share its offset, so seek and io on it go under lock.
+    """
+
+    def __init__(self, key, fd, file):
+        self.key = key # (fuuid, flags)
+        self.fd = fd
+        self.file = file # file object on fd, None for raw fd io
+        self.lock = threading.Lock()
+        self.refs = 1
+        self.stale = False # out of the pool, closed by the last release
+
+    def close(self):
+        if self.file != None:
+            self.file.close()
+        else:
+            os.close(self.fd)
+
+class FDPool:
+    """
+    Back-store files opened by tagfs handles, keyed by fuuid and open
+    flags. Handles opening the same file with the same flags share one
+    PooledFile, counted in its refs, and it stays open after the last of
+    them is released. At most size files are pooled, the least recently
+    opened one is taken out to make room and closed once it is unused.
+    So are the files of a fuuid which is removed or changed in a way that
+    matters to open, see forget. files.hits and files.misses count the
+    opens which found the file open or not.
+    """
+
+    def __init__(self, size):
+        self.lock = threading.Lock()
+        # files is {(fuuid, flags)=>PooledFile}
+        self.files = LRUCache.LRUCache(size, self.__evicted)
+        self.flagsof = {} # flagsof is {fuuid=>set of flags} pooled
+
+    def __len__(self):
+        return len(self.files)
+
+    def __evicted(self, key, pf):
+        self.__unpooled(key, pf)
+
+    def __unpooled(self, key, pf):
+        fuuid, flags = key
+        pooled = self.flagsof[fuuid]
+        pooled.discard(flags)
+        if len(pooled) == 0:
+            del self.flagsof[fuuid]
+        pf.stale = True
+        if pf.refs == 0:
+            pf.close()
+
+    def acquire(self, fuuid, flags, opener):
+        """
+        The PooledFile of fuuid opened with flags. If there is none,
+        opener() opens one and gives (fd, file object or None).
+        """
+        key = (fuuid, flags)
+        self.lock.acquire()
+        try:
+            pf = self.files.get(key)
+            if pf != None:
+                pf.refs += 1
+                return pf
+        finally:
+            self.lock.release()
+
+        fd, file = opener()
+        pf = PooledFile(key, fd, file)
+        self.lock.acquire()
+        try:
+            other = self.files.pop(key)
+            if other == None:
+                self.flagsof.setdefault(fuuid, set()).add(flags)
+                self.files.put(key, pf)
+                return pf
+            # opened by another handle meanwhile
+            other.refs += 1
+            self.files.put(key, other)
+        finally:
+            self.lock.release()
+        pf.close()
+        return other
+
+    def release(self, pf):
+        self.lock.acquire()
+        try:
+            pf.refs -= 1
+            if pf.refs == 0 and pf.stale:
+                pf.close()
+        finally:
+            self.lock.release()
+
+    def forget(self, fuuid):
+        """Close the files of fuuid, the ones in use when released"""
+        self.lock.acquire()
+        try:
+            for flags in list(self.flagsof.get(fuuid, ())):
+                key = (fuuid, flags)
+                self.__unpooled(key, self.files.pop(key))
+        finally:
+            self.lock.release()
+
+    def close(self):
+        """Close all files, the ones in use when released"""
+        self.lock.acquire()
+        try:
+            for key in self.files.nodes.keys():
+                self.__unpooled(key, self.files.pop(key))
+        finally:
+            self.lock.release()
@@ -0,0 +1,79 @@
+# Bounded LRU cache
+
+class _Node(object):
+    __slots__ = ('key', 'value', 'prev', 'next')
+
+class LRUCache:
+    """
+    Mapping of at most size entries, the least recently used one is evicted
+    to make room. onevict(key, value) is called for every evicted entry.
+    hits and misses count the outcomes of get().
+    """
+
+    def __init__(self, size, onevict = None):
+        self.size = size
+        self.onevict = onevict
+        self.hits = 0
+        self.misses = 0
+        self.nodes = {}
+        # circular list with a sentinel, most recently used at head.next
+        self.head = _Node()
+        self.head.prev = self.head
+        self.head.next = self.head
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __contains__(self, key):
+        return key in self.nodes
+
+    def __unlink(self, node):
+        node.prev.next = node.next
+        node.next.prev = node.prev
+
+    def __push(self, node):
+        node.prev = self.head
+        node.next = self.head.next
+        self.head.next.prev = node
+        self.head.next = node
+
+    def get(self, key, default = None):
+        node = self.nodes.get(key)
+        if node == None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self.__unlink(node)
+        self.__push(node)
+        return node.value
+
+    def put(self, key, value):
+        node = self.nodes.get(key)
+        if node != None:
+            node.value = value
+            self.__unlink(node)
+            self.__push(node)
+            return
+        node = _Node()
+        node.key = key
+        node.value = value
+        self.nodes[key] = node
+        self.__push(node)
+        while len(self.nodes) > self.size:
+            last = self.head.prev
+            self.__unlink(last)
+            del self.nodes[last.key]
+            if self.onevict != None:
+                self.onevict(last.key, last.value)
+
+    def pop(self, key, default = None):
+        node = self.nodes.pop(key, None)
+        if node == None:
+            return default
+        self.__unlink(node)
+        return node.value
+
+    def clear(self):
+        self.nodes = {}
+        self.head.prev = self.head
+        self.head.next = self.head
@@ -0,0 +1,74 @@
+# Reader/writer lock
+
+import thread
+import threading
+
+class RWLock:
+    """
+    Many readers or one writer. Both sides are reentrant and the writer may
+    take the read side too, so locked methods can call each other. A read
+    lock can not be upgraded to the write lock. Writers waiting keep new
+    readers out, but not threads already reading.
+    """
+
+    def __init__(self):
+        self.cond = threading.Condition(threading.Lock())
+        self.readers = {} # readers is {thread id=>depth}
+        self.writer = None
+        self.wdepth = 0
+        self.wwaiting = 0
+
+    def acquire_read(self):
+        me = thread.get_ident()
+        self.cond.acquire()
+        try:
+            if self.writer != me and me not in self.readers:
+                while self.writer != None or self.wwaiting > 0:
+                    self.cond.wait()
+            self.readers[me] = self.readers.get(me, 0) + 1
+        finally:
+            self.cond.release()
+
+    def release_read(self):
+        me = thread.get_ident()
+        self.cond.acquire()
+        try:
+            depth = self.readers[me] - 1
+            if depth == 0:
+                del self.readers[me]
+                if len(self.readers) == 0:
+                    self.cond.notifyAll()
+            else:
+                self.readers[me] = depth
+        finally:
+            self.cond.release()
+
+    def acquire_write(self):
+        me = thread.get_ident()
+        self.cond.acquire()
+        try:
+            if self.writer == me:
+                self.wdepth += 1
+                return
+            if me in self.readers:
+                raise RuntimeError('read lock can not be upgraded')
+            self.wwaiting += 1
+            try:
+                while self.writer != None or len(self.readers) != 0:
+                    self.cond.wait()
+            finally:
+                self.wwaiting -= 1
+            self.writer = me
+            self.wdepth = 1
+        finally:
+            self.cond.release()
+
+    def release_write(self):
+        self.cond.acquire()
+        try:
+            self.wdepth -= 1
+            if self.wdepth == 0:
+                self.writer = None
+                self.cond.notifyAll()
+        finally:
+            self.cond.release()
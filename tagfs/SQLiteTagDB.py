@@ -0,0 +1,1182 @@
+# Tag db on SQLite
+
+"""
+Tag db engine keeping files and tags in an SQLite database instead of in
+memory, for stores too big for TagDB. It answers the same calls as TagDB
+and gives the same results, only the tie between same named files that
+none of them can break may fall on another file.
+
+Every mutation is a transaction of its own, committed before it returns,
+so there is no journal. The database is in WAL mode. With the default
+durability every transaction is synced too and commit() has nothing
+left to do; the other modes of TagDB.DurabilityModes let SQLite sync the
+WAL only when it is checkpointed into the database, which commit() then
+has a background thread do within the commit window. Each thread talks to it through its own
+connection, lookups are serialized against mutations by rwlock like in
+TagDB.
+
+Tables:
+    file        fid, fuuid, fname
+    tag         tid, name
+    file_tag    fid, tid, pos: pos orders the tags of a file, it is NULL
+                for '/' which files created without tags are in
+"""
+
+import os
+import sqlite3
+import threading
+import tagfsutils
+import TagDB
+import RWLock
+import TagQuery
+import TagStats
+
+# for default sqlite db file
+DefaultSQLiteDBFile = '.tagfs_db.sqlite'
+
+SchemaVersion = 1
+
+_schema = """
+CREATE TABLE IF NOT EXISTS %(db)sfile (
+    fid INTEGER PRIMARY KEY,
+    fuuid TEXT NOT NULL UNIQUE,
+    fname TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS %(db)sfile_fname ON file (fname);
+CREATE TABLE IF NOT EXISTS %(db)stag (
+    tid INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE);
+CREATE TABLE IF NOT EXISTS %(db)sfile_tag (
+    tid INTEGER NOT NULL,
+    fid INTEGER NOT NULL,
+    pos INTEGER,
+    PRIMARY KEY (tid, fid));
+CREATE INDEX IF NOT EXISTS %(db)sfile_tag_fid ON file_tag (fid, pos);
+"""
+
+class _FileTable:
+    """{fuuid=>DBFile} view of the file table, as TagDB.files"""
+
+    def __init__(self, tdb):
+        self.tdb = tdb
+
+    def __getitem__(self, fuuid):
+        f = self.tdb.get_file(fuuid)
+        if f == None:
+            raise KeyError(fuuid)
+        return f
+
+    def __contains__(self, fuuid):
+        return self.tdb.get_file(fuuid) != None
+
+    def __len__(self):
+        return self.tdb.count('file')
+
+    def __iter__(self):
+        for f in self.tdb.iter_files():
+            yield f.fuuid
+
+    def itervalues(self):
+        return self.tdb.iter_files()
+
+class _TagTable:
+    """Names of the tag table, as the keys of TagDB.tags"""
+
+    def __init__(self, tdb):
+        self.tdb = tdb
+
+    def keys(self):
+        return self.tdb.tag_names()
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __contains__(self, tag):
+        return self.tdb.tag_id(tag) != None
+
+    def __len__(self):
+        return self.tdb.count('tag')
+
+class SQLiteTagDB:
+
+    def __init__(self, logger, dbfile = None):
+        self.logger = logger
+        self.dbfile = None
+        self.rwlock = RWLock.RWLock()
+        self.files = _FileTable(self)
+        self.tags = _TagTable(self)
+        # a connection per thread, all of them listed in conns so that
+        # they can be closed. gen moves on when the db file changes.
+        self.local = threading.local()
+        self.connlock = threading.Lock()
+        self.conns = []
+        self.gen = 0
+        self.durability = 'op'
+        self.commitwindow = TagDB.CommitWindow
+        self.commitrecords = TagDB.CommitRecords
+        # commits since the last group checkpoint, under commitlock
+        self.commitlock = threading.Lock()
+        self.unsynced = 0
+        self.committer = None
+        self.commit_wakeup = threading.Event()
+        self.commit_stop = False
+        if dbfile != None:
+            self.load_db(dbfile)
+
+    def __conn(self):
+        c = getattr(self.local, 'conn', None)
+        if c != None and self.local.gen == self.gen:
+            return c
+        if self.dbfile == None:
+            raise Exception('Sys error: no db file loaded')
+        c = sqlite3.connect(self.dbfile, isolation_level = None,
+                            check_same_thread = False)
+        c.text_factory = str
+        if self.durability == 'op':
+            c.execute('PRAGMA synchronous = FULL')
+        else:
+            c.execute('PRAGMA synchronous = NORMAL')
+        self.connlock.acquire()
+        try:
+            self.conns.append(c)
+        finally:
+            self.connlock.release()
+        self.local.conn = c
+        self.local.gen = self.gen
+        return c
+
+    def __close_conns(self):
+        self.connlock.acquire()
+        try:
+            for c in self.conns:
+                c.close()
+            self.conns = []
+            self.gen += 1
+        finally:
+            self.connlock.release()
+
+    def __begin(self):
+        c = self.__conn()
+        c.execute('BEGIN IMMEDIATE')
+        return c
+
+    def __tag_id(self, c, t, create = False):
+        row = c.execute('SELECT tid FROM tag WHERE name = ?', (t,)).fetchone()
+        if row != None:
+            return row[0]
+        if not create:
+            return None
+        return c.execute('INSERT INTO tag (name) VALUES (?)', (t,)).lastrowid
+
+    def __file_tags(self, c, fid):
+        return [r[0] for r in c.execute(
+                'SELECT name FROM file_tag JOIN tag USING (tid) '
+                + 'WHERE fid = ? AND pos IS NOT NULL ORDER BY pos', (fid,))]
+
+    def __file(self, c, fuuid):
+        row = c.execute('SELECT fid, fname FROM file WHERE fuuid = ?',
+                        (fuuid,)).fetchone()
+        if row == None:
+            return None
+        return TagDB.DBFile(fuuid, row[1], self.__file_tags(c, row[0]),
+                            row[0])
+
+    @tagfsutils.reader
+    def get_file(self, fuuid):
+        """DBFile of fuuid or None. Changing it does not change the db."""
+        return self.__file(self.__conn(), fuuid)
+
+    def iter_files(self):
+        """
+        Yield a DBFile for every file, streamed in one statement which sees
+        the db as it was when it started.
+        """
+        f = None
+        tags = []
+        for fid, fuuid, fname, t in self.__conn().cursor().execute(
+                'SELECT file.fid, fuuid, fname, name FROM file '
+                + 'LEFT JOIN file_tag ON file_tag.fid = file.fid '
+                + 'AND pos IS NOT NULL LEFT JOIN tag USING (tid) '
+                + 'ORDER BY file.fid, pos'):
+            if f == None or f.fid != fid:
+                if f != None:
+                    f.tags = tuple(tags)
+                    yield f
+                f = TagDB.DBFile(fuuid, fname, (), fid)
+                tags = []
+            if t != None:
+                tags.append(t)
+        if f != None:
+            f.tags = tuple(tags)
+            yield f
+
+    @tagfsutils.reader
+    def tag_id(self, t):
+        return self.__tag_id(self.__conn(), t)
+
+    @tagfsutils.reader
+    def tag_names(self):
+        return [r[0] for r in self.__conn().execute('SELECT name FROM tag')]
+
+    @tagfsutils.reader
+    def count(self, table):
+        return self.__conn().execute('SELECT COUNT(*) FROM '
+                                     + table).fetchone()[0]
+
+    def __tag_ids(self, c, qtags):
+        tids = []
+        for t in qtags:
+            tid = self.__tag_id(c, t)
+            if tid == None:
+                self.logger.debug('query by tags no tag: %s', t)
+                raise TagDB.NoTagException('Can not find tags ' + t, t)
+            tids.append(tid)
+        if len(tids) == 0:
+            self.logger.debug('query by tags no tag')
+            raise TagDB.NoTagException('Can not find tags', qtags)
+        return sorted(set(tids))
+
+    def __having_sql(self, tids):
+        """SQL selecting the fids of the files having all tids"""
+        return ' INTERSECT '.join(['SELECT fid FROM file_tag WHERE tid = ?']
+                                  * len(tids))
+
+    def __query_by_tags(self, c, qtags):
+        """Sorted ids of the files having all qtags"""
+        tids = self.__tag_ids(c, qtags)
+        return [r[0] for r in c.execute(
+                'SELECT fid FROM (' + self.__having_sql(tids)
+                + ') ORDER BY fid', tids)]
+
+    def __make_unique(self, c, rows):
+        """
+        make a file list unique in names, rows being [(fid, fuuid, fname)]
+        in the order of the result
+        """
+        fnames = {}
+        for fid, fuuid, fname in rows:
+            if fname in fnames:
+                fnames[fname].append(fid)
+            else:
+                fnames[fname] = [fid]
+
+        unqtags = {}
+        for fname, fids in fnames.iteritems():
+            if len(fids) > 1:
+                self.__unique_tags(c, fids, unqtags)
+
+        rs = []
+        for fid, fuuid, fname in rows:
+            t = unqtags.get(fid)
+            if t == None:
+                rs.append((fuuid,))
+            else:
+                rs.append((fuuid, t))
+        return rs
+
+    def __unique_tags(self, c, fids, unqtags):
+        """
+        Pick for each of the same named files fids a tag none of the
+        others has, into unqtags {fid=>tag}. Same rules as TagDB, see the
+        notagused comment there.
+        """
+        ftags = [self.__file_tags(c, fid) for fid in fids]
+        counts = {}
+        for tags in ftags:
+            for t in tags:
+                counts[t] = counts.get(t, 0) + 1
+
+        notagused = False
+        for fid, tags in zip(fids, ftags):
+            for t in tags:
+                if counts[t] == 1:
+                    unqtags[fid] = t
+                    break
+            else:
+                if notagused:
+                    fuuids = [r[0] for r in c.execute(
+                            'SELECT fuuid FROM file WHERE fid IN ('
+                            + ','.join(['?'] * len(fids)) + ') ORDER BY fid',
+                            fids)]
+                    raise TagDB.NoUniqueTagException(
+                            'Can not distinguish files: ' + str(fuuids),
+                            fuuids)
+                notagused = True
+
+    def __file_rows(self, c, qtags):
+        """[(fid, fuuid, fname)] of the files named qtags[-1] having the
+        other qtags"""
+        tids = self.__tag_ids(c, qtags[0:-1])
+        return c.execute('SELECT fid, fuuid, fname FROM file WHERE fname = ? '
+                         + 'AND fid IN (' + self.__having_sql(tids)
+                         + ') ORDER BY fid', [qtags[-1]] + tids).fetchall()
+
+    def __query_file(self, c, qtags):
+        """
+        qtags: tags splited from path, the last one is filename
+        """
+        return self.__make_unique(c, self.__file_rows(c, qtags))
+
+    def __query_dir(self, c, qtags):
+        tids = self.__tag_ids(c, qtags)
+        rows = c.execute('SELECT fid, fuuid, fname FROM file WHERE fid IN ('
+                         + self.__having_sql(tids) + ') ORDER BY fid',
+                         tids).fetchall()
+        return self.__make_unique(c, rows)
+
+    def __query_both(self, c, qtags):
+        ftags = qtags
+        frs = None
+        if len(ftags) == 1:
+            ftags = ['/'] + ftags
+        try:
+            frs = self.__query_file(c, ftags)
+        except TagDB.NoTagException:
+            self.logger.debug('query both file part no tag: %s', ftags)
+        except TagDB.NoUniqueTagException:
+            self.logger.debug('query both file part no unique tag: %s', ftags)
+
+        drs = None
+        notagex = None
+        try:
+            drs = self.__query_dir(c, qtags)
+        except TagDB.NoTagException as e:
+            # this must be re-raised!
+            self.logger.debug('query both dir part no tag: %s', qtags)
+            notagex = e
+        except TagDB.NoUniqueTagException as e:
+            self.logger.debug('query both dir part no unique tag: %s %s', qtags,
+                             e.msg)
+
+        if frs == None and drs == None:
+            if notagex == None:
+                raise TagDB.NoUniqueTagException('Can not distinguish '
+                                                 + 'files: '+str(qtags), qtags)
+            raise notagex
+        elif drs == None:
+            if len(frs) > 1:
+                return ('files', frs)
+            elif len(frs) == 1:
+                return ('file', frs[0])
+            else:
+                return ('no file',)
+        elif frs == None or frs == []:
+            return ('dir', drs)
+        else:
+            raise TagDB.NameConflictionException('Can\'t distinguish file '
+                                                 + 'and dir with tags: '
+                                                 + str(qtags))
+
+    def __clauses_sql(self, c, comps):
+        """
+        SQL selecting the fids of the files matching the query clauses in
+        comps, with its parameters. The clauses become an INTERSECT of the
+        positive ones followed by an EXCEPT per negative one.
+        """
+        try:
+            clauses = TagQuery.parse_query(comps)
+        except TagQuery.QueryException as e:
+            raise TagDB.NoTagException(e.msg + ': ' + e.clause, e.clause)
+        # counting the rows of every tag would cost more than it saves,
+        # each arm of the compound is built in full anyway
+        positives, negatives = TagQuery.plan(clauses, lambda t: 0)
+
+        parts = []
+        params = []
+        for cl in positives:
+            tids = [tid for tid in [self.__tag_id(c, t) for t in cl.tags]
+                    if tid != None]
+            if len(tids) == 0:
+                self.logger.debug('query no tag: %s', cl)
+                raise TagDB.NoTagException('Can not find tags ' + str(cl),
+                                           cl.tags)
+            parts.append('SELECT DISTINCT fid FROM file_tag WHERE tid IN ('
+                         + ','.join(['?'] * len(tids)) + ')')
+            params.extend(tids)
+        if len(parts) == 0:
+            parts.append('SELECT fid FROM file')
+        sql = ' INTERSECT '.join(parts)
+        for cl in negatives:
+            tids = [tid for tid in [self.__tag_id(c, t) for t in cl.tags]
+                    if tid != None]
+            if len(tids) != 0:
+                sql += ' EXCEPT SELECT fid FROM file_tag WHERE tid IN (' \
+                       + ','.join(['?'] * len(tids)) + ')'
+                params.extend(tids)
+        return (sql, params)
+
+    def __find_by_query(self, c, path, target, comps):
+        """Query path lookup, see TagDB.__find_by_query"""
+        if target == 'dir' or (path[-1] == '/' and target == 'unsure'):
+            sql, params = self.__clauses_sql(c, comps)
+            rows = c.execute('SELECT fid, fuuid, fname FROM file WHERE fid IN ('
+                             + sql + ') ORDER BY fid', params).fetchall()
+            return ('dir', self.__make_unique(c, rows))
+        if target != 'file' and target != 'unsure':
+            raise Exception('Invalid parameter: target = '+target)
+        if path[-1] == '/':
+            raise Exception('Sys error: query file but a dir path is '
+                            + 'given: ' + path)
+
+        frs = []
+        if len(comps) != 0:
+            sql, params = self.__clauses_sql(c, comps[0:-1])
+            rows = c.execute('SELECT fid, fuuid, fname FROM file '
+                             + 'WHERE fname = ? AND fid IN (' + sql
+                             + ') ORDER BY fid', [comps[-1]] + params)
+            frs = self.__make_unique(c, rows.fetchall())
+        if len(frs) == 1:
+            return ('file', frs[0])
+        elif len(frs) > 1:
+            return ('files', frs)
+        elif target == 'file':
+            raise TagDB.NoFileException('No such file', path)
+        return self.__find_by_query(c, path + '/', 'dir', comps)
+
+    @TagStats.timed('db.find_by_path')
+    @tagfsutils.reader
+    def find_by_path(self, path, target):
+        """Do query by tags in path, see TagDB.find_by_path."""
+        if len(path) == 0:
+            raise TagDB.NoTagException('No such file.', path)
+
+        tset = path.split('/')
+        if tset[0] == '':
+            del tset[0]
+        if tset[-1] == '':
+            del tset[-1]
+        if len(tset) == 0:
+            tset = ['/']
+
+        c = self.__conn()
+        if TagQuery.is_query(tset):
+            return self.__find_by_query(c, path, target, tset[1:])
+
+        if target == 'dir' or (path[-1] == '/' and target == 'unsure'):
+            return ('dir', self.__query_dir(c, tset))
+
+        elif target == 'file':
+            if path[-1] == '/':
+                raise Exception('Sys error: query file but a dir path is '
+                                + 'given: ' + path)
+            # use / as tag for files without tag
+            if len(tset) == 1:
+                tset = ['/'] + tset
+            frs = self.__query_file(c, tset)
+            if len(frs) == 0:
+                raise TagDB.NoFileException('No such file', path)
+            elif len(frs) == 1:
+                return ('file', frs[0])
+            else:
+                return ('files', frs)
+
+        elif target == 'unsure':
+            rs = self.__query_both(c, tset)
+            if rs[0] == 'no file':
+                raise TagDB.NoFileException('No such file', path)
+            return rs
+
+        else:
+            raise Exception('Invalid parameter: target = '+target)
+
+    def check_unique_filepath(self, filepath, existed=False):
+        """
+        Check if a file path is unique. The filepath includes a filename
+        and directory structure.
+        """
+        try:
+            rs = self.find_by_path(filepath, 'unsure')
+            if (rs[0] == 'files' or rs[0] == 'file') and existed:
+                return True
+
+            if not existed:
+                if rs[0] == 'files':
+                    for f in rs[1]:
+                        if len(f) == 1:
+                            return False
+                    return True
+                if rs[0] == 'file':
+                    f = self.files[rs[1][0]]
+                    rspath = '/' + ''.join([t + '/' for t in f.tags]) + f.fname
+                    if len(rspath) > len(filepath):
+                        return True
+            return False
+        except TagDB.NoTagException:
+            return True
+        except TagDB.NoUniqueTagException:
+            return False
+        except TagDB.NameConflictionException:
+            return False
+        except TagDB.NoFileException:
+            return True
+
+    def check_unique_file(self, tags, fname, existed=False):
+        """
+        Check if a file with fname as name and 'tags' as all its tags
+        can be told from the others, see TagDB.check_unique_file. Unless
+        fname is also a tag only the file query of its path is run.
+        """
+        tags = [t for t in tags if t != '/']
+        c = self.__conn()
+        if TagQuery.is_query(tags + [fname]) or \
+               self.__tag_id(c, fname) != None:
+            # the path is a dir as well, the lookup decides
+            return self.check_unique_filepath('/'.join([''] + tags + [fname]),
+                                              existed)
+        if existed:
+            return True
+        qtags = tags
+        if len(qtags) == 0:
+            qtags = ['/']
+        try:
+            rows = self.__file_rows(c, qtags + [fname])
+        except TagDB.NoTagException:
+            return True
+        if len(rows) == 0:
+            return True
+        if len(rows) == 1:
+            # the file there keeps its plain name unless it has more tags
+            return len(''.join([t + '/' for t in
+                                self.__file_tags(c, rows[0][0])])) > \
+                   len(''.join([t + '/' for t in tags]))
+        unqtags = {}
+        try:
+            self.__unique_tags(c, [r[0] for r in rows], unqtags)
+        except TagDB.NoUniqueTagException:
+            return self.check_unique_filepath('/'.join([''] + tags + [fname]))
+        # the new file would be the one without a unique tag
+        return len(unqtags) == len(rows)
+
+    @TagStats.timed('db.sub_tags')
+    @tagfsutils.reader
+    def sub_tags(self, qtags):
+        """Tags the files having all qtags have besides qtags."""
+        if TagQuery.is_query(qtags):
+            # no sub-tags for queries, any clause can be added to them
+            return []
+        c = self.__conn()
+        tids = self.__tag_ids(c, qtags)
+        qset = set(qtags)
+        return [r[0] for r in c.execute(
+                'SELECT DISTINCT name FROM file_tag JOIN tag USING (tid) '
+                + 'WHERE pos IS NOT NULL AND fid IN ('
+                + self.__having_sql(tids) + ')', tids)
+                if r[0] not in qset]
+
+    @TagStats.timed('db.open_dir')
+    @tagfsutils.reader
+    def open_dir(self, qtags):
+        """Start listing the dir of qtags, see TagDB.open_dir."""
+        c = self.__conn()
+        if TagQuery.is_query(qtags):
+            sql, params = self.__clauses_sql(c, qtags[1:])
+            fids = tagfsutils.new_posting([r[0] for r in c.execute(
+                    'SELECT fid FROM (' + sql + ') ORDER BY fid', params)])
+            return TagDB.DirListing(qtags, fids, [])
+        fids = tagfsutils.new_posting(self.__query_by_tags(c, qtags))
+        if qtags == ['/']:
+            subtags = [t for t in self.tag_names() if t != '/']
+        else:
+            subtags = self.sub_tags(qtags)
+        return TagDB.DirListing(qtags, fids, subtags)
+
+    @TagStats.timed('db.dir_entries')
+    @tagfsutils.reader
+    def dir_entries(self, listing, start, count):
+        """[(index, name), ...] of a part of listing, see TagDB.dir_entries."""
+        c = self.__conn()
+        end = min(start + count, len(listing.fids))
+        if start >= end:
+            return []
+        if TagQuery.is_query(listing.qtags):
+            # files of a query are the ones it had when opened
+            having = 'SELECT fid FROM file'
+            tids = []
+        else:
+            try:
+                tids = self.__tag_ids(c, listing.qtags)
+            except TagDB.NoTagException:
+                return []
+            having = self.__having_sql(tids)
+        # fids of a listing are sorted, the batch is a range of them
+        rows = c.execute('SELECT fid, fname, (SELECT COUNT(*) FROM file g '
+                         + 'WHERE g.fname = f.fname) FROM file f '
+                         + 'WHERE fid BETWEEN ? AND ? AND fid IN ('
+                         + having + ')',
+                         [listing.fids[start], listing.fids[end - 1]] + tids)
+        found = dict((fid, (fname, n)) for fid, fname, n in rows)
+
+        rs = []
+        for i in xrange(start, end):
+            fid = listing.fids[i]
+            if fid not in found:
+                continue
+            fname, n = found[fid]
+            if n == 1:
+                rs.append((i, fname))
+                continue
+            unqtags = listing.unique.get(fname)
+            if unqtags == None:
+                unqtags = listing.unique[fname] = {}
+                same = [r[0] for r in c.execute(
+                        'SELECT fid FROM file WHERE fname = ? ORDER BY fid',
+                        (fname,))
+                        if tagfsutils.in_postings([listing.fids], r[0])]
+                try:
+                    if len(same) > 1:
+                        self.__unique_tags(c, same, unqtags)
+                except TagDB.NoUniqueTagException as e:
+                    # they can not be told apart, leave them all out
+                    self.logger.error('dir entries: %s', e.msg)
+                    unqtags[None] = None
+            if None in unqtags:
+                continue
+            t = unqtags.get(fid)
+            if t == None:
+                rs.append((i, fname))
+            else:
+                rs.append((i, t + '/' + fname))
+        return rs
+
+    def __add_ftags(self, c, f, ftags):
+        pos = c.execute('SELECT COALESCE(MAX(pos) + 1, 0) FROM file_tag '
+                        + 'WHERE fid = ?', (f.fid,)).fetchone()[0]
+        for t in ftags:
+            tid = self.__tag_id(c, t, True)
+            if t != '/' and t not in f.tags:
+                f.tags += (t,)
+                c.execute('INSERT OR REPLACE INTO file_tag VALUES (?, ?, ?)',
+                          (tid, f.fid, pos))
+                pos += 1
+            else:
+                c.execute('INSERT OR IGNORE INTO file_tag VALUES (?, ?, NULL)',
+                          (tid, f.fid))
+
+    def __rm_ftags(self, c, f, ftags):
+        for t in ftags:
+            if t != '/' and t in f.tags:
+                f.tags = tuple([u for u in f.tags if u != t])
+            c.execute('DELETE FROM file_tag WHERE fid = ? AND tid = '
+                      + '(SELECT tid FROM tag WHERE name = ?)', (f.fid, t))
+
+    def __rm_file(self, c, f):
+        c.execute('DELETE FROM file_tag WHERE fid = ?', (f.fid,))
+        c.execute('DELETE FROM file WHERE fid = ?', (f.fid,))
+
+    def __in_root(self, c, f):
+        return c.execute('SELECT 1 FROM file_tag JOIN tag USING (tid) '
+                         + 'WHERE fid = ? AND name = ?',
+                         (f.fid, '/')).fetchone() != None
+
+    def __file_or_raise(self, c, fuuid):
+        f = self.__file(c, fuuid)
+        if f == None:
+            raise KeyError(fuuid)
+        return f
+
+    @TagStats.timed('db.add_file')
+    @tagfsutils.writer
+    def add_file(self, fuuid, fname, ftags):
+        if not self.check_unique_file(ftags, fname):
+            raise TagDB.NoUniqueTagException('File with name '+fname
+                                             +' and tags: '+str(ftags)
+                                             +' is not unique.', ftags)
+        newftags = ftags[:]
+        if '/' in newftags:
+            newftags = newftags[1:]
+        if len(ftags) == 0:
+            ftags = ['/']
+        c = self.__begin()
+        try:
+            fid = c.execute('INSERT INTO file (fuuid, fname) VALUES (?, ?)',
+                            (fuuid, fname)).lastrowid
+            f = TagDB.DBFile(fuuid, fname, [], fid)
+            self.__add_ftags(c, f, newftags)
+            self.__add_ftags(c, f, [t for t in ftags if t not in newftags])
+            c.execute('COMMIT')
+        except:
+            c.execute('ROLLBACK')
+            raise
+
+    @TagStats.timed('db.add_file_tags')
+    @tagfsutils.writer
+    def add_file_tags(self, fuuid, ftags):
+        c = self.__conn()
+        f = self.__file_or_raise(c, fuuid)
+        existed = False
+        if len(ftags) == 0:
+            existed = True
+        if not self.check_unique_file(ftags+list(f.tags), f.fname,
+                                      existed):
+            raise TagDB.NoUniqueTagException('File '+fuuid+' can not have '
+                                             + 'tags: ' + str(ftags)
+                                             + ', not unique.', ftags)
+        c = self.__begin()
+        try:
+            self.__add_ftags(c, f, ftags)
+            c.execute('COMMIT')
+        except:
+            c.execute('ROLLBACK')
+            raise
+
+    @TagStats.timed('db.rm_file')
+    @tagfsutils.writer
+    def rm_file(self, fuuid):
+        """Remove a file from db"""
+        c = self.__begin()
+        try:
+            f = self.__file(c, fuuid)
+            if f == None:
+                raise Exception('No such file: '+fuuid)
+            self.__rm_file(c, f)
+            c.execute('COMMIT')
+        except:
+            c.execute('ROLLBACK')
+            raise
+
+    @TagStats.timed('db.rename_file')
+    @tagfsutils.writer
+    def rename_file(self, fuuid, fname):
+        """Change the name of a file, its tags are kept."""
+        c = self.__begin()
+        try:
+            self.__file_or_raise(c, fuuid)
+            c.execute('UPDATE file SET fname = ? WHERE fuuid = ?',
+                      (fname, fuuid))
+            c.execute('COMMIT')
+        except:
+            c.execute('ROLLBACK')
+            raise
+
+    @TagStats.timed('db.rm_file_tags_by_path')
+    @tagfsutils.writer
+    def rm_file_tags_by_path(self, fuuid, path):
+        tset = tagfsutils.path2tags(path, 'file')[1]
+        del tset[-1]
+        c = self.__begin()
+        try:
+            f = self.__file_or_raise(c, fuuid)
+            self.__rm_ftags(c, f, tset)
+            # the check sees the removal, it is in our transaction
+            if not self.check_unique_file(f.tags, f.fname, True):
+                self.logger.error('not unique in rm file tags by path: %s',
+                                  f.tags)
+                raise TagDB.NoUniqueTagException(
+                        'Can not make file unique if remove tags. ' \
+                        + 'file: ' + fuuid + ' tags: ' + str(tset), tset)
+            rt = (False,)
+            if len(f.tags) == 0 and not self.__in_root(c, f):
+                self.__rm_file(c, f)
+                rt = (True, f.getfullname())
+            c.execute('COMMIT')
+            return rt
+        except:
+            c.execute('ROLLBACK')
+            raise
+
+    @TagStats.timed('db.rm_tags_by_path')
+    @tagfsutils.writer
+    def rm_tags_by_path(self, path):
+        tset = tagfsutils.path2tags(path, 'dir')[1]
+        c = self.__begin()
+        try:
+            for t in tset:
+                c.execute('DELETE FROM tag WHERE name = ? AND NOT EXISTS '
+                          + '(SELECT 1 FROM file_tag '
+                          + 'WHERE file_tag.tid = tag.tid)', (t,))
+            c.execute('COMMIT')
+        except:
+            c.execute('ROLLBACK')
+            raise
+
+    @TagStats.timed('db.change_file_tags')
+    @tagfsutils.writer
+    def change_file_tags(self, fuuid, rmtags, addtags):
+        self.logger.debug('change_file_tags: +%s -%s', addtags, rmtags)
+        c = self.__begin()
+        try:
+            f = self.__file_or_raise(c, fuuid)
+            self.__rm_ftags(c, f, rmtags)
+            existed = False
+            if len(addtags) == 0:
+                existed = True
+            if not self.check_unique_file(addtags+list(f.tags), f.fname,
+                                          existed):
+                self.logger.error('change file tags failed rm: %s add: %s',
+                                  rmtags, addtags)
+                raise TagDB.NoUniqueTagException('change file tags failed '
+                                                 + 'rm: '+str(rmtags)
+                                                 + ' add: '+str(addtags),
+                                                 addtags)
+            self.__add_ftags(c, f, addtags)
+            c.execute('COMMIT')
+        except:
+            c.execute('ROLLBACK')
+            raise
+
+    @TagStats.timed('db.add_files')
+    @tagfsutils.writer
+    def add_files(self, files):
+        """add_file for every (fuuid, fname, ftags) of files, all or none"""
+        c = self.__begin()
+        try:
+            for fuuid, fname, ftags in files:
+                # the check sees the files added before, they are in our
+                # transaction
+                if not self.check_unique_file(ftags, fname):
+                    raise TagDB.NoUniqueTagException('File with name '+fname
+                                                     +' and tags: '+str(ftags)
+                                                     +' is not unique.', ftags)
+                newftags = ftags[:]
+                if '/' in newftags:
+                    newftags = newftags[1:]
+                if len(ftags) == 0:
+                    ftags = ['/']
+                fid = c.execute('INSERT INTO file (fuuid, fname) '
+                                + 'VALUES (?, ?)', (fuuid, fname)).lastrowid
+                f = TagDB.DBFile(fuuid, fname, [], fid)
+                self.__add_ftags(c, f, newftags)
+                self.__add_ftags(c, f, [t for t in ftags if t not in newftags])
+            c.execute('COMMIT')
+        except:
+            c.execute('ROLLBACK')
+            raise
+
+    @TagStats.timed('db.change_files_tags')
+    @tagfsutils.writer
+    def change_files_tags(self, changes):
+        """
+        change_file_tags for every (fuuid, rmtags, addtags) of changes, all
+        or none
+        """
+        c = self.__begin()
+        try:
+            for fuuid, rmtags, addtags in changes:
+                f = self.__file_or_raise(c, fuuid)
+                # only what changes, as TagDB.change_files_tags takes it
+                root = self.__in_root(c, f)
+                rmtags = [t for t in rmtags if t in f.tags
+                          or (t == '/' and root)]
+                self.__rm_ftags(c, f, rmtags)
+                root = root and '/' not in rmtags
+                addtags = [t for t in addtags if (t != '/' and t not in f.tags)
+                           or (t == '/' and not root)]
+                existed = False
+                if len(addtags) == 0:
+                    existed = True
+                if not self.check_unique_file(addtags+list(f.tags), f.fname,
+                                              existed):
+                    raise TagDB.NoUniqueTagException('File '+fuuid+' can '
+                                                     + 'not have tags: '
+                                                     + str(addtags)
+                                                     + ', not unique.',
+                                                     addtags)
+                self.__add_ftags(c, f, addtags)
+            c.execute('COMMIT')
+        except:
+            c.execute('ROLLBACK')
+            raise
+
+    @TagStats.timed('db.rename_tag')
+    @tagfsutils.writer
+    def rename_tag(self, tag, tag1):
+        """
+        Rename tag into tag1, or merge it into tag1, see TagDB.rename_tag.
+        A rename only changes the tag row, a merge moves the file_tag rows
+        of tag over in place.
+        """
+        c = self.__begin()
+        try:
+            tid = self.__tag_id(c, tag)
+            if tag == '/' or tid == None:
+                raise TagDB.NoTagException('Can not find tags ' + tag, tag)
+            if tag1 == '/' or TagQuery.is_query([tag1]):
+                raise TagDB.NameConflictionException('Can not rename ' + tag
+                                                     + ' into ' + tag1)
+            tid1 = self.__tag_id(c, tag1)
+            if tid1 == None:
+                if c.execute('SELECT 1 FROM file WHERE fname = ?',
+                             (tag1,)).fetchone() != None:
+                    raise TagDB.NameConflictionException(
+                            'Can not rename ' + tag + ' into ' + tag1
+                            + ', a file has that name')
+                c.execute('UPDATE tag SET name = ? WHERE tid = ?',
+                          (tag1, tid))
+            elif tid1 != tid:
+                self.__check_clashes(c, tid, tag, tag1)
+                c.execute('UPDATE file_tag SET tid = ? WHERE tid = ? AND '
+                          + 'fid NOT IN (SELECT fid FROM file_tag '
+                          + 'WHERE tid = ?)', (tid1, tid, tid1))
+                c.execute('DELETE FROM file_tag WHERE tid = ?', (tid,))
+                c.execute('DELETE FROM tag WHERE tid = ?', (tid,))
+            c.execute('COMMIT')
+        except:
+            c.execute('ROLLBACK')
+            raise
+
+    def __check_clashes(self, c, tid, tag, tag1, gone = ()):
+        """
+        Raise NoUniqueTagException if merging tag into tag1, or taking it
+        off if tag1 is None, leaves files of the same name as a file of
+        tag impossible to tell apart. The files of gone are removed.
+        """
+        for (fname,) in c.execute(
+                'SELECT DISTINCT fname FROM file JOIN file_tag USING (fid) '
+                + 'WHERE tid = ?', (tid,)).fetchall():
+            fids = [r[0] for r in c.execute(
+                    'SELECT fid FROM file WHERE fname = ?', (fname,))]
+            if len(fids) == 1:
+                continue
+            group = dict([(fid, self.__file_tags(c, fid)) for fid in fids])
+            clashes = TagDB.merge_clashes(group, tag, tag1, gone)
+            if len(clashes) != 0:
+                fuuids = [r[0] for r in c.execute(
+                        'SELECT fuuid FROM file WHERE fid IN ('
+                        + ','.join(['?'] * len(clashes)) + ') ORDER BY fid',
+                        clashes)]
+                if tag1 == None:
+                    what = 'remove ' + tag
+                else:
+                    what = 'merge ' + tag + ' into ' + tag1
+                raise TagDB.NoUniqueTagException('Can not ' + what
+                                                 + ', can not distinguish '
+                                                 + 'files: ' + str(fuuids),
+                                                 fuuids)
+
+    @TagStats.timed('db.rm_tag')
+    @tagfsutils.writer
+    def rm_tag(self, tag):
+        """
+        Take tag off all its files and remove it, the files left without
+        tags are removed too, see TagDB.rm_tag. One transaction.
+        @return: the DBFiles removed
+        """
+        # fids of the files which have no other tag and are not in '/'
+        lonely = ('SELECT fid FROM file_tag ft WHERE tid = ? AND NOT EXISTS '
+                  + '(SELECT 1 FROM file_tag o WHERE o.fid = ft.fid '
+                  + 'AND o.tid != ft.tid)')
+        c = self.__begin()
+        try:
+            tid = self.__tag_id(c, tag)
+            if tag == '/' or tid == None:
+                raise TagDB.NoTagException('Can not find tags ' + tag, tag)
+            removed = [TagDB.DBFile(fuuid, fname, [tag], fid)
+                       for fid, fuuid, fname in c.execute(
+                            'SELECT fid, fuuid, fname FROM file WHERE fid IN ('
+                            + lonely + ') ORDER BY fid', (tid,))]
+            self.__check_clashes(c, tid, tag, None,
+                                 set([f.fid for f in removed]))
+            c.execute('DELETE FROM file WHERE fid IN (' + lonely + ')',
+                      (tid,))
+            c.execute('DELETE FROM file_tag WHERE tid = ?', (tid,))
+            c.execute('DELETE FROM tag WHERE tid = ?', (tid,))
+            c.execute('COMMIT')
+            return removed
+        except:
+            c.execute('ROLLBACK')
+            raise
+
+    @TagStats.timed('db.add_tags_by_path')
+    @tagfsutils.writer
+    def add_tags_by_path(self, path):
+        tset = tagfsutils.path2tags(path, 'dir')[1]
+        self.logger.debug('add tags by path: %s', tset)
+        c = self.__begin()
+        try:
+            for t in tset:
+                self.__tag_id(c, t, True)
+            c.execute('COMMIT')
+        except:
+            c.execute('ROLLBACK')
+            raise
+
+    @tagfsutils.writer
+    def import_db(self, tdb):
+        """Copy all files and tags of a TagDB in, in one transaction."""
+        c = self.__begin()
+        try:
+            for t in tdb.tags:
+                self.__tag_id(c, t, True)
+            root = tdb.postings[tdb.tags['/']]
+            for f in tdb.flist:
+                if f == None:
+                    continue
+                fid = c.execute('INSERT INTO file (fuuid, fname) '
+                                + 'VALUES (?, ?)', (f.fuuid, f.fname)).lastrowid
+                new = TagDB.DBFile(f.fuuid, f.fname, [], fid)
+                self.__add_ftags(c, new, f.tags)
+                if tagfsutils.in_postings([root], f.fid):
+                    self.__add_ftags(c, new, ['/'])
+            c.execute('COMMIT')
+        except:
+            c.execute('ROLLBACK')
+            raise
+        self.logger.info('imported %s files', self.count('file'))
+
+    @tagfsutils.writer
+    def load_db(self, dbfile, jfile = None):
+        """
+        Open the database in dbfile, creating it if needed. jfile is not
+        used, SQLite keeps its own journal.
+        """
+        self.__close_conns()
+        self.dbfile = dbfile
+        c = self.__conn()
+        c.execute('PRAGMA journal_mode = WAL')
+        if c.execute('PRAGMA user_version').fetchone()[0] == 0:
+            c.executescript(_schema % {'db': ''})
+            c.execute('PRAGMA user_version = ' + str(SchemaVersion))
+        self.__tag_id(c, '/', True)
+        self.logger.info('DB opened: %s files, %s tags', self.count('file'),
+                         self.count('tag'))
+
+    @tagfsutils.writer
+    def store_db(self, dbfile):
+        """Copy the database into dbfile, or checkpoint it if it is ours."""
+        if dbfile == self.dbfile:
+            self.checkpoint()
+            return
+        c = self.__conn()
+        c.execute('ATTACH DATABASE ? AS dst', (dbfile,))
+        try:
+            c.executescript(_schema % {'db': 'dst.'})
+            c.execute('BEGIN IMMEDIATE')
+            try:
+                for table in ('file', 'tag', 'file_tag'):
+                    c.execute('DELETE FROM dst.' + table)
+                    c.execute('INSERT INTO dst.' + table
+                              + ' SELECT * FROM main.' + table)
+                c.execute('COMMIT')
+            except:
+                c.execute('ROLLBACK')
+                raise
+            c.execute('PRAGMA dst.user_version = ' + str(SchemaVersion))
+        finally:
+            c.execute('DETACH DATABASE dst')
+
+    @tagfsutils.reader
+    def check_index(self):
+        """
+        Integrity check of the database plus file_tag rows pointing to no
+        file or tag and files in no tag at all, not even '/'.
+        @return: list of problem descriptions, empty if all is well
+        """
+        c = self.__conn()
+        problems = [r[0] for r in c.execute('PRAGMA integrity_check')
+                    if r[0] != 'ok']
+        n = c.execute('SELECT COUNT(*) FROM file_tag WHERE fid NOT IN '
+                      + '(SELECT fid FROM file)').fetchone()[0]
+        if n != 0:
+            problems.append(str(n)+' tag rows of removed files')
+        n = c.execute('SELECT COUNT(*) FROM file_tag WHERE tid NOT IN '
+                      + '(SELECT tid FROM tag)').fetchone()[0]
+        if n != 0:
+            problems.append(str(n)+' tag rows of removed tags')
+        n = c.execute('SELECT COUNT(*) FROM file WHERE fid NOT IN '
+                      + '(SELECT fid FROM file_tag)').fetchone()[0]
+        if n != 0:
+            problems.append(str(n)+' files without tags outside /')
+        return problems
+
+    @tagfsutils.writer
+    def rebuild_index(self):
+        """
+        Drop the rows check_index complains about, put files without tags
+        in '/' and rebuild the indexes.
+        """
+        c = self.__begin()
+        try:
+            c.execute('DELETE FROM file_tag WHERE fid NOT IN '
+                      + '(SELECT fid FROM file) OR tid NOT IN '
+                      + '(SELECT tid FROM tag)')
+            root = self.__tag_id(c, '/', True)
+            c.execute('INSERT INTO file_tag SELECT ?, fid, NULL FROM file '
+                      + 'WHERE fid NOT IN (SELECT fid FROM file_tag)',
+                      (root,))
+            c.execute('COMMIT')
+        except:
+            c.execute('ROLLBACK')
+            raise
+        c.execute('REINDEX')
+
+    def set_durability(self, mode, window = None, records = None):
+        """See TagDB.set_durability"""
+        if mode not in TagDB.DurabilityModes:
+            raise ValueError('durability must be one of '
+                             + ', '.join(TagDB.DurabilityModes))
+        self.durability = mode
+        if window != None:
+            self.commitwindow = window
+        if records != None:
+            self.commitrecords = records
+        # connections are made again with the synchronous of the mode
+        self.__close_conns()
+
+    @TagStats.timed('db.commit')
+    def commit(self):
+        """
+        In op durability mutations are durable when they return, nothing
+        to do. In group the WAL is synced by a background checkpoint.
+        """
+        if self.durability != 'group' or self.dbfile == None:
+            return
+        self.commitlock.acquire()
+        try:
+            self.unsynced += 1
+            unsynced = self.unsynced
+        finally:
+            self.commitlock.release()
+        if self.committer == None or not self.committer.isAlive():
+            # started lazily so that it is not lost when fuse forks
+            self.committer = threading.Thread(target=self.__commit_loop)
+            self.committer.setDaemon(True)
+            self.committer.start()
+        if unsynced >= self.commitrecords:
+            self.commit_wakeup.set()
+
+    def __commit_loop(self):
+        while not self.commit_stop:
+            self.commit_wakeup.wait(self.commitwindow)
+            self.commit_wakeup.clear()
+            self.commitlock.acquire()
+            try:
+                unsynced = self.unsynced
+                self.unsynced = 0
+            finally:
+                self.commitlock.release()
+            if unsynced == 0 or self.commit_stop:
+                continue
+            try:
+                self.checkpoint()
+            except Exception as e:
+                self.logger.error('group commit failed: %s', e)
+
+    @TagStats.timed('db.checkpoint')
+    def checkpoint(self):
+        """Move what the WAL has into the database file."""
+        if self.dbfile != None:
+            self.__conn().execute('PRAGMA wal_checkpoint')
+
+    def close(self):
+        if self.committer != None:
+            self.commit_stop = True
+            self.commit_wakeup.set()
+            self.committer.join()
+            self.committer = None
+            self.commit_stop = False
+        if self.dbfile != None:
+            self.checkpoint()
+        self.__close_conns()
+
+def import_tagdb(tdb, dbfile):
+    """
+    Create the SQLite db dbfile holding what TagDB tdb has. It is built
+    aside and renamed in place, a crash leaves no half imported db.
+    """
+    tmpfile = dbfile + '.tmp'
+    for f in (tmpfile, tmpfile + '-wal', tmpfile + '-shm'):
+        if os.path.exists(f):
+            os.remove(f)
+    sdb = SQLiteTagDB(tdb.logger, tmpfile)
+    sdb.import_db(tdb)
+    sdb.close()
+    os.rename(tmpfile, dbfile)
@@ -0,0 +1,289 @@
+# Back-store layout
+
+import os
+import re
+import threading
+
+# for default layout file, there is none in flat back-stores
+DefaultLayoutFile = '.tagfs_layout'
+
+# hex chars of the fuuid naming the dir of each fan-out level
+LevelChars = 2
+
+# most fan-out levels, 3 makes 16M dirs
+MaxFanout = 3
+
+_storename = re.compile('^([0-9a-f]{32})_(.+)$')
+_levelname = re.compile('^[0-9a-f]{%d}$' % LevelChars)
+
+def split_store_name(name):
+    """
+    (fuuid, fname) of a data file name as DBFile.getfullname gives, None
+    if name is not one.
+    """
+    m = _storename.match(name)
+    if m == None:
+        return None
+    return m.groups()
+
+class StoreLayout:
+    """
+    Where the data file of each tagfs file, named <fuuid>_<fname>, is in
+    the back-store. Flat back-stores keep them all in the root. With
+    fanout levels they are spread over nested dirs named after the first
+    chars of the fuuid, 2 per level: with fanout 2 abcd..._name is in
+    ab/cd/. fuuids are random so every dir gets its share, with 256 sub
+    dirs per level.
+
+    The layout is kept in the layout file of the back-store. A store
+    being moved to another fanout (see begin and migrate) has its old
+    fanout there as well. Until every file has been moved a file is
+    looked for at its new place, then at its old one, and the file
+    operations of call and rename serialize on lock with the moves.
+    """
+
+    def __init__(self, root, fanout = 0, oldfanout = None):
+        self.root = root
+        if self.root[-1] != '/':
+            self.root += '/'
+        self.fanout = fanout
+        self.oldfanout = oldfanout
+        self.lock = threading.Lock()
+        self.dirs = set() # dirs known to exist in the current layout
+        self.moved = 0
+        # moves files while the store is mounted, started by the first
+        # file operation so that it is not lost when fuse forks
+        self.mover = None
+        self.movelog = None
+
+    def relpath(self, name, fanout = None):
+        if fanout == None:
+            fanout = self.fanout
+        if fanout == 0:
+            return name
+        return ''.join([name[i:i+LevelChars] + '/'
+                        for i in range(0, fanout * LevelChars,
+                                       LevelChars)]) + name
+
+    def path(self, name):
+        """Path of the data file name. See call for the file operations"""
+        p = self.root + self.relpath(name)
+        if self.oldfanout == None or os.path.lexists(p):
+            return p
+        old = self.root + self.relpath(name, self.oldfanout)
+        if os.path.lexists(old):
+            return old
+        return p
+
+    def new_path(self, name):
+        """Path name is created at, its dir is made if needed"""
+        p = self.root + self.relpath(name)
+        d = os.path.dirname(p)
+        if self.fanout != 0 and d not in self.dirs:
+            try:
+                os.makedirs(d)
+            except OSError:
+                if not os.path.isdir(d):
+                    raise
+            self.dirs.add(d)
+        return p
+
+    def call(self, func, name, *args):
+        """
+        func(path of the data file name, *args). While files are moved
+        the path can not change before func is done.
+        """
+        if self.oldfanout == None:
+            return func(self.path(name), *args)
+        if self.movelog != None and \
+               (self.mover == None or not self.mover.isAlive()):
+            self.__start_mover()
+        self.lock.acquire()
+        try:
+            return func(self.path(name), *args)
+        finally:
+            self.lock.release()
+
+    def create(self, name, flags, *mode):
+        """os.open with O_CREAT of the data file name, in its dir"""
+        if self.oldfanout == None:
+            return os.open(self.new_path(name), flags, *mode)
+        self.lock.acquire()
+        try:
+            p = self.path(name)
+            if not os.path.lexists(p):
+                p = self.new_path(name)
+            return os.open(p, flags, *mode)
+        finally:
+            self.lock.release()
+
+    def rename(self, name, name1):
+        """Rename data file name into name1, at its place in the layout"""
+        self.lock.acquire()
+        try:
+            os.rename(self.path(name), self.new_path(name1))
+        finally:
+            self.lock.release()
+
+    def names(self, fanout = None):
+        """Yield the data file names of the store laid out with fanout"""
+        if fanout == None:
+            fanout = self.fanout
+        return self.__names(self.root, fanout)
+
+    def __names(self, d, fanout):
+        try:
+            entries = os.listdir(d)
+        except OSError:
+            return
+        for e in entries:
+            if fanout == 0:
+                if split_store_name(e) != None:
+                    yield e
+            elif _levelname.match(e) != None:
+                for name in self.__names(d + e + '/', fanout - 1):
+                    yield name
+
+    def all_names(self):
+        """Yield (name, path) of every data file, moved or not"""
+        for name in self.names():
+            yield (name, self.root + self.relpath(name))
+        if self.oldfanout != None:
+            for name in self.names(self.oldfanout):
+                yield (name, self.root + self.relpath(name, self.oldfanout))
+
+    def begin(self, fanout):
+        """
+        Start moving the store to fanout: new files go there, the others
+        are found at their old place until migrate has moved them.
+        """
+        if fanout < 0 or fanout > MaxFanout:
+            raise ValueError('fanout must be 0 to ' + str(MaxFanout))
+        if self.oldfanout != None:
+            if fanout == self.fanout:
+                return
+            raise Exception('still moving from fanout '
+                            + str(self.oldfanout) + ' to '
+                            + str(self.fanout))
+        if fanout == self.fanout:
+            return
+        self.lock.acquire()
+        try:
+            self.oldfanout = self.fanout
+            self.fanout = fanout
+            self.dirs = set()
+            self.store()
+        finally:
+            self.lock.release()
+
+    def migrate(self):
+        """
+        Move every file of the old fanout to its place in the new one, a
+        file at a time under lock, then drop the old fanout and its dirs.
+        @return: the number of files moved
+        """
+        if self.oldfanout == None:
+            return 0
+        n = 0
+        for name in list(self.names(self.oldfanout)):
+            self.lock.acquire()
+            try:
+                old = self.root + self.relpath(name, self.oldfanout)
+                if os.path.lexists(old):
+                    os.rename(old, self.new_path(name))
+                    n += 1
+                    self.moved += 1
+            finally:
+                self.lock.release()
+        self.lock.acquire()
+        try:
+            oldfanout = self.oldfanout
+            self.oldfanout = None
+            self.store()
+        finally:
+            self.lock.release()
+        if oldfanout != 0:
+            self.__rm_dirs(self.root, oldfanout)
+        return n
+
+    def __rm_dirs(self, d, levels, depth = 1):
+        """
+        Remove the level dirs under d deeper than the fanout, they are
+        empty once their files are moved. The others may be in use.
+        """
+        for e in os.listdir(d):
+            if _levelname.match(e) == None or not os.path.isdir(d + e):
+                continue
+            if levels > 1:
+                self.__rm_dirs(d + e + '/', levels - 1, depth + 1)
+            if depth > self.fanout:
+                try:
+                    os.rmdir(d + e)
+                except OSError:
+                    # something else was put there
+                    pass
+
+    def __start_mover(self):
+        self.lock.acquire()
+        try:
+            if self.mover != None and self.mover.isAlive():
+                return
+            self.mover = threading.Thread(target=self.__move_loop)
+            self.mover.setDaemon(True)
+            self.mover.start()
+        finally:
+            self.lock.release()
+
+    def __move_loop(self):
+        try:
+            self.movelog.info('moving back-store to fanout %s', self.fanout)
+            n = self.migrate()
+            self.movelog.info('back-store at fanout %s, %s files moved',
+                              self.fanout, n)
+        except Exception as e:
+            self.movelog.error('moving back-store failed: %s', e)
+        self.movelog = None
+
+    def start_moving(self, logger):
+        """Let the first file operation start migrate in a thread"""
+        if self.oldfanout != None:
+            self.movelog = logger
+
+    def store(self):
+        lfile = self.root + DefaultLayoutFile
+        if self.fanout == 0 and self.oldfanout == None:
+            if os.path.exists(lfile):
+                os.remove(lfile)
+            return
+        data = 'fanout ' + str(self.fanout) + '\n'
+        if self.oldfanout != None:
+            data += 'from ' + str(self.oldfanout) + '\n'
+        tmpfile = lfile + '.tmp'
+        lf = open(tmpfile, 'w')
+        try:
+            lf.write(data)
+            lf.flush()
+            os.fsync(lf.fileno())
+        finally:
+            lf.close()
+        os.rename(tmpfile, lfile)
+
+def load_layout(root):
+    """The layout of the back-store in root, flat without a layout file"""
+    layout = StoreLayout(root)
+    lfile = layout.root + DefaultLayoutFile
+    if not os.path.exists(lfile):
+        return layout
+    lf = open(lfile)
+    try:
+        for line in lf:
+            words = line.split()
+            if len(words) != 2:
+                continue
+            if words[0] == 'fanout':
+                layout.fanout = int(words[1])
+            elif words[0] == 'from':
+                layout.oldfanout = int(words[1])
+    finally:
+        lf.close()
+    return layout
@@ -1,14 +1,41 @@
 # Tag db
 
+import os
 import stat
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+import threading
+from bisect import bisect_left
 import tagfsutils
+import TagJournal
+import TagDBImage
+import LRUCache
+import RWLock
+import TagQuery
+import TagStats
 
-class DBFile:
-    def __init__(self, fuuid, fname, ftags):
+class DBFile(object):
+    """
+    A file of the tag db, there is one per file so they are kept small:
+    no __dict__, tags is a tuple of tag names, the very strings of the
+    tag table in a TagDB, and mode is the same for every file.
+    """
+    __slots__ = ('fuuid', 'fname', 'tags', 'fid')
+    mode = stat.S_IFREG|0777
+
+    def __init__(self, fuuid = None, fname = None, ftags = (), fid = None):
         self.fuuid = fuuid
         self.fname = fname
-        self.tags = ftags
-        self.mode = stat.S_IFREG|0777
+        self.tags = tuple(ftags)
+        self.fid = fid # dense integer id of the file within its TagDB
+
+    def __setstate__(self, state):
+        # db files pickled by older versions have the __dict__ of the
+        # DBFiles of that time
+        self.__init__(state['fuuid'], state['fname'], state['tags'],
+                      state.get('fid'))
 
     def getfullname(self):
         return self.fuuid + '_' + self.fname
@@ -20,6 +47,19 @@ class DBFile:
     def __repr__(self):
         return self.__str__()
 
+class DirListing:
+    """
+    A tag dir as it was when opened: the ids of its files in listing order
+    and its sub-tags. Names are resolved batch by batch by
+    TagDB.dir_entries, so entries keep their index however long the
+    listing takes.
+    """
+    def __init__(self, qtags, fids, subtags):
+        self.qtags = qtags
+        self.fids = fids
+        self.subtags = subtags
+        self.unique = {} # unique is {fname=>{fid=>tag}} for shared names
+
 class NoTagException(Exception):
     def __init__(self, msg, tags):
         self.msg = msg
@@ -42,107 +82,245 @@ class NoFileException(Exception):
 # for default tags db file
 DefaultMetaDBFile = '.tagfs_db.meta'
 
+# checkpoint the journal into the db file once it has this many records,
+CheckpointRecords = 10000
+# or every this many seconds if it has any.
+CheckpointInterval = 60
+
+# When commit makes mutations durable:
+#   op          before it returns, one fsync per call
+#   group       within CommitWindow seconds, or as soon as CommitRecords
+#               of them are waiting, synced by a background thread
+#   unmount     on close only, a crash of tagfs itself loses nothing but
+#               one of the system may lose what was not checkpointed
+DurabilityModes = ('op', 'group', 'unmount')
+CommitWindow = 0.05
+CommitRecords = 256
+
+# entries of the find_by_path cache
+PathCacheSize = 4096
+
+def _told_apart(group, fid):
+    """
+    If file fid of group {fid=>tags}, files of the same name, can be told
+    from the others as check_unique_file tells it for a new file.
+    """
+    tset = set(group[fid])
+    others = [g for g in sorted(group)
+              if g != fid and tset.issubset(group[g])]
+    if len(others) == 0:
+        return True
+    if len(others) == 1:
+        return len(group[others[0]]) > len(tset)
+    counts = {}
+    for g in others:
+        for t in group[g]:
+            counts[t] = counts.get(t, 0) + 1
+    for g in others:
+        for t in group[g]:
+            if counts[t] == 1:
+                break
+        else:
+            return False
+    return True
+
+def merge_clashes(group, tag, tag1, gone = ()):
+    """
+    fids of group {fid=>tags}, files of the same name, which can be told
+    apart before tag is merged into tag1, or taken off if tag1 is None,
+    but not after. The files of gone are removed as well.
+    """
+    merged = {}
+    for fid, tags in group.iteritems():
+        if fid in gone:
+            continue
+        if tag not in tags:
+            merged[fid] = tags
+        elif tag1 == None or tag1 in tags:
+            merged[fid] = [t for t in tags if t != tag]
+        else:
+            merged[fid] = [t == tag and tag1 or t for t in tags]
+    return [fid for fid in sorted(merged)
+            if not _told_apart(merged, fid) and _told_apart(group, fid)]
+
 class TagDB:
     
     def __init__(self, logger, dbfile = None):
         """Load tag db from a file"""
-        self.tags = {'/':{}} # tags is {tag=>{fuuid=>DBFile}}
-        self.files = {} # files is {fuuid=>DBFile}
+        self.logger = logger
+        
+        # find_by_path results, see __cache_path. Readers share the cache,
+        # cachelock serializes their updates to it.
+        self.cachelock = threading.Lock()
+        self.pathcache = LRUCache.LRUCache(PathCacheSize, self.__forget_path)
+        self.pathdeps = {} # pathdeps is {tag=>set of pathcache keys}
+        self.__reset()
+        
+        # Every mutation is journaled as (seq, op, args) and replayed
+        # through the op table on load. seq of the last applied mutation
+        # is saved within snapshots so replay can skip what they cover.
+        self.seq = 0
+        self.journal = None
+        self.dbfile = None
+        self.rwlock = RWLock.RWLock()
+        self.checkpointer = None
+        self.ckpt_wakeup = threading.Event()
+        self.ckpt_stop = False
+        self.durability = 'op'
+        self.commitwindow = CommitWindow
+        self.commitrecords = CommitRecords
+        self.committer = None
+        self.commit_wakeup = threading.Event()
+        self.__ops = {'add_file': self.__do_add_file,
+                      'add_file_tags': self.__do_add_ftags,
+                      'rm_file': self.__do_rm_file,
+                      'rm_file_tags': self.__do_rm_file_tags,
+                      'change_file_tags': self.__do_change_ftags,
+                      'rename_file': self.__do_rename_file,
+                      'add_tags': self.__do_add_tags,
+                      'rm_tags': self.__do_rm_tags,
+                      'rename_tag': self.__do_rename_tag,
+                      'rm_tag': self.__do_rm_tag,
+                      'add_files': self.__do_add_files,
+                      'change_files_tags': self.__do_change_files_tags}
         if dbfile != None:
             self.load_db(dbfile)
-        self.logger = logger
+
+    def __reset(self):
+        self.files = {} # files is {fuuid=>DBFile}
+        
+        # Files and tags are interned to dense integer ids, ids of removed
+        # ones are reused. Each tag has a posting: the sorted array of the
+        # ids of its files.
+        self.flist = [] # flist is [fid=>DBFile or None]
+        self.freefids = []
+        self.tags = {} # tags is {tag=>tid}
+        self.tagnames = [] # tagnames is [tid=>tag or None]
+        self.postings = [] # postings is [tid=>posting or None]
+        self.freetids = []
+        self.newtags = None # tags __new_tag makes are listed here if set
+        self.__new_tag('/')
+        # names is {fname=>set of fids}, nametags is {fname=>{tag=>count}}
+        # counting the tags of the files having that name
+        self.names = {}
+        self.nametags = {}
+        # cotags is {tag=>{co-tag=>count}}, counting the files having both
+        self.cotags = {}
+        self.pathcache.clear()
+        self.pathdeps = {}
 
     def __make_unique(self, flist):
         """
         make a file list unique in names
         """
-        rs = []
         fnames = {}
-        dupnames = []
         for fid in flist:
-            f = self.files[fid]
-            if f.fname in fnames:
-                fnames[f.fname].append(fid)
-                if len(fnames[f.fname]) == 2:
-                    dupnames.append(f.fname)
-                    rs.remove((fnames[f.fname][0],))
+            fname = self.flist[fid].fname
+            if fname in fnames:
+                fnames[fname].append(fid)
             else:
-                fnames[f.fname] = [fid]
-                rs.append((fid,))
+                fnames[fname] = [fid]
 
-        for fn in dupnames:
-            fids = fnames[fn]
-            
-            # About notagused:
-            #
-            # If there are multiple files, say n, with the same name in the 
-            # current query, ideally we need n different tags to distinguish 
-            # them, in a way that each file has its unique tag attached in its
-            # file name. However, to distinguish them, only n-1 different tags
-            # are enough because one of those files can use its original name
-            # without any unique tag.
-            # This is cool when ls, but not that good when a user wants to open
-            # that file without unique tag because the query will result in
-            # a 'files' result. 
-            # So the file query must be aware of this.
-            # 
-            #                                                  -by Weibin Sun
-            
-            # enable notagused feature:
-            notagused = False
+        unqtags = {}
+        for fname, fids in fnames.iteritems():
+            if len(fids) > 1:
+                self.__unique_tags(fname, fids, unqtags)
+
+        rs = []
+        for fid in flist:
+            f = self.flist[fid]
+            t = unqtags.get(fid)
+            if t == None:
+                rs.append((f.fuuid,))
+            else:
+                rs.append((f.fuuid, t))
+        return rs
+
+    def __unique_tags(self, fname, fids, unqtags):
+        """
+        Pick for each of the same named files fids a tag none of the
+        others has, into unqtags {fid=>tag}. A tag is unique when it is
+        counted once over the group, which makes this linear in the tags
+        of the group. The counts over all files named fname are kept by
+        the name index, so they only have to be redone for a part of them.
+        """
+        if len(fids) == len(self.names[fname]):
+            counts = self.nametags[fname]
+        else:
+            counts = {}
             for fid in fids:
-                unqtags = set(self.files[fid].tags[:])
-                for other_fid in fids:
-                    if fid != other_fid:
-                        unqtags -= set(self.files[other_fid].tags)
-                if len(unqtags) == 0:
-                    
-                    # enable notagused feature:
-                    #
-                    if notagused:
-                        raise NoUniqueTagException('Can not distinguish files: ' \
-                                               + str(fids), fids)
-                    else:
-                        rs.append((fid, ))
-                        notagused = True
-                    
-                    # raise NoUniqueTagException('Can not distinguish files: ' \
-                    #                           + str(fids), fids)
-                else:
-                    rs.append((fid, unqtags.pop()))  
+                for t in self.flist[fid].tags:
+                    counts[t] = counts.get(t, 0) + 1
 
-        return rs        
+        # About notagused:
+        #
+        # If there are multiple files, say n, with the same name in the 
+        # current query, ideally we need n different tags to distinguish 
+        # them, in a way that each file has its unique tag attached in its
+        # file name. However, to distinguish them, only n-1 different tags
+        # are enough because one of those files can use its original name
+        # without any unique tag.
+        # This is cool when ls, but not that good when a user wants to open
+        # that file without unique tag because the query will result in
+        # a 'files' result. 
+        # So the file query must be aware of this.
+        # 
+        #                                                  -by Weibin Sun
         
-    def __query_by_tags(self, qtags):
-        fset = None
+        # enable notagused feature:
+        notagused = False
+        for fid in fids:
+            for t in self.flist[fid].tags:
+                if counts[t] == 1:
+                    unqtags[fid] = t
+                    break
+            else:
+                # enable notagused feature:
+                #
+                if notagused:
+                    fuuids = [self.flist[i].fuuid for i in fids]
+                    raise NoUniqueTagException('Can not distinguish files: ' \
+                                           + str(fuuids), fuuids)
+                notagused = True
+        
+    def __tag_postings(self, qtags):
+        postings = []
         for tag in qtags:
             if tag not in self.tags:
-                self.logger.error('query by tags no tag: '+tag)
+                self.logger.debug('query by tags no tag: %s', tag)
                 raise NoTagException('Can not find tags ' + tag, tag)
-            if fset == None:
-                fset = set(self.tags[tag].keys())
-            else:
-                fset &= set(self.tags[tag].keys())
-        if fset == None:
-            self.logger.error('query by tags no tag: '+tag)
-            raise NoTagException('Can not find tags ' + tag, tag)
-        return list(fset)
+            postings.append(self.postings[self.tags[tag]])
+        if len(postings) == 0:
+            self.logger.debug('query by tags no tag')
+            raise NoTagException('Can not find tags', qtags)
+        return postings
+
+    def __query_by_tags(self, qtags):
+        """
+        Ids of the files having all qtags, as a sorted posting.
+        """
+        return tagfsutils.intersect_postings(self.__tag_postings(qtags))
 
     def __query_file(self, qtags):
         """
         qtags: tags splited from path, the last one is filename
+        Only the files with that name are made unique. They are taken from
+        the name index, or from the query if it is the smaller one.
         """        
-        flist = self.__query_by_tags(qtags[0:-1])
-        flist = self.__make_unique(flist)
-        rs = []
-        for f in flist:
-            if self.files[f[0]].fname == qtags[-1]:
-                rs.append(f)
-        return rs
+        fname = qtags[-1]
+        postings = self.__tag_postings(qtags[0:-1])
+        named = self.names.get(fname, ())
+        if len(named) < min([len(p) for p in postings]):
+            fids = [fid for fid in sorted(named)
+                    if tagfsutils.in_postings(postings, fid)]
+        else:
+            fids = [fid for fid in tagfsutils.intersect_postings(postings)
+                    if self.flist[fid].fname == fname]
+        return self.__make_unique(fids)
 
     def __query_dir(self, qtags):
         flist = self.__query_by_tags(qtags)
-        self.logger.info('query dir: '+str(qtags)+str(flist))
+        self.logger.debug('query dir: %s %s', qtags, flist)
         flist = self.__make_unique(flist)
         return flist
 
@@ -157,11 +335,11 @@ class TagDB:
             if len(frs) == 0:
                 frs = [] 
         except NoTagException:
-            self.logger.info('query both file part no tag: '+str(ftags))
+            self.logger.debug('query both file part no tag: %s', ftags)
         except NoUniqueTagException:
-            self.logger.info('query both file part no unique tag: '+str(ftags))
+            self.logger.debug('query both file part no unique tag: %s', ftags)
         
-        self.logger.info('query both file part: '+str(frs)+' for '+str(ftags))
+        self.logger.debug('query both file part: %s for %s', frs, ftags)
               
         # query as a directory:
         drs = None
@@ -170,15 +348,21 @@ class TagDB:
             drs = self.__query_dir(qtags)
         except NoTagException as e:
             # this must be re-raised!
-            self.logger.info('query both dir part no tag: '+str(qtags))
+            self.logger.debug('query both dir part no tag: %s', qtags)
             notagex = e
         except NoUniqueTagException as e:
-            self.logger.info('query both dir part no unique tag: '+str(qtags) + ' '+e.msg)
+            self.logger.debug('query both dir part no unique tag: %s %s', qtags,
+                             e.msg)
             
 
-        self.logger.info('query both dir part: '+str(drs)+' for '+str(qtags))
+        self.logger.debug('query both dir part: %s for %s', drs, qtags)
         
         if frs == None and drs == None:            
+            if notagex == None:
+                # both parts have same named files which can not be told
+                # apart
+                raise NoUniqueTagException('Can not distinguish files: '
+                                           + str(qtags), qtags)
             raise notagex
         elif drs == None:
             if len(frs) > 1:
@@ -196,6 +380,8 @@ class TagDB:
             raise NameConflictionException('Can\'t distinguish file and dir '\
                                            + 'with tags: ' + str(qtags))
 
+    @TagStats.timed('db.find_by_path')
+    @tagfsutils.reader
     def find_by_path(self, path, target):
         """
         @description:
@@ -209,7 +395,7 @@ class TagDB:
           ... (TODO: add descriptions of cases)
         """
         if len(path) == 0:
-            raise NoTagException('No such file.')
+            raise NoTagException('No such file.', path)
 
         tset = path.split('/')
         if tset[0] == '':
@@ -219,34 +405,276 @@ class TagDB:
         if len(tset) == 0:
             tset = ['/']
         
+        # Results, failures included, are cached by the set of tags in the
+        # path and the file name. An entry depends on all those tags and
+        # is dropped when a mutation touches any of them. Paths of the
+        # root also look in '/', every file mutation touches it.
+        deps = tset
+        if len(tset) <= 1:
+            deps = tset + ['/']
+        if TagQuery.is_query(tset):
+            # queries by their text, they depend on their tags and on all
+            # files, which every file mutation invalidates through '/'
+            key = ('query', target, path[-1] == '/', tuple(tset))
+            deps = ['/']
+            for comp in tset[1:]:
+                deps.extend(comp.lstrip('-').split('|'))
+        elif target == 'dir' or (path[-1] == '/' and target == 'unsure'):
+            key = ('dir', frozenset(tset), None)
+        elif target == 'file' or target == 'unsure':
+            if path[-1] == '/':
+                raise Exception('Sys error: query file but a dir path is '
+                                + 'given: ' + path)
+            key = (target, frozenset(tset[0:-1]), tset[-1])
+        else:
+            raise Exception('Invalid parameter: target = '+target)
+        
+        self.cachelock.acquire()
+        try:
+            cached = self.pathcache.get(key)
+        finally:
+            self.cachelock.release()
+        if cached != None:
+            if isinstance(cached[0], Exception):
+                raise cached[0]
+            return cached[0]
+        
+        try:
+            rs = self.__find_by_tags(path, target, tset)
+        except (NoTagException, NoUniqueTagException, \
+                NameConflictionException, NoFileException) as e:
+            self.__cache_path(key, e, deps)
+            raise
+        self.__cache_path(key, rs, deps)
+        return rs
+
+    def __cache_path(self, key, rs, deps):
+        self.cachelock.acquire()
+        try:
+            self.pathcache.put(key, (rs, deps))
+            for t in deps:
+                if t in self.pathdeps:
+                    self.pathdeps[t].add(key)
+                else:
+                    self.pathdeps[t] = set([key])
+        finally:
+            self.cachelock.release()
+
+    def __forget_path(self, key, cached):
+        for t in cached[1]:
+            keys = self.pathdeps.get(t)
+            if keys != None:
+                keys.discard(key)
+                if len(keys) == 0:
+                    del self.pathdeps[t]
+
+    def __invalidate(self, tags):
+        """Drop cached path results depending on any of tags."""
+        for t in tags:
+            keys = self.pathdeps.pop(t, None)
+            if keys == None:
+                continue
+            for key in keys:
+                cached = self.pathcache.pop(key)
+                if cached != None:
+                    self.__forget_path(key, cached)
+
+    def __tag_size(self, t):
+        tid = self.tags.get(t)
+        if tid == None:
+            return 0
+        return len(self.postings[tid])
+
+    def __query_clauses(self, comps):
+        """
+        Ids of the files matching the query clauses in comps, as a sorted
+        posting, evaluated in the order TagQuery.plan gives.
+        """
+        try:
+            clauses = TagQuery.parse_query(comps)
+        except TagQuery.QueryException as e:
+            raise NoTagException(e.msg + ': ' + e.clause, e.clause)
+        positives, negatives = TagQuery.plan(clauses, self.__tag_size)
+
+        rs = None
+        for c in positives:
+            postings = [self.postings[self.tags[t]] for t in c.tags
+                        if t in self.tags]
+            if len(postings) == 0:
+                self.logger.debug('query no tag: %s', c)
+                raise NoTagException('Can not find tags ' + str(c), c.tags)
+            p = tagfsutils.union_postings(postings)
+            if rs == None:
+                rs = p
+            else:
+                rs = tagfsutils.intersect_postings([rs, p])
+        if rs == None:
+            rs = tagfsutils.new_posting([f.fid for f in self.flist
+                                         if f != None])
+        for c in negatives:
+            for t in c.tags:
+                if t in self.tags and len(rs) != 0:
+                    rs = tagfsutils.subtract_postings(
+                            rs, self.postings[self.tags[t]])
+        return rs
+
+    def __find_by_query(self, path, target, comps):
+        """
+        comps: the components of a query path after the query dir. For a
+        dir they are all clauses, else the last one is tried as the name
+        of a file in the result of the others first.
+        """
+        if target == 'dir' or (path[-1] == '/' and target == 'unsure'):
+            return ('dir', self.__make_unique(self.__query_clauses(comps)))
+        if target != 'file' and target != 'unsure':
+            raise Exception('Invalid parameter: target = '+target)
+        if path[-1] == '/':
+            raise Exception('Sys error: query file but a dir path is '
+                            + 'given: ' + path)
+
+        frs = []
+        if len(comps) != 0:
+            fids = self.__query_clauses(comps[0:-1])
+            named = self.names.get(comps[-1], ())
+            frs = self.__make_unique([fid for fid in sorted(named)
+                                      if tagfsutils.in_postings([fids], fid)])
+        if len(frs) == 1:
+            return ('file', frs[0])
+        elif len(frs) > 1:
+            return ('files', frs)
+        elif target == 'file':
+            raise NoFileException('No such file', path)
+        return ('dir', self.__make_unique(self.__query_clauses(comps)))
+
+    @TagStats.timed('db.sub_tags')
+    @tagfsutils.reader
+    def sub_tags(self, qtags):
+        """
+        Tags the files having all qtags have besides qtags, from the co-tag
+        index. For one tag these are just its co-tags. For more, the co-tags
+        they share are the candidates, kept if some file of the query has
+        them, unless the query has fewer files than candidates: then the
+        tags of its files are gathered directly.
+        """
+        if TagQuery.is_query(qtags):
+            # no sub-tags for queries, any clause can be added to them
+            return []
+        postings = self.__tag_postings(qtags)
+        qset = set(qtags)
+        if '/' in qset:
+            # '/' is no tag of the files in it, it has no co-tags
+            cos = None
+        else:
+            cos = sorted([self.cotags.get(t, {}) for t in qset], key=len)
+            cands = [t for t in cos[0] if t not in qset]
+            for co in cos[1:]:
+                cands = [t for t in cands if t in co]
+            if len(cos) == 1:
+                return cands
+
+        fids = tagfsutils.intersect_postings(postings)
+        if cos != None and len(cands) < len(fids):
+            return [t for t in cands if tagfsutils.postings_meet(
+                        fids, self.postings[self.tags[t]])]
+        tags = set()
+        for fid in fids:
+            tags.update(self.flist[fid].tags)
+        return list(tags - qset)
+
+    @TagStats.timed('db.open_dir')
+    @tagfsutils.reader
+    def open_dir(self, qtags):
+        """
+        Start listing the dir of qtags, see dir_entries. Its files are
+        taken now, a copy of the query posting is all that is kept.
+        """
+        if TagQuery.is_query(qtags):
+            fids = tagfsutils.new_posting(self.__query_clauses(qtags[1:]))
+            return DirListing(qtags, fids, [])
+        fids = tagfsutils.new_posting(self.__query_by_tags(qtags))
+        if qtags == ['/']:
+            subtags = [t for t in self.tags if t != '/']
+        else:
+            subtags = self.sub_tags(qtags)
+        return DirListing(qtags, fids, subtags)
+
+    @TagStats.timed('db.dir_entries')
+    @tagfsutils.reader
+    def dir_entries(self, listing, start, count):
+        """
+        [(index, name), ...] of the files at listing.fids[start:start+count]
+        which still have the tags of the listing. Files sharing a name are
+        made unique against the other files of that name in the listing,
+        the first time one of them is met.
+        """
+        postings = []
+        if TagQuery.is_query(listing.qtags):
+            # files of a query are the ones it had when opened
+            qtags = []
+        else:
+            qtags = set(listing.qtags)
+        for t in qtags:
+            if t not in self.tags:
+                return []
+            postings.append(self.postings[self.tags[t]])
+
+        rs = []
+        for i in xrange(start, min(start + count, len(listing.fids))):
+            fid = listing.fids[i]
+            if fid >= len(self.flist) or self.flist[fid] == None \
+                    or not tagfsutils.in_postings(postings, fid):
+                continue
+            f = self.flist[fid]
+            if len(self.names[f.fname]) == 1:
+                rs.append((i, f.fname))
+                continue
+            unqtags = listing.unique.get(f.fname)
+            if unqtags == None:
+                unqtags = listing.unique[f.fname] = {}
+                same = [n for n in sorted(self.names[f.fname])
+                        if tagfsutils.in_postings([listing.fids], n)]
+                try:
+                    if len(same) > 1:
+                        self.__unique_tags(f.fname, same, unqtags)
+                except NoUniqueTagException as e:
+                    # they can not be told apart, leave them all out
+                    self.logger.error('dir entries: %s', e.msg)
+                    unqtags[None] = None
+            if None in unqtags:
+                continue
+            t = unqtags.get(fid)
+            if t == None:
+                rs.append((i, f.fname))
+            else:
+                rs.append((i, t + '/' + f.fname))
+        return rs
+
+    def __find_by_tags(self, path, target, tset):
+        if TagQuery.is_query(tset):
+            return self.__find_by_query(path, target, tset[1:])
+
         if target == 'dir' or (path[-1] == '/' and target == 'unsure'):
             return ('dir', self.__query_dir(tset))
         
         elif target == 'file':
-            if path[-1] == '/':
-                raise Exception('Sys error: query file but a dir path is '
-                                + 'given: ' + path)
+            # use / as tag for files without tag
+            if len(tset) == 1:
+                tset = ['/'] + tset
+   
+            frs = self.__query_file(tset)
+            if len(frs) == 0:
+                raise NoFileException('No such file', path)
+            elif len(frs) == 1:
+                return ('file', frs[0])
             else:
-                # use / as tag for files without tag
-                if len(tset) == 1:
-                    tset = ['/'] + tset
-       
-                frs = self.__query_file(tset)
-                if len(frs) == 0:
-                    raise NoFileException('No such file', path)
-                elif len(frs) == 1:
-                    return ('file', frs[0])
-                else:
-                    return ('files', frs)
+                return ('files', frs)
             
-        elif target == 'unsure':
+        else:
             rs = self.__query_both(tset)
-            self.logger.info('query both: '+str(rs)+'for '+path)
+            self.logger.debug('query both: %s for %s', rs, path)
             if rs[0] == 'no file':
                 raise NoFileException('No such file', path)
             return rs
-        else:
-            raise Exception('Invalid parameter: target = '+target)
 
     def check_unique_filepath(self, filepath, existed=False):
         """
@@ -255,7 +683,7 @@ class TagDB:
         """
         try:
             rs = self.find_by_path(filepath, 'unsure')
-            self.logger.info('check unique: '+str(rs)+' '+filepath)
+            self.logger.debug('check unique: %s %s', rs, filepath)
             if (rs[0] == 'files' or rs[0] == 'file') and existed:
                 return True
             
@@ -284,131 +712,943 @@ class TagDB:
 
     def check_unique_file(self, tags, fname, existed=False):
         """
-        Check if a file with fname as name and 'tags' as all its tags  """
-        fpath = '/'.join(['']+[t for t in tags if t != '/']+[fname])        
-        return self.check_unique_filepath(fpath, existed)
+        Check if a file with fname as name and 'tags' as all its tags
+        can be told from the others, as check_unique_filepath does for its
+        path. Unless fname is also a tag, only the files named fname
+        count, so they are taken from the name index and checked against
+        the postings of tags instead of looking the path up.
+        """
+        tags = [t for t in tags if t != '/']
+        if fname in self.tags or TagQuery.is_query(tags + [fname]):
+            # the path is a dir as well, the lookup decides
+            return self.check_unique_filepath('/'.join([''] + tags + [fname]),
+                                              existed)
+        if existed:
+            return True
+        qtags = tags
+        if len(qtags) == 0:
+            qtags = ['/']
+        postings = []
+        for t in qtags:
+            if t not in self.tags:
+                return True
+            postings.append(self.postings[self.tags[t]])
+        fids = [fid for fid in sorted(self.names.get(fname, ()))
+                if tagfsutils.in_postings(postings, fid)]
+        if len(fids) == 0:
+            return True
+        if len(fids) == 1:
+            # the file there keeps its plain name unless it has more tags
+            f = self.flist[fids[0]]
+            return len(''.join([t + '/' for t in f.tags])) > \
+                   len(''.join([t + '/' for t in tags]))
+        unqtags = {}
+        try:
+            self.__unique_tags(fname, fids, unqtags)
+        except NoUniqueTagException:
+            return self.check_unique_filepath('/'.join([''] + tags + [fname]))
+        # the new file would be the one without a unique tag
+        return len(unqtags) == len(fids)
     
+    def __journal(self, op, *args):
+        """Record a mutation which has just been applied."""
+        if self.journal != None:
+            self.seq = self.journal.append(op, args)
+        else:
+            self.seq += 1
+
+    def __new_tag(self, t):
+        if len(self.freetids) != 0:
+            tid = self.freetids.pop()
+            self.tagnames[tid] = t
+            self.postings[tid] = tagfsutils.new_posting()
+        else:
+            tid = len(self.tagnames)
+            self.tagnames.append(t)
+            self.postings.append(tagfsutils.new_posting())
+        self.tags[t] = tid
+        if self.newtags != None:
+            self.newtags.append(t)
+        return tid
+
+    def __tag_id(self, t):
+        """Id of tag t, the tag is created if needed."""
+        tid = self.tags.get(t)
+        if tid == None:
+            tid = self.__new_tag(t)
+        return tid
+
+    def __posting(self, t):
+        """Posting of tag t, the tag is created if needed."""
+        return self.postings[self.__tag_id(t)]
+
+    def __new_file(self, f):
+        if len(self.freefids) != 0:
+            f.fid = self.freefids.pop()
+            self.flist[f.fid] = f
+        else:
+            f.fid = len(self.flist)
+            self.flist.append(f)
+        self.files[f.fuuid] = f
+        self.__index_name(f)
+        self.__index_cotags(f)
+
+    def __free_file(self, f):
+        self.__unindex_name(f)
+        self.__unindex_cotags(f)
+        del self.files[f.fuuid]
+        self.flist[f.fid] = None
+        self.freefids.append(f.fid)
+
+    def __index_name(self, f):
+        if f.fname in self.names:
+            self.names[f.fname].add(f.fid)
+            counts = self.nametags[f.fname]
+        else:
+            self.names[f.fname] = set([f.fid])
+            counts = self.nametags[f.fname] = {}
+        for t in f.tags:
+            counts[t] = counts.get(t, 0) + 1
+
+    def __unindex_name(self, f):
+        fids = self.names[f.fname]
+        fids.discard(f.fid)
+        if len(fids) == 0:
+            del self.names[f.fname]
+            del self.nametags[f.fname]
+            return
+        counts = self.nametags[f.fname]
+        for t in f.tags:
+            if counts[t] == 1:
+                del counts[t]
+            else:
+                counts[t] -= 1
+
+    def __index_cotags(self, f):
+        for t in f.tags:
+            counts = self.cotags.get(t)
+            for u in f.tags:
+                if u != t:
+                    if counts == None:
+                        counts = self.cotags[t] = {}
+                    counts[u] = counts.get(u, 0) + 1
+
+    def __unindex_cotags(self, f):
+        for t in f.tags:
+            counts = self.cotags.get(t)
+            if counts == None:
+                # t is the only tag of f
+                continue
+            for u in f.tags:
+                if u != t:
+                    if counts[u] == 1:
+                        del counts[u]
+                    else:
+                        counts[u] -= 1
+            if len(counts) == 0:
+                del self.cotags[t]
+
+    def __do_add_file(self, fuuid, fname, ftags):
+        if len(ftags) == 0:
+            ftags = ['/']
+        # files share the tag names of the tag table
+        tids = [self.__tag_id(t) for t in ftags]
+        newftags = [self.tagnames[tid] for tid in tids]
+        if '/' in newftags:
+            newftags = newftags[1:]
+        f = DBFile(fuuid, fname, newftags)
+        self.__new_file(f)
+        self.__invalidate(ftags + ['/'])
+
+        for tid in tids:
+            tagfsutils.posting_add(self.postings[tid], f.fid)
+
+    def __do_add_ftags(self, fuuid, ftags):
+        f = self.files[fuuid]
+        self.__invalidate(list(f.tags) + ftags + ['/'])
+        self.__unindex_name(f)
+        self.__unindex_cotags(f)
+        tags = list(f.tags)
+        try:
+            for t in ftags:
+                tid = self.__tag_id(t)
+                if t != '/' and t not in tags:
+                    tags.append(self.tagnames[tid])
+                tagfsutils.posting_add(self.postings[tid], f.fid)
+        finally:
+            f.tags = tuple(tags)
+            self.__index_name(f)
+            self.__index_cotags(f)
+
+    def __do_rm_ftags(self, fuuid, ftags):
+        f = self.files[fuuid]
+        self.__invalidate(list(f.tags) + ['/'])
+        self.__unindex_name(f)
+        self.__unindex_cotags(f)
+        tags = list(f.tags)
+        try:
+            for t in ftags:
+                if t != '/' and t in tags:
+                    tags.remove(t)
+                tid = self.tags.get(t)
+                if tid != None:
+                    tagfsutils.posting_remove(self.postings[tid], f.fid)
+        finally:
+            f.tags = tuple(tags)
+            self.__index_name(f)
+            self.__index_cotags(f)
+
+    def __do_rm_file(self, fuuid):
+        f = self.files[fuuid]
+        self.__invalidate(list(f.tags) + ['/'])
+        for t in list(f.tags) + ['/']:
+            tagfsutils.posting_remove(self.postings[self.tags[t]], f.fid)
+        self.__free_file(f)
+
+    def __in_root(self, f):
+        """If f is in the '/' posting, i.e. it was created without tags"""
+        root = self.postings[self.tags['/']]
+        i = bisect_left(root, f.fid)
+        return i < len(root) and root[i] == f.fid
+
+    def __do_rm_file_tags(self, fuuid, ftags):
+        self.__do_rm_ftags(fuuid, ftags)
+        f = self.files[fuuid]
+        if len(f.tags) == 0 and not self.__in_root(f):
+            self.__free_file(f)
+
+    def __do_change_ftags(self, fuuid, rmtags, addtags):
+        self.__do_rm_ftags(fuuid, rmtags)
+        self.__do_add_ftags(fuuid, addtags)
+
+    def __restore_ftags(self, f, tags, root):
+        """
+        Give f back tags, in their order, and its place in '/' if root: the
+        undo of a change which fails, it is not journaled. Re-adding what
+        was removed would put the tags at the end, and replay would not.
+        """
+        self.__do_rm_ftags(f.fuuid, list(f.tags) + ['/'])
+        if root:
+            tags = list(tags) + ['/']
+        self.__do_add_ftags(f.fuuid, list(tags))
+
+    def __do_rename_file(self, fuuid, fname):
+        f = self.files[fuuid]
+        self.__invalidate(list(f.tags) + ['/'])
+        self.__unindex_name(f)
+        f.fname = fname
+        self.__index_name(f)
+
+    def __do_add_tags(self, tset):
+        self.__invalidate(tset)
+        for t in tset:
+            if t not in self.tags:
+                self.__new_tag(t)
+
+    def __do_rm_tags(self, tset):
+        self.__invalidate(tset)
+        for t in tset:
+            if t in self.tags:
+                tid = self.tags.pop(t)
+                self.tagnames[tid] = None
+                self.postings[tid] = None
+                self.freetids.append(tid)
+
+    def __do_rename_tag(self, tag, tag1):
+        tid = self.tags.get(tag)
+        if tid == None:
+            # journals of older versions may name an empty tag which a
+            # refused batch left in memory only, it is not there on replay
+            return
+        posting = self.postings[tid]
+        self.__invalidate([tag, tag1, '/'] + self.cotags.get(tag, {}).keys())
+        tid1 = self.tags.get(tag1)
+        if tid1 == None:
+            # the posting and the co-tag counts move over as they are
+            del self.tags[tag]
+            self.tags[tag1] = tid
+            self.tagnames[tid] = tag1
+            fnames = set()
+            for fid in posting:
+                f = self.flist[fid]
+                f.tags = tuple([t == tag and tag1 or t for t in f.tags])
+                fnames.add(f.fname)
+            for fname in fnames:
+                counts = self.nametags[fname]
+                counts[tag1] = counts.pop(tag)
+            co = self.cotags.pop(tag, None)
+            if co != None:
+                self.cotags[tag1] = co
+                for u in co:
+                    counts = self.cotags[u]
+                    counts[tag1] = counts.pop(tag)
+            return
+        tag1 = self.tagnames[tid1]
+        for fid in posting:
+            f = self.flist[fid]
+            self.__unindex_name(f)
+            self.__unindex_cotags(f)
+            if tag1 in f.tags:
+                f.tags = tuple([t for t in f.tags if t != tag])
+            else:
+                f.tags = tuple([t == tag and tag1 or t for t in f.tags])
+            self.__index_name(f)
+            self.__index_cotags(f)
+        self.postings[tid1] = tagfsutils.union_postings(
+                [self.postings[tid1], posting])
+        self.__do_rm_tags([tag])
+
+    def __do_rm_tag(self, tag):
+        """@return: the files removed, they had no other tag"""
+        tid = self.tags.get(tag)
+        if tid == None:
+            # see __do_rename_tag
+            return []
+        self.__invalidate([tag, '/'] + self.cotags.get(tag, {}).keys())
+        removed = []
+        for fid in self.postings[tid]:
+            f = self.flist[fid]
+            if len(f.tags) == 1 and not self.__in_root(f):
+                self.__free_file(f)
+                removed.append(f)
+                continue
+            self.__unindex_name(f)
+            self.__unindex_cotags(f)
+            f.tags = tuple([t for t in f.tags if t != tag])
+            self.__index_name(f)
+            self.__index_cotags(f)
+        self.__do_rm_tags([tag])
+        return removed
+
+    def __do_add_files(self, files):
+        for fuuid, fname, ftags in files:
+            self.__do_add_file(fuuid, fname, ftags)
+
+    def __do_change_files_tags(self, changes):
+        for fuuid, rmtags, addtags in changes:
+            self.__do_change_ftags(fuuid, rmtags, addtags)
+
+    @TagStats.timed('db.add_file')
+    @tagfsutils.writer
     def add_file(self, fuuid, fname, ftags):
         if self.check_unique_file(ftags, fname):
-            newftags = ftags[:]
-            if '/' in newftags:
-                newftags = newftags[1:]
-            f = DBFile(fuuid, fname, newftags)                        
-            self.files[fuuid] = f
-            if len(ftags) == 0:
-                ftags += ['/']
-            
-            for t in ftags:
-                if t in self.tags:
-                    self.tags[t][fuuid] = f
-                else:
-                    self.tags[t] = {fuuid:f}
+            self.__do_add_file(fuuid, fname, ftags)
+            self.__journal('add_file', fuuid, fname, ftags)
         else:
             raise NoUniqueTagException('File with name '+fname+' and tags: '\
-                                       +str(ftags)+' is not unique.')
+                                       +str(ftags)+' is not unique.', ftags)
 
+    @TagStats.timed('db.add_file_tags')
+    @tagfsutils.writer
     def add_file_tags(self, fuuid, ftags):
         f = self.files[fuuid]
         existed = False
         if len(ftags) == 0:
             existed = True
-        if self.check_unique_file(ftags+f.tags, f.fname, existed):
-            for t in ftags:
-                if t != '/' and t not in f.tags:
-                    f.tags.append(t)
-                if t in self.tags:
-                    self.tags[t][fuuid] = f
-                else:
-                    self.tags[t] = {fuuid:f}
+        if self.check_unique_file(ftags+list(f.tags), f.fname, existed):
+            self.__do_add_ftags(fuuid, ftags)
+            self.__journal('add_file_tags', fuuid, ftags)
         else:
             raise NoUniqueTagException('File '+fuuid+' can not have tags: ' \
-                                       + str(ftags) + ', not unique.')
-            
-        
+                                       + str(ftags) + ', not unique.', ftags)
+
+    @TagStats.timed('db.rm_file')
+    @tagfsutils.writer
     def rm_file(self, fuuid):
         """Remove a file from db"""
-        if fuuid in self.files: 
-            f = self.files[fuuid]
-            del self.files[fuuid]
-            for t in f.tags:
-                del self.tags[t][fuuid]
-            if fuuid in self.tags['/']:
-                del self.tags['/'][fuuid]
+        if fuuid in self.files:
+            self.__do_rm_file(fuuid)
+            self.__journal('rm_file', fuuid)
         else:
             raise Exception('No such file: '+fuuid)
 
-    def load_db(self, dbfile):
-        """load metadata from dbfile"""
-        import pickle
+    @TagStats.timed('db.rename_file')
+    @tagfsutils.writer
+    def rename_file(self, fuuid, fname):
+        """Change the name of a file, its tags are kept."""
+        self.__do_rename_file(fuuid, fname)
+        self.__journal('rename_file', fuuid, fname)
+
+    @tagfsutils.writer
+    def load_db(self, dbfile, jfile = None):
+        """
+        Load metadata from the snapshot in dbfile, then replay journal jfile
+        on top of it if given. Mutations after that are appended to jfile
+        and checkpointed back into dbfile.
+        """
+        self.__reset()
+        self.seq = 0
+        legacy = False
+        if os.path.exists(dbfile):
+            if TagDBImage.is_image(dbfile):
+                self.__load_image(dbfile)
+            else:
+                # db file pickled by older versions
+                legacy = True
+                self.__load_pickle(dbfile)
+        self.logger.info('DB loaded: %s files, %s tags, seq %s',
+                         len(self.files), len(self.tags), self.seq)
+        if jfile == None:
+            return
+
+        if legacy:
+            self.logger.info('migrate pickled DB to image: %s', dbfile)
+            self.__write_db(dbfile, self.__dump_db())
+
+        if self.journal != None:
+            self.journal.close()
+        count = 0
+        end = 0
+        if os.path.exists(jfile):
+            for end, (seq, op, args) in TagJournal.read_journal(jfile):
+                count += 1
+                if seq <= self.seq:
+                    continue
+                self.__ops[op](*args)
+                self.seq = seq
+        self.logger.info('journal replayed: %s records, seq %s', count,
+                         self.seq)
+        self.journal = TagJournal.TagJournal(jfile, self.seq, count, end)
+        self.dbfile = dbfile
+
+    def __load_image(self, dbfile):
+        # all of it is decoded and indexed now, the image is not kept: the
+        # lookups run on flist and the indexes, so load time grows with
+        # the number of files
+        img = TagDBImage.TagDBImage(dbfile)
+        try:
+            names = img.names()
+            tagnames = img.tags()
+            fuuids = img.fuuids()
+            fnameids = img.fnameids()
+            ftagoffs = img.ftagoffs
+            ftagids = img.ftagids()
+            # file ids are the rows of the image, postings are used as is
+            self.flist = [DBFile(fuuids[i], names[fnameids[i]],
+                                 [tagnames[t] for t in
+                                  ftagids[ftagoffs[i]:ftagoffs[i+1]]], i)
+                          for i in xrange(img.nfiles)]
+            self.files = dict((f.fuuid, f) for f in self.flist)
+            for f in self.flist:
+                self.__index_name(f)
+                self.__index_cotags(f)
+            self.tagnames = tagnames
+            self.tags = dict((t, tid) for tid, t in enumerate(tagnames))
+            self.postings = [img.posting(tid) for tid in xrange(img.ntags)]
+            if '/' not in self.tags:
+                self.__new_tag('/')
+            self.seq = img.seq
+        finally:
+            img.close()
+
+    def __load_pickle(self, dbfile):
         dbf = open(dbfile, 'rb')
-        self.files = pickle.load(dbf)
-        self.tags = pickle.load(dbf)
+        files = pickle.load(dbf)
+        tags = pickle.load(dbf) # tags was {tag=>{fuuid=>DBFile}}
         dbf.close()
-        self.logger.info('DB loaded:')
-        self.logger.info('files: '+str(self.files))
-        self.logger.info('tags: '+str(self.tags))
-    
-    def store_db(self, dbfile):
-        import pickle
-        dbf = open(dbfile, 'wb')
-        pickle.dump(self.files, dbf)
-        pickle.dump(self.tags, dbf)
+        for f in files.itervalues():
+            self.__new_file(f)
+        for t, tfiles in tags.iteritems():
+            self.__posting(t).extend(sorted([files[fuuid].fid
+                                             for fuuid in tfiles]))
+
+    def __dump_db(self):
+        # ids are compacted into image rows when some have been freed
+        remap = None
+        if len(self.freefids) != 0:
+            remap = [0] * len(self.flist)
+        flist = []
+        for f in self.flist:
+            if f != None:
+                if remap != None:
+                    remap[f.fid] = len(flist)
+                flist.append((f.fuuid, f.fname, f.tags))
+        tlist = []
+        for tid, t in enumerate(self.tagnames):
+            if t != None:
+                p = self.postings[tid]
+                if remap != None:
+                    p = [remap[fid] for fid in p]
+                tlist.append((t, p))
+        return TagDBImage.dump_image(self.seq, flist, tlist)
+
+    def __write_db(self, dbfile, data):
+        # never leave a half written db file behind
+        tmpfile = dbfile + '.tmp'
+        dbf = open(tmpfile, 'wb')
+        dbf.write(data)
+        dbf.flush()
+        os.fsync(dbf.fileno())
         dbf.close()
+        os.rename(tmpfile, dbfile)
 
-    def __rm_ftags(self, fuuid, ftags):
-        f = self.files[fuuid]
-        for t in ftags:
-            if t != '/' and t in f.tags:
-                f.tags.remove(t)
-            del self.tags[t][fuuid]
-    
-    def __undo_rm_ftags(self, fuuid, ftags):
-        f = self.files[fuuid]
-        for t in ftags:
-            if t != '/' and t not in f.tags:
-                f.tags.append(t)
-            self.tags[t][fuuid] = f
-        
+    @tagfsutils.writer
+    def store_db(self, dbfile):
+        self.__write_db(dbfile, self.__dump_db())
+        if self.journal != None and dbfile == self.dbfile:
+            self.journal.truncate(self.seq)
+
+    def set_durability(self, mode, window = None, records = None):
+        """
+        When commit makes mutations durable, see DurabilityModes. window
+        and records bound the wait of group commits.
+        """
+        if mode not in DurabilityModes:
+            raise ValueError('durability must be one of '
+                             + ', '.join(DurabilityModes))
+        self.durability = mode
+        if window != None:
+            self.commitwindow = window
+        if records != None:
+            self.commitrecords = records
+
+    @TagStats.timed('db.commit')
+    def commit(self):
+        """
+        Make mutations so far durable: one fsync of the journal for all of
+        them, now or later as the durability mode says. Without a journal
+        the caller has to store_db by itself.
+        """
+        if self.journal == None:
+            return
+        if self.durability == 'op':
+            self.journal.sync()
+        else:
+            # off to the OS at least, safe from a crash of tagfs
+            self.journal.flush()
+            if self.durability == 'group':
+                if self.committer == None or not self.committer.isAlive():
+                    self.committer = threading.Thread(
+                            target=self.__commit_loop)
+                    self.committer.setDaemon(True)
+                    self.committer.start()
+                if self.journal.pending >= self.commitrecords:
+                    self.commit_wakeup.set()
+        if self.checkpointer == None or not self.checkpointer.isAlive():
+            # started lazily so that it is not lost when fuse forks
+            self.checkpointer = threading.Thread(target=self.__checkpoint_loop)
+            self.checkpointer.setDaemon(True)
+            self.checkpointer.start()
+        if self.journal.count >= CheckpointRecords:
+            self.ckpt_wakeup.set()
+
+    @TagStats.timed('db.group_sync')
+    def __group_sync(self):
+        self.journal.sync()
+
+    def __commit_loop(self):
+        while not self.ckpt_stop:
+            self.commit_wakeup.wait(self.commitwindow)
+            self.commit_wakeup.clear()
+            journal = self.journal
+            if journal == None or journal.pending == 0:
+                continue
+            try:
+                self.__group_sync()
+            except Exception as e:
+                self.logger.error('group commit failed: %s', e)
+
+    @TagStats.timed('db.checkpoint')
+    def checkpoint(self):
+        """
+        Write a full snapshot into the db file and drop the journal records
+        it covers. Only serializing holds the db (to read), mutations can go
+        on while the snapshot is written.
+        """
+        self.rwlock.acquire_read()
+        try:
+            if self.journal == None or self.journal.count == 0:
+                return
+            data = self.__dump_db()
+            seq = self.seq
+        finally:
+            self.rwlock.release_read()
+
+        self.__write_db(self.dbfile, data)
+        self.journal.truncate(seq)
+        self.logger.info('checkpoint at seq %s', seq)
+
+    def __checkpoint_loop(self):
+        while not self.ckpt_stop:
+            self.ckpt_wakeup.wait(CheckpointInterval)
+            self.ckpt_wakeup.clear()
+            if self.ckpt_stop:
+                break
+            try:
+                self.checkpoint()
+            except Exception as e:
+                self.logger.error('checkpoint failed: %s', e)
+
+    def close(self):
+        """
+        Stop checkpointing and group commits, write a last snapshot and
+        close the journal.
+        """
+        self.ckpt_stop = True
+        if self.committer != None:
+            self.commit_wakeup.set()
+            self.committer.join()
+            self.committer = None
+        if self.checkpointer != None:
+            self.ckpt_wakeup.set()
+            self.checkpointer.join()
+            self.checkpointer = None
+        if self.journal != None:
+            self.checkpoint()
+            self.journal.close()
+            self.journal = None
+        self.ckpt_stop = False
+
+    def __build_index(self):
+        """
+        Postings, names, nametags and cotags as the file records say, in
+        one pass over the files. A file is in '/' if the '/' posting has it
+        or it has no tags.
+        @return: (postings as {tag=>[fid]}, names, nametags, cotags)
+        """
+        root = set()
+        if '/' in self.tags:
+            root.update(self.postings[self.tags['/']])
+        postings = {}
+        names = {}
+        nametags = {}
+        cotags = {}
+        # fids ascend, so do the postings
+        for fid, f in enumerate(self.flist):
+            if f == None:
+                continue
+            if fid in root or len(f.tags) == 0:
+                postings.setdefault('/', []).append(fid)
+            if f.fname in names:
+                names[f.fname].add(fid)
+                counts = nametags[f.fname]
+            else:
+                names[f.fname] = set([fid])
+                counts = nametags[f.fname] = {}
+            for t in f.tags:
+                postings.setdefault(t, []).append(fid)
+                counts[t] = counts.get(t, 0) + 1
+                for u in f.tags:
+                    if u != t:
+                        co = cotags.setdefault(t, {})
+                        co[u] = co.get(u, 0) + 1
+        return (postings, names, nametags, cotags)
+
+    @tagfsutils.reader
+    def check_index(self):
+        """
+        Compare the postings and the name and co-tag indexes with the file
+        records. rebuild_index repairs what this finds.
+        @return: list of problem descriptions, empty if all agree
+        """
+        problems = []
+        nfiles = 0
+        for fid, f in enumerate(self.flist):
+            if f == None:
+                continue
+            nfiles += 1
+            if f.fid != fid:
+                problems.append('file '+f.fuuid+' has id '+str(f.fid)
+                                +' but is at '+str(fid))
+            if self.files.get(f.fuuid) is not f:
+                problems.append('file '+f.fuuid+' is not in files')
+            if len(set(f.tags)) != len(f.tags) or '/' in f.tags:
+                problems.append('file '+f.fuuid+' has bad tags '+str(f.tags))
+        if nfiles != len(self.files):
+            problems.append(str(len(self.files))+' files but '+str(nfiles)
+                            +' file ids in use')
+
+        postings, names, nametags, cotags = self.__build_index()
+        for t, tid in self.tags.iteritems():
+            if self.tagnames[tid] != t:
+                problems.append('tag '+t+' has id '+str(tid)+' of '
+                                +str(self.tagnames[tid]))
+                continue
+            p = self.postings[tid]
+            want = postings.get(t, [])
+            if list(p) == want:
+                continue
+            if sorted(set(p)) != list(p):
+                problems.append('posting of '+t+' is not sorted')
+            dangling = [fid for fid in p if fid >= len(self.flist)
+                        or self.flist[fid] == None]
+            if len(dangling) != 0:
+                problems.append('posting of '+t+' has '+str(len(dangling))
+                                +' removed files')
+            have = set(p)
+            stray = len(have - set(want)) - len(dangling)
+            missing = len(set(want) - have)
+            if stray != 0:
+                problems.append('posting of '+t+' has '+str(stray)
+                                +' files without the tag')
+            if missing != 0:
+                problems.append('posting of '+t+' misses '+str(missing)
+                                +' files with the tag')
+        for t in postings:
+            if t not in self.tags:
+                problems.append('unknown tag '+t+' on '+str(len(postings[t]))
+                                +' files')
+        if names != self.names or nametags != self.nametags:
+            problems.append('name index does not match the files')
+        if cotags != self.cotags:
+            problems.append('co-tag index does not match the files')
+        return problems
+
+    @tagfsutils.writer
+    def rebuild_index(self):
+        """
+        Rebuild ids, postings and the name and co-tag indexes from the
+        file records alone. It is not journaled: store_db afterwards.
+        """
+        self.cachelock.acquire()
+        try:
+            self.pathcache.clear()
+            self.pathdeps = {}
+        finally:
+            self.cachelock.release()
+        self.files = {}
+        self.freefids = []
+        for fid, f in enumerate(self.flist):
+            if f == None:
+                self.freefids.append(fid)
+                continue
+            f.fid = fid
+            tags = []
+            for t in f.tags:
+                if t != '/' and t not in tags:
+                    tags.append(t)
+            f.tags = tuple(tags)
+            self.files[f.fuuid] = f
+
+        postings, self.names, self.nametags, self.cotags = \
+                  self.__build_index()
+        for t in postings:
+            if t not in self.tags:
+                self.__new_tag(t)
+        for t, tid in self.tags.iteritems():
+            self.tagnames[tid] = t
+            self.postings[tid] = tagfsutils.new_posting(postings.get(t, ()))
+
+    @TagStats.timed('db.rm_file_tags_by_path')
+    @tagfsutils.writer
     def rm_file_tags_by_path(self, fuuid, path):
         tset = tagfsutils.path2tags(path, 'file')[1]
-        del tset[-1]                
-        self.__rm_ftags(fuuid, tset)
+        del tset[-1]
         f = self.files[fuuid]
-        if not self.check_unique_file(f.tags, f.fname, True):
-            self.logger.error('not unique in rm file tags by path'+str(f.tags))
-            self.__undo_rm_ftags(fuuid, tset)            
+        tags, root = f.tags, self.__in_root(f)
+        self.__do_rm_ftags(fuuid, tset)
+        try:
+            unique = self.check_unique_file(f.tags, f.fname, True)
+        except:
+            self.__restore_ftags(f, tags, root)
+            raise
+        if not unique:
+            self.logger.error('not unique in rm file tags by path: %s', f.tags)
+            self.__restore_ftags(f, tags, root)
             raise NoUniqueTagException(
                     'Can not make file unique if remove tags. ' \
                     + 'file: ' + fuuid + ' tags: ' + str(tset), tset)
         #if path != '/':
             #if len(f.tags) == 0:
                 #self.tags['/'][fuuid] = f
-        if len(f.tags) == 0 and fuuid not in self.tags['/']:
-            del self.files[fuuid]
+        self.__journal('rm_file_tags', fuuid, tset)
+        if len(f.tags) == 0 and not self.__in_root(f):
+            self.__free_file(f)
             return (True, f.getfullname())
         return (False,)
-        
+
+    @TagStats.timed('db.rm_tags_by_path')
+    @tagfsutils.writer
     def rm_tags_by_path(self, path):
         tset = tagfsutils.path2tags(path, 'dir')[1]
-        for t in tset:
-            if len(self.tags[t]) == 0:
-                del self.tags[t]
-                
+        rmtags = [t for t in tset if t in self.tags
+                  and len(self.postings[self.tags[t]]) == 0]
+        self.__do_rm_tags(rmtags)
+        self.__journal('rm_tags', rmtags)
+
+    @TagStats.timed('db.change_file_tags')
+    @tagfsutils.writer
     def change_file_tags(self, fuuid, rmtags, addtags):
-        self.logger.info('change_file_tags: +'+str(addtags)+' -'+str(rmtags))
-        self.__rm_ftags(fuuid, rmtags)
+        self.logger.debug('change_file_tags: +%s -%s', addtags, rmtags)
+        f = self.files[fuuid]
+        tags, root = f.tags, self.__in_root(f)
+        self.__do_rm_ftags(fuuid, rmtags)
+        existed = False
+        if len(addtags) == 0:
+            existed = True
         try:
-            self.add_file_tags(fuuid, addtags)
-        except NoUniqueTagException:
-            self.__undo_rm_ftags(fuuid, rmtags)
-            self.logger.error('change file tags failed rm: '+str(rmtags)+' add: '+str(addtags))
-            raise NoUniqueTagException('change file tags failed rm: '+str(rmtags)+' add: '+str(addtags))
-    
+            unique = self.check_unique_file(addtags+list(f.tags), f.fname,
+                                            existed)
+        except:
+            self.__restore_ftags(f, tags, root)
+            raise
+        if unique:
+            self.__do_add_ftags(fuuid, addtags)
+            self.__journal('change_file_tags', fuuid, rmtags, addtags)
+        else:
+            self.__restore_ftags(f, tags, root)
+            self.logger.error('change file tags failed rm: %s add: %s', rmtags,
+                              addtags)
+            raise NoUniqueTagException('change file tags failed rm: '+str(rmtags)+' add: '+str(addtags), addtags)
+
+    @TagStats.timed('db.add_files')
+    @tagfsutils.writer
+    def add_files(self, files):
+        """
+        add_file for every (fuuid, fname, ftags) of files, all of them or
+        none: when one is not unique the ones added before are taken out
+        again, so are the tags made for them. They are journaled as a
+        single record.
+        """
+        done = []
+        self.newtags = []
+        try:
+            for fuuid, fname, ftags in files:
+                if not self.check_unique_file(ftags, fname):
+                    raise NoUniqueTagException('File with name '+fname
+                                               +' and tags: '+str(ftags)
+                                               +' is not unique.', ftags)
+                self.__do_add_file(fuuid, fname, ftags)
+                done.append(fuuid)
+        except:
+            for fuuid in reversed(done):
+                self.__do_rm_file(fuuid)
+            self.__drop_new_tags()
+            raise
+        self.newtags = None
+        self.__journal('add_files', files)
+
+    @TagStats.timed('db.change_files_tags')
+    @tagfsutils.writer
+    def change_files_tags(self, changes):
+        """
+        change_file_tags for every (fuuid, rmtags, addtags) of changes, all
+        of them or none, journaled as a single record. Each file is checked
+        against the ones changed before it.
+        """
+        done = []
+        saved = [] # saved is [(DBFile, tags, in '/')] as they were
+        self.newtags = []
+        try:
+            for fuuid, rmtags, addtags in changes:
+                f = self.files[fuuid]
+                saved.append((f, f.tags, self.__in_root(f)))
+                rmtags = [t for t in rmtags if t in f.tags
+                          or (t == '/' and saved[-1][2])]
+                self.__do_rm_ftags(fuuid, rmtags)
+                done.append((fuuid, rmtags, []))
+                addtags = [t for t in addtags if (t != '/' and t not in f.tags)
+                           or (t == '/' and not self.__in_root(f))]
+                existed = False
+                if len(addtags) == 0:
+                    existed = True
+                if not self.check_unique_file(addtags+list(f.tags), f.fname,
+                                              existed):
+                    raise NoUniqueTagException('File '+fuuid+' can not have '
+                                               + 'tags: '+str(addtags)
+                                               + ', not unique.', addtags)
+                self.__do_add_ftags(fuuid, addtags)
+                done[-1] = (fuuid, rmtags, addtags)
+        except:
+            for f, tags, root in reversed(saved):
+                self.__restore_ftags(f, tags, root)
+            self.__drop_new_tags()
+            raise
+        self.newtags = None
+        self.__journal('change_files_tags', done)
+
+    def __drop_new_tags(self):
+        """
+        Remove the tags made since newtags was set, by a batch which is
+        undone: they have no files again and are not journaled. Their ids
+        are freed last made first, as they were before.
+        """
+        newtags = self.newtags
+        self.newtags = None
+        self.__do_rm_tags(list(reversed(newtags)))
+
+    @TagStats.timed('db.rename_tag')
+    @tagfsutils.writer
+    def rename_tag(self, tag, tag1):
+        """
+        Rename tag into tag1, or merge it into tag1 if that is a tag too:
+        its files have tag1 in its place and tag is gone. It is one
+        journal record, and a pass over the files of tag. A merge which
+        would leave same named files impossible to tell apart fails
+        before anything changes, only names shared with the files of tag
+        are looked at.
+        """
+        if tag == '/' or tag not in self.tags:
+            raise NoTagException('Can not find tags ' + tag, tag)
+        if tag1 == '/' or TagQuery.is_query([tag1]):
+            raise NameConflictionException('Can not rename ' + tag
+                                           + ' into ' + tag1)
+        if tag1 == tag:
+            return
+        posting = self.postings[self.tags[tag]]
+        if tag1 not in self.tags:
+            if tag1 in self.names:
+                raise NameConflictionException('Can not rename ' + tag
+                                               + ' into ' + tag1
+                                               + ', a file has that name')
+        else:
+            fnames = set([self.flist[fid].fname for fid in posting])
+            for fname in fnames:
+                fids = self.names[fname]
+                if len(fids) == 1:
+                    continue
+                group = dict([(fid, self.flist[fid].tags) for fid in fids])
+                clashes = merge_clashes(group, tag, tag1)
+                if len(clashes) != 0:
+                    fuuids = [self.flist[fid].fuuid for fid in clashes]
+                    raise NoUniqueTagException('Can not merge ' + tag
+                                               + ' into ' + tag1
+                                               + ', can not distinguish '
+                                               + 'files: ' + str(fuuids),
+                                               fuuids)
+        self.__do_rename_tag(tag, tag1)
+        self.__journal('rename_tag', tag, tag1)
+
+    @TagStats.timed('db.rm_tag')
+    @tagfsutils.writer
+    def rm_tag(self, tag):
+        """
+        Take tag off all its files and remove it, the files left without
+        tags are removed too, as unlinking each of them from the tag dir
+        would. It is one journal record. Like rename_tag it fails before
+        anything changes if same named files could not be told apart
+        any more.
+        @return: the DBFiles removed, their data files are to be removed
+        """
+        if tag == '/' or tag not in self.tags:
+            raise NoTagException('Can not find tags ' + tag, tag)
+        posting = self.postings[self.tags[tag]]
+        gone = set([fid for fid in posting
+                    if len(self.flist[fid].tags) == 1
+                    and not self.__in_root(self.flist[fid])])
+        fnames = set([self.flist[fid].fname for fid in posting])
+        for fname in fnames:
+            fids = self.names[fname]
+            if len(fids) == 1:
+                continue
+            group = dict([(fid, self.flist[fid].tags) for fid in fids])
+            clashes = merge_clashes(group, tag, None, gone)
+            if len(clashes) != 0:
+                fuuids = [self.flist[fid].fuuid for fid in clashes]
+                raise NoUniqueTagException('Can not remove ' + tag
+                                           + ', can not distinguish '
+                                           + 'files: ' + str(fuuids),
+                                           fuuids)
+        removed = self.__do_rm_tag(tag)
+        self.__journal('rm_tag', tag)
+        return removed
+
+    @TagStats.timed('db.add_tags_by_path')
+    @tagfsutils.writer
     def add_tags_by_path(self, path):
         tset = tagfsutils.path2tags(path, 'dir')[1]
-        self.logger.info('add tags by path: '+str(tset))
+        self.logger.debug('add tags by path: %s', tset)
         # TODO: check unique for tags!!! IMPORTANT TODO
-        for t in tset:
-            if t not in self.tags:
-                self.tags[t] = {}
-
+        newtags = [t for t in tset if t not in self.tags]
+        self.__do_add_tags(newtags)
+        self.__journal('add_tags', newtags)
@@ -0,0 +1,189 @@
+# Tag db on-disk image
+
+"""
+Versioned binary layout of the tag db file, loaded through mmap.
+
+All integers are little-endian. After the header come these sections,
+back to back, in this order:
+
+    name table      u32 offsets[nnames+1], name bytes
+    tag table       u32 offsets[ntags+1], tag bytes
+    fuuid column    16 bytes of uuid per file
+    name column     u32 name id per file
+    file tags       u32 offsets[nfiles+1], u32 tag ids
+    postings        u32 offsets[ntags+1], u32 file ids, sorted per tag
+
+File ids are the row numbers of the file columns. Sections are sliced
+straight out of the map and decoded a whole column at a time, TagDB
+decodes all of them when it loads the image.
+"""
+
+import os
+import sys
+import mmap
+import struct
+import binascii
+from array import array
+import tagfsutils
+
+ImageMagic = 'TAGFSDB\0'
+ImageVersion = 1
+
+# magic, version, seq, nfiles, ntags, nnames
+_header = struct.Struct('<8sIQIII')
+
+_u32 = tagfsutils.PostingType
+
+def _u32array(data=''):
+    a = array(_u32)
+    a.fromstring(data)
+    if sys.byteorder == 'big':
+        a.byteswap()
+    return a
+
+def _u32bytes(a):
+    if sys.byteorder == 'big':
+        a = array(_u32, a)
+        a.byteswap()
+    return a.tostring()
+
+def _strtable(strs):
+    offs = array(_u32, [0])
+    for s in strs:
+        offs.append(offs[-1] + len(s))
+    return _u32bytes(offs) + ''.join(strs)
+
+class ImageException(Exception):
+    def __init__(self, msg, dbfile):
+        self.msg = msg
+        self.dbfile = dbfile
+
+    def __str__(self):
+        return self.msg + ': ' + self.dbfile
+
+def is_image(dbfile):
+    """Tell a db image from a db file pickled by older versions."""
+    dbf = open(dbfile, 'rb')
+    magic = dbf.read(len(ImageMagic))
+    dbf.close()
+    return magic == ImageMagic
+
+def dump_image(seq, files, tags):
+    """
+    Build the image of a db.
+    @files: [(fuuid, fname, [tag, ...]), ...], fuuid being a uuid in hex
+    @tags:  [(tag, posting), ...], posting being the sorted indexes of
+            the files of the tag in files
+    """
+    tagnames = [t for t, p in tags]
+    tagids = dict((t, i) for i, t in enumerate(tagnames))
+    names = []
+    nameids = {}
+    fnameids = array(_u32)
+    ftagoffs = array(_u32, [0])
+    ftagids = array(_u32)
+    fuuids = []
+    for fuuid, fname, ftags in files:
+        fuuids.append(fuuid)
+        if fname not in nameids:
+            nameids[fname] = len(names)
+            names.append(fname)
+        fnameids.append(nameids[fname])
+        ftagids.extend([tagids[t] for t in ftags])
+        ftagoffs.append(len(ftagids))
+
+    postoffs = array(_u32, [0])
+    postids = array(_u32)
+    for t, posting in tags:
+        postids.extend(posting)
+        postoffs.append(len(postids))
+
+    return ''.join([_header.pack(ImageMagic, ImageVersion, seq, len(files),
+                                 len(tagnames), len(names)),
+                    _strtable(names),
+                    _strtable(tagnames),
+                    binascii.unhexlify(''.join(fuuids)),
+                    _u32bytes(fnameids),
+                    _u32bytes(ftagoffs), _u32bytes(ftagids),
+                    _u32bytes(postoffs), _u32bytes(postids)])
+
+class TagDBImage:
+    """
+    Read-only view of a db image through mmap.
+    """
+
+    def __init__(self, dbfile):
+        self.dbfile = dbfile
+        dbf = open(dbfile, 'rb')
+        try:
+            if os.fstat(dbf.fileno()).st_size < _header.size:
+                raise ImageException('Truncated db image', dbfile)
+            self.mm = mmap.mmap(dbf.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            dbf.close()
+
+        (magic, version, self.seq, self.nfiles, self.ntags,
+         self.nnames) = _header.unpack(self.mm[0:_header.size])
+        if magic != ImageMagic:
+            raise ImageException('Not a db image', dbfile)
+        if version != ImageVersion:
+            raise ImageException('Unsupported db image version '
+                                 + str(version), dbfile)
+
+        pos = _header.size
+        self.nameoffs, pos = self.__u32s(pos, self.nnames + 1)
+        self.namebase = pos
+        pos += self.nameoffs[-1]
+        self.tagoffs, pos = self.__u32s(pos, self.ntags + 1)
+        self.tagbase = pos
+        pos += self.tagoffs[-1]
+        self.fuuidbase = pos
+        pos += 16 * self.nfiles
+        self.fnamebase = pos
+        pos += 4 * self.nfiles
+        self.ftagoffs, pos = self.__u32s(pos, self.nfiles + 1)
+        self.ftagbase = pos
+        pos += 4 * self.ftagoffs[-1]
+        self.postoffs, pos = self.__u32s(pos, self.ntags + 1)
+        self.postbase = pos
+        pos += 4 * self.postoffs[-1]
+        if pos > len(self.mm):
+            raise ImageException('Truncated db image', dbfile)
+
+    def __u32s(self, pos, n):
+        end = pos + 4 * n
+        if end > len(self.mm):
+            raise ImageException('Truncated db image', self.dbfile)
+        return (_u32array(self.mm[pos:end]), end)
+
+    def __strs(self, base, offs):
+        blob = self.mm[base:base + offs[-1]]
+        return [blob[offs[i]:offs[i + 1]] for i in xrange(len(offs) - 1)]
+
+    def names(self):
+        return self.__strs(self.namebase, self.nameoffs)
+
+    def tags(self):
+        return self.__strs(self.tagbase, self.tagoffs)
+
+    def fuuids(self):
+        h = binascii.hexlify(self.mm[self.fuuidbase:
+                                     self.fuuidbase + 16 * self.nfiles])
+        return [h[i:i + 32] for i in xrange(0, len(h), 32)]
+
+    def fnameids(self):
+        return _u32array(self.mm[self.fnamebase:
+                                 self.fnamebase + 4 * self.nfiles])
+
+    def ftagids(self):
+        """Tag ids of all files, sliced per file by ftagoffs"""
+        return _u32array(self.mm[self.ftagbase:
+                                 self.ftagbase + 4 * self.ftagoffs[-1]])
+
+    def posting(self, tid):
+        """Sorted ids of files having tag tid"""
+        return _u32array(self.mm[self.postbase + 4 * self.postoffs[tid]:
+                                 self.postbase + 4 * self.postoffs[tid + 1]])
+
+    def close(self):
+        self.mm.close()
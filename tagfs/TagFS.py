@@ -11,8 +11,18 @@ import stat
 import os
 import errno
 import sys
+import threading
+import time
 
 import TagDB
+import TagJournal
+import SQLiteTagDB
+import LRUCache
+import TagQuery
+import TagStats
+import TagLog
+import StoreLayout
+import FDPool
 import tagfsutils
 
 
@@ -23,10 +33,22 @@ fuse.fuse_python_api = (0, 2)
 
 import logging
 LOG_FILENAME = '/tmp/tagfs.log'
-logging.basicConfig(level = logging.DEBUG, \
-                    format = '%(asctime)s %(levelname)s %(message)s', \
-                    filename = LOG_FILENAME, \
-                    filemode = 'w') # or 'a+'
+# records below this level cost a level check, see -o loglevel
+LogLevel = 'warning'
+
+# stats of back-store files kept around for getattr
+StatCacheSize = 4096
+# seconds the kernel may trust attributes and lookups, unless given by -o
+AttrTimeout = 1.0
+EntryTimeout = 1.0
+# file entries resolved per TagDB call while listing a dir
+DirBatch = 1024
+# back-store files kept open after their last handle is released
+FDPoolSize = 128
+# threads removing the back-store files of a bulk delete, which takes
+# more than UnlinkBatch of them
+UnlinkThreads = 4
+UnlinkBatch = 64
 
 def _flags2mode(flags):
     md = {os.O_RDONLY: 'r', \
@@ -39,6 +61,16 @@ def _flags2mode(flags):
 
     return m
 
+StatsDir = TagStats.StatsDir
+StatsPath = '/' + StatsDir + '/stats'
+
+def _read_only(path):
+    """
+    If path is a query or a stats file, or would make .q or .tagfs a tag
+    or file name
+    """
+    return len(tagfsutils.reserved_names(path.split('/'))) != 0
+
 class TagfsStat(fuse.Stat):
     def __init__(self):
         pass
@@ -46,8 +78,9 @@ class TagfsStat(fuse.Stat):
 
 class TagFS(fuse.Fuse):
     
-    # because of single threading, we could use this static var to access the only
-    # TagFS object.
+    # there is only one TagFS object per process, TagFSFile finds it with this
+    # static var. FUSE calls may come from many threads, the TagDB locks
+    # itself and handlers doing several TagDB calls hold its write lock.
     cur_tagfs = None
     
     def __init__(self, *args, **kw):        
@@ -57,6 +90,24 @@ class TagFS(fuse.Fuse):
         self.lldir = "." 
         TagFS.cur_tagfs = self
         self.root = "."
+        self.fdio = False
+        self.engine = 'memory'
+        self.durability = 'op'
+        self.commit_window = TagDB.CommitWindow
+        self.commit_records = TagDB.CommitRecords
+        self.statsdump = None
+        self.fanout = None
+        self.layout = None
+        self.loglevel = LogLevel
+        self.loghandler = None
+        # statcache is {fuuid=>TagfsStat}, statgen moves on every change so
+        # that a stat taken before it is not cached after it
+        self.statlock = threading.Lock()
+        self.statcache = LRUCache.LRUCache(StatCacheSize)
+        self.statgen = 0
+        self.dirstat = None
+        self.fdpool = FDPool.FDPool(FDPoolSize)
+        TagStats.stats.add_gauge(self.stats_gauges)
         
     def find_nonfiles_by_path(self, path, target='unsure'):
         fs = self.tdb.find_by_path(path, target)
@@ -65,51 +116,170 @@ class TagFS(fuse.Fuse):
             if f == None:
                 import inspect
                 funcname = inspect.currentframe().f_back.f_code.co_name
-                logging.error(funcname+' get files: '+path)
+                logging.debug('%s get files: %s', funcname, path)
                 raise TagDB.NoTagException(funcname+' not tag'+path, path)
             else:
                 fs = f
         return fs
         
+    @TagStats.timed('getattr')
     def getattr(self, path):
-        logging.info('getattr: '+path)
-        st = TagfsStat()
+        logging.debug('getattr: %s', path)
+        if path == StatsPath:
+            st = TagfsStat()
+            st.st_mode = stat.S_IFREG | 0444
+            st.st_size = len(TagStats.stats.report())
+            st.st_nlink = 1
+            st.st_ino = 0L
+            st.st_dev = 0L
+            st.st_gid = os.getgid()
+            st.st_uid = os.getuid()
+            st.st_atime = st.st_mtime = st.st_ctime = int(time.time())
+            return st
         try:
-            fs = self.find_nonfiles_by_path(path)
+            if path == '/' + StatsDir:
+                fs = ('dir',)
+            else:
+                fs = self.find_nonfiles_by_path(path)
         except (TagDB.NoTagException, TagDB.NoFileException):
-            logging.error('getattr: no ent '+path)
+            logging.debug('getattr: no ent %s', path)
             return -errno.ENOENT        
             
         if fs[0] == 'dir':
-            # directory
-            st.st_mode = stat.S_IFDIR | 0755
-            st.st_size = 4096L
-            st.st_nlink = 2
-            st.st_ino = 0L
-            st.st_dev = 0L
-            st.st_gid = os.getgid()
-            
-            # TODO: add a/m/c times for tags. Dir times will be the most recent one.
-            st.st_atime = 0
-            st.st_mtime = 0
-            st.st_ctime = 0
-            st.st_uid = os.getuid()            
-        else:
-            # file
-            llst = os.lstat(self.lldir + self.tdb.files[fs[1][0]].getfullname())
-            st.st_size = llst.st_size
-            st.st_nlink = llst.st_nlink
-            st.st_ino = llst.st_ino
-            st.st_dev = llst.st_dev
-            st.st_gid = llst.st_gid
-            st.st_atime = llst.st_atime
-            st.st_mtime = llst.st_mtime
-            st.st_ctime = llst.st_ctime
-            st.st_mode = llst.st_mode
-            st.st_uid = llst.st_uid
+            # directory, all of them look the same
+            if self.dirstat == None:
+                st = TagfsStat()
+                st.st_mode = stat.S_IFDIR | 0755
+                st.st_size = 4096L
+                st.st_nlink = 2
+                st.st_ino = 0L
+                st.st_dev = 0L
+                st.st_gid = os.getgid()
+                
+                # TODO: add a/m/c times for tags. Dir times will be the most recent one.
+                st.st_atime = 0
+                st.st_mtime = 0
+                st.st_ctime = 0
+                st.st_uid = os.getuid()            
+                self.dirstat = st
+            return self.dirstat
+
+        # file
+        try:
+            return self.__file_stat(fs[1][0])
+        except (KeyError, OSError):
+            # removed by another thread meanwhile
+            logging.debug('getattr: gone %s', path)
+            return -errno.ENOENT
+
+    def __file_stat(self, fuuid):
+        self.statlock.acquire()
+        try:
+            st = self.statcache.get(fuuid)
+            gen = self.statgen
+        finally:
+            self.statlock.release()
+        if st != None:
+            return st
+
+        llst = self.layout.call(os.lstat, self.tdb.files[fuuid].getfullname())
+        st = TagfsStat()
+        st.st_size = llst.st_size
+        st.st_nlink = llst.st_nlink
+        st.st_ino = llst.st_ino
+        st.st_dev = llst.st_dev
+        st.st_gid = llst.st_gid
+        st.st_atime = llst.st_atime
+        st.st_mtime = llst.st_mtime
+        st.st_ctime = llst.st_ctime
+        st.st_mode = llst.st_mode
+        st.st_uid = llst.st_uid
+
+        self.statlock.acquire()
+        try:
+            if gen == self.statgen:
+                self.statcache.put(fuuid, st)
+        finally:
+            self.statlock.release()
         return st
+
+    def stats_gauges(self):
+        """Tag db size and cache hit rates for the stats file"""
+        tdb = self.tdb
+        gauges = [('db.files', len(tdb.files)), ('db.tags', len(tdb.tags))]
+        journal = getattr(tdb, 'journal', None)
+        if journal != None:
+            gauges.append(('db.journal_records', journal.count))
+        gauges.append(('db.durability', tdb.durability))
+        caches = [('statcache', self.statcache),
+                  ('fdpool', self.fdpool.files)]
+        if hasattr(tdb, 'pathcache'):
+            caches.append(('pathcache', tdb.pathcache))
+        if self.layout != None:
+            gauges.append(('store.fanout', self.layout.fanout))
+            if self.layout.oldfanout != None:
+                gauges.append(('store.moved', '%d files from fanout %d'
+                               % (self.layout.moved, self.layout.oldfanout)))
+        if isinstance(self.loghandler, TagLog.QueueHandler):
+            gauges.append(('log.dropped', self.loghandler.dropped))
+        for name, cache in caches:
+            looked = cache.hits + cache.misses
+            gauges.append((name, '%d/%d entries, %d hits %d misses (%.1f%%)'
+                           % (len(cache), cache.size, cache.hits,
+                              cache.misses,
+                              100.0 * cache.hits / max(looked, 1))))
+        return gauges
+
+    def forget_stat(self, fuuid):
+        """The back-store file of fuuid changed, its cached stat is stale."""
+        self.statlock.acquire()
+        try:
+            self.statgen += 1
+            self.statcache.pop(fuuid)
+        finally:
+            self.statlock.release()
     
     
+    def remove_store_files(self, files):
+        """
+        Remove the back-store files of DBFiles files, which are out of the
+        tag db already, and drop their cached stats and pooled fds. More
+        than UnlinkBatch files are removed by UnlinkThreads threads.
+        @return: how many could not be removed
+        """
+        pending = iter(files)
+        lock = threading.Lock()
+        failed = [0]
+        def remove():
+            while True:
+                lock.acquire()
+                try:
+                    f = next(pending, None)
+                finally:
+                    lock.release()
+                if f == None:
+                    return
+                self.forget_stat(f.fuuid)
+                self.fdpool.forget(f.fuuid)
+                try:
+                    self.layout.call(os.remove, f.getfullname())
+                except OSError as e:
+                    logging.error('remove %s failed: %s', f.getfullname(), e)
+                    lock.acquire()
+                    failed[0] += 1
+                    lock.release()
+        if len(files) <= UnlinkBatch:
+            remove()
+            return failed[0]
+        workers = [threading.Thread(target=remove)
+                   for i in range(UnlinkThreads)]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        return failed[0]
+
+    @TagStats.timed('getxattr')
     def getxattr(self, path, name, size):
         if name != 'tags':
             return -errno.ENODATA # should be -errno.ENOATTR
@@ -120,15 +290,16 @@ class TagFS(fuse.Fuse):
             try:
                 fs = self.find_nonfiles_by_path(path)               
             except (TagDB.NoTagException, TagDB.NoFileException):
-                logging.error('getxattr: no ent '+path)
+                logging.debug('getxattr: no ent %s', path)
                 return -errno.ENOENT
             
             if fs[0] == 'dir':
                 if len(fs[1]) != 0:                
-                    pts = set(tagfsutils.path2tags(path, 'dir')[1])
-                    
-                    # make sure lambda be executed at least once and also for first time call                    
-                    ts = reduce(lambda irt,f: irt | set(self.tdb.files[f[0]].tags)-pts, [set()]+fs[1])
+                    try:
+                        ts = self.tdb.sub_tags(tagfsutils.path2tags(path, 'dir')[1])
+                    except TagDB.NoTagException:
+                        logging.debug('getxattr: no ent %s', path)
+                        return -errno.ENOENT
                     tags = '/'.join(ts)                
             else:
                 f = self.tdb.files[fs[1][0]]
@@ -139,54 +310,155 @@ class TagFS(fuse.Fuse):
             return len(tags)
         return tags
     
-    def setxattr(self, path, name, value):
-        # if name != 'tags':
-        #    return -errno.ENODATA # should be -errno.ENOATTR 
+    @TagStats.timed('setxattr')
+    def setxattr(self, path, name, value, flags = 0):
+        """
+        Writing the tags attribute retags a file, or every file listed in a
+        dir (query dirs too) at once, see tagfsutils.parse_tag_edit for the
+        value. Either all files get their new tags or none does. Writing
+        rmtag on a top level tag dir removes the tag, see rm_tag.
+        """
+        logging.debug('setxattr: %s %s', path, value)
+        if name == 'rmtag':
+            return self.rm_tag(path)
+        if name != 'tags':
+            return -errno.ENOTSUP
         try:
-            self.find_nonfiles_by_path(path)                           
-        except (TagDB.NoTagException, TagDB.NoFileException):
-            logging.error('setxattr: no ent '+path)
-            return -errno.ENOENT       
+            exact, addtags, rmtags = tagfsutils.parse_tag_edit(value)
+        except ValueError as e:
+            logging.error('setxattr: %s', e)
+            return -errno.EINVAL
+        if len(tagfsutils.reserved_names(addtags)) != 0:
+            return -errno.EINVAL
+
+        self.tdb.rwlock.acquire_write()
+        try:
+            try:
+                fs = self.find_nonfiles_by_path(path)
+            except (TagDB.NoTagException, TagDB.NoFileException):
+                logging.debug('setxattr: no ent %s', path)
+                return -errno.ENOENT
+            except TagQuery.QueryException:
+                return -errno.EINVAL
+            if fs[0] == 'dir':
+                fuuids = [f[0] for f in fs[1]]
+            elif fs[0] == 'file':
+                fuuids = [fs[1][0]]
+            else:
+                return -errno.ENOENT
+
+            changes = []
+            for fuuid in fuuids:
+                f = self.tdb.files[fuuid]
+                if exact:
+                    rm = [t for t in f.tags if t not in addtags] + ['/']
+                    add = addtags[:]
+                else:
+                    rm = rmtags
+                    add = addtags
+                left = [t for t in list(f.tags) + add if t not in rm]
+                if len(left) == 0:
+                    # a file without tags lives in /
+                    add = add + ['/']
+                changes.append((fuuid, rm, add))
+            try:
+                self.tdb.change_files_tags(changes)
+                self.tdb.commit()
+            except TagDB.NoUniqueTagException:
+                logging.error('setxattr: tags not unique %s', value)
+                return -errno.EEXIST
+            except KeyError:
+                return -errno.ENOENT
+        finally:
+            self.tdb.rwlock.release_write()
 
+    def rm_tag(self, path):
+        """
+        Take the tag of top level dir path off all its files and remove
+        it, with the files left without tags, as rm -r of the dir would
+        but in one tag db operation. The back-store files are removed
+        once the tag db is committed.
+        """
+        if _read_only(path):
+            return -errno.EROFS
+        tags = tagfsutils.path2tags(path, 'dir')[1]
+        if len(tags) != 1 or tags[0] == '/':
+            return -errno.EINVAL
+        self.tdb.rwlock.acquire_write()
+        try:
+            try:
+                removed = self.tdb.rm_tag(tags[0])
+                self.tdb.commit()
+            except TagDB.NoTagException:
+                return -errno.ENOENT
+            except TagDB.NoUniqueTagException as e:
+                logging.error('rm tag %s failed: %s', tags[0], e.msg)
+                return -errno.EEXIST
+        finally:
+            self.tdb.rwlock.release_write()
+        failed = self.remove_store_files(removed)
+        logging.info('rm tag %s: %d files removed, %d failed', tags[0],
+                     len(removed), failed)
+        if failed != 0:
+            return -errno.EIO
+        return 0
+
+    @TagStats.timed('listxattr')
     def listxattr(self, path, size):        
         # we have only one extended attribute
         return self.getxattr(path, 'tags', size)
 
+    @TagStats.timed('readlink')
     def readlink(self, path):
         # link is not supported
-        logging.info('readlink: '+path)
+        logging.debug('readlink: %s', path)
         return -errno.ENOSYS
 
-    def readdir(self, path, offset):
-        logging.info('readdir: '+path)
-        try:            
-            fs = self.tdb.find_by_path(path, 'dir')
-            if fs[0] == 'file':
-                yield -errno.ENOTDIR
-                return
-            if fs[0] != 'dir':
-                yield -errno.ENOENT
-                return
+    @TagStats.timed('opendir')
+    def opendir(self, path):
+        logging.debug('opendir: %s', path)
+        if path == '/' + StatsDir:
+            return TagDB.DirListing([StatsDir], [], [StatsPath.split('/')[-1]])
+        try:
+            return self.tdb.open_dir(tagfsutils.path2tags(path, 'dir')[1])
         except TagDB.NoTagException:
-            yield -errno.ENOENT
-            return
-        
-        for f in fs[1]:
-            if len(f) == 1:
-                yield fuse.Direntry(self.tdb.files[f[0]].fname)
-            else:
-                yield fuse.Direntry(f[1] + '/' + self.tdb.files[f[0]].fname)
-                
-        subtags = self.getxattr(path, 'tags', 1)
-        if len(subtags) != 0:
-            subtags = subtags.split('/')
-            for st in subtags:
-                if len(st) != 0:
-                    yield fuse.Direntry(st)
+            return -errno.ENOENT
+
+    @TagStats.timed('readdir')
+    def readdir(self, path, offset, dh = None):
+        """
+        Files of the listing come first, then its sub-tags. The offset of
+        an entry is the index of the next one, so a listing cut short by
+        the kernel goes on from where it stopped.
+        """
+        logging.debug('readdir: %s from %s', path, offset)
+        if dh == None:
+            dh = self.opendir(path)
+            if not isinstance(dh, TagDB.DirListing):
+                yield dh
+                return
+
+        nfiles = len(dh.fids)
+        start = offset
+        while start < nfiles:
+            for i, name in self.tdb.dir_entries(dh, start, DirBatch):
+                yield fuse.Direntry(name, offset = i + 1)
+            start += DirBatch
+
+        for i in xrange(max(offset - nfiles, 0), len(dh.subtags)):
+            yield fuse.Direntry(dh.subtags[i], offset = nfiles + i + 1)
+
+    @TagStats.timed('releasedir')
+    def releasedir(self, path, dh):
+        return 0
                  
 
+    @TagStats.timed('unlink')
     def unlink(self, path):
-        logging.info('unlink: '+path)
+        logging.debug('unlink: %s', path)
+        if _read_only(path):
+            return -errno.EROFS
+        self.tdb.rwlock.acquire_write()
         try:
             fs = self.find_nonfiles_by_path(path, 'file')            
                     
@@ -195,129 +467,187 @@ class TagFS(fuse.Fuse):
             
             rt = self.tdb.rm_file_tags_by_path(fs[1][0], path)
             if rt[0]:
-                os.remove(self.lldir+rt[1])
-            self.tdb.store_db(self.lldir+TagDB.DefaultMetaDBFile)
+                self.layout.call(os.remove, rt[1])
+                self.forget_stat(fs[1][0])
+                self.fdpool.forget(fs[1][0])
+            self.tdb.commit()
         except TagDB.NoTagException as e:
-            logging.error('no tag in unlink'+str(e))
+            logging.error('no tag in unlink: %s', e)
             return -errno.ENOENT
         except TagDB.NoUniqueTagException as e:
-            logging.error('no unique in unlink'+str(e))
+            logging.error('no unique in unlink: %s', e)
             return -errno.EISDIR # -errno.ENOENT may be better
+        finally:
+            self.tdb.rwlock.release_write()
         
         # unlink will remove the tags associated with the file, if there is
         # not any tag left, remove the file, too.
         
+    @TagStats.timed('rmdir')
     def rmdir(self, path):
-        logging.info('rmdir: '+path)
+        logging.debug('rmdir: %s', path)
+        if _read_only(path):
+            return -errno.EROFS
         try:
             fs = self.tdb.find_by_path(path, 'dir')
             if len(fs[1]) != 0:
                 return -errno.ENOTEMPTY # not empty
             else:
                 self.tdb.rm_tags_by_path(path)
-                self.tdb.store_db(self.lldir+TagDB.DefaultMetaDBFile)
+                self.tdb.commit()
         except TagDB.NoTagException:
             return -errno.ENOENT
         except TagDB.NoUniqueTagException:
             logging.error('Can not remove dir because of name confliction')
             return -errno.EFAULT # but there is problem! (TODO: figure out a solution)
 
+    @TagStats.timed('symlink')
     def symlink(self, path, path1):
-        logging.info('symlink: '+path)
+        logging.debug('symlink: %s', path)
         # I decide not support symlink!
         return -errno.ENOSYS
 
+    @TagStats.timed('rename')
     def rename(self, path, path1):
-        logging.info('rename: '+path)        
+        logging.debug('rename: %s', path)        
+        if _read_only(path) or _read_only(path1):
+            return -errno.EROFS
+        self.tdb.rwlock.acquire_write()
         try:
-            frs = self.find_nonfiles_by_path(path, 'file')
+            try:
+                frs = self.find_nonfiles_by_path(path, 'file')
+            except (TagDB.NoFileException, TagDB.NoTagException):
+                # no such file, a dir then: its tags are all it takes
+                tags0 = tagfsutils.path2tags(path, 'dir')[1]
+                if len(tags0) == 0 or \
+                       [t for t in tags0 if t not in self.tdb.tags]:
+                    raise
+                frs = ('dir',)
             if frs[0] == 'dir':
-                logging.error('rename on dir is not supported yet: '+path+' to '+path1)
-                return -errno.ENOSYS
+                tags0 = tagfsutils.path2tags(path, 'dir')[1]
+                tags1 = tagfsutils.path2tags(path1, 'dir')[1]
+                if len(tags0) != 1 or len(tags1) != 1:
+                    logging.error('rename on dir is only supported for top '
+                                  'level tags: %s to %s', path, path1)
+                    return -errno.ENOSYS
+                # rename the tag, or merge it into an existing one
+                try:
+                    self.tdb.rename_tag(tags0[0], tags1[0])
+                    self.tdb.commit()
+                except (TagDB.NoUniqueTagException,
+                        TagDB.NameConflictionException) as e:
+                    logging.error('rename tag %s to %s failed: %s',
+                                  tags0[0], tags1[0], e.msg)
+                    return -errno.EEXIST
+                return 0
             
             if frs[0] == 'file':
-                logging.info('rename from ' + path + ' to ' + path1)
+                logging.debug('rename from %s to %s', path, path1)
                 tags0 = tagfsutils.path2tags(path, 'file')[1]
                 tags1 = tagfsutils.path2tags(path1, 'file')[1]
                 f = self.tdb.files[frs[1][0]]
+                self.forget_stat(f.fuuid)
                 if tags1[-1] != tags0[-1]:
-                    logging.info('rename from '+self.lldir+f.getfullname()+' to '+self.lldir+f.fuuid+'_'+tags1[-1])
-                    os.rename(self.lldir+f.getfullname(), self.lldir+f.fuuid+'_'+tags1[-1])                    
-                    f.fname = tags1[-1]
+                    logging.debug('rename from %s to %s_%s', f.getfullname(),
+                                  f.fuuid, tags1[-1])
+                    self.layout.rename(f.getfullname(), f.fuuid+'_'+tags1[-1])
+                    self.tdb.rename_file(f.fuuid, tags1[-1])
                 rmtags = list(set(tags0[0:-1]) - set(tags1[0:-1]))
                 addtags = list(set(tags1[0:-1]) - set(tags0[0:-1]))
                 try:
                     self.tdb.change_file_tags(f.fuuid, rmtags, addtags)
-                    self.tdb.store_db(self.lldir+TagDB.DefaultMetaDBFile)
+                    self.tdb.commit()
                 except Exception as e:
-                    logging.error('change file tag failed from +'+str(addtags)+' -'+str(rmtags))
-                    os.rename(self.lldir+f.fuuid+'_'+tags0[-1], self.lldir+f.fuuid+'_'+tags1[-1])
+                    logging.error('change file tag failed from +%s -%s',
+                                  addtags, rmtags)
+                    if tags1[-1] != tags0[-1]:
+                        self.layout.rename(f.fuuid+'_'+tags1[-1], f.fuuid+'_'+tags0[-1])
+                        self.tdb.rename_file(f.fuuid, tags0[-1])
+                        self.tdb.commit()
                     raise e
             else:
                 logging.error('rename fault error')
                 return -errno.EFAULT
         except Exception as e:
-            logging.error('rename error'+str(e))
+            logging.error('rename error: %s', e)
             return -errno.ENOENT
+        finally:
+            self.tdb.rwlock.release_write()
 
+    @TagStats.timed('link')
     def link(self, path, path1):
-        logging.info('link: '+path)
+        logging.debug('link: %s', path)
         # I decide not support link!
         return -errno.ENOSYS
 
+    @TagStats.timed('chmod')
     def chmod(self, path, mode):
-        logging.info('chmod: '+path)
+        logging.debug('chmod: %s', path)
         try:
             frs = self.find_nonfiles_by_path(path)
             if frs[0] == 'dir':
-                logging.info('chmod on dir makes no sense')
+                logging.debug('chmod on dir makes no sense')
                 return 0
             
             if frs[0] == 'file':
-                os.chmod(self.lldir+self.tdb.files[frs[1][0]].getfullname(), mode)
+                self.layout.call(os.chmod, self.tdb.files[frs[1][0]].getfullname(),
+                                 mode)
+                self.forget_stat(frs[1][0])
+                # opens have to be checked against the new mode
+                self.fdpool.forget(frs[1][0])
             else:
                 return -errno.EFAULT
         except:
             return -errno.ENOENT
 
+    @TagStats.timed('chown')
     def chown(self, path, user, group):
-        logging.info('chown: '+path)
+        logging.debug('chown: %s', path)
         try:
             frs = self.find_nonfiles_by_path(path)
             if frs[0] == 'dir':
-                logging.info('chown on dir makes no sense')
+                logging.debug('chown on dir makes no sense')
                 return 0
             
             if frs[0] == 'file':
-                os.chown(self.lldir+self.tdb.files[frs[1][0]].getfullname(), user, group)   
+                self.layout.call(os.chown, self.tdb.files[frs[1][0]].getfullname(),
+                                 user, group)
+                self.forget_stat(frs[1][0])
+                self.fdpool.forget(frs[1][0])
             else:
                 return -errno.EFAULT             
         except:
             return -errno.ENOENT
 
+    @TagStats.timed('truncate')
     def truncate(self, path, len):
-        logging.info('truncate: '+path)
+        logging.debug('truncate: %s', path)
         try:
             frs = self.find_nonfiles_by_path(path)
             if frs[0] == 'dir':
-                logging.info('truncate on dir')
+                logging.debug('truncate on dir')
                 return -errno.EISDIR
             
             if frs[0] == 'file':
-                f = open(self.lldir+self.tdb.files[frs[1][0]].getfullname(), 'a')
+                f = self.layout.call(open, self.tdb.files[frs[1][0]].getfullname(),
+                                     'a')
                 f.truncate(len)
                 f.close()    
+                self.forget_stat(frs[1][0])
             else:
                 return -errno.EFAULT            
         except:
             return -errno.ENOENT
 
+    @TagStats.timed('mknod')
     def mknod(self, path, mode, dev):
-        logging.info('Create new inode: '+path)
+        logging.debug('Create new inode: %s', path)
+        if _read_only(path):
+            return -errno.EROFS
         ftags_rs = tagfsutils.path2tags(path, 'file')
                     
         if ftags_rs[0] == 'file':
-            logging.info('Want to create a file')
+            logging.debug('Want to create a file')
             ftags = ftags_rs[1][0:-1]
             fname = ftags_rs[1][-1]
             import uuid
@@ -330,42 +660,56 @@ class TagFS(fuse.Fuse):
                 e.errno = errno.EEXIST # (TODO: find a correct errno)
                 raise e
         else:
-            logging.info('Want to create a dir')
+            logging.debug('Want to create a dir')
             self.mkdir(path, mode)
-        self.tdb.store_db(self.lldir+TagDB.DefaultMetaDBFile)
+        self.tdb.commit()
 
 
+    @TagStats.timed('mkdir')
     def mkdir(self, path, mode):
-        logging.info('mkdir: '+path)
+        logging.debug('mkdir: %s', path)
+        if _read_only(path):
+            return -errno.EROFS
         self.tdb.add_tags_by_path(path)
-        self.tdb.store_db(self.lldir+TagDB.DefaultMetaDBFile)
+        self.tdb.commit()
 
+    @TagStats.timed('utime')
     def utime(self, path, times):
-        logging.info('utime: '+path)
+        logging.debug('utime: %s', path)
         try:
             frs = self.find_nonfiles_by_path(path)              
             if frs[0] == 'dir':
-                logging.info('utime on dir makes no sense')
+                logging.debug('utime on dir makes no sense')
                 return 0
             
             if frs[0] == 'file':
-                return os.utime(self.lldir+self.tdb.files[frs[1][0]].getfullname()
-                                 ,times)
+                self.layout.call(os.utime, self.tdb.files[frs[1][0]].getfullname(),
+                                 times)
+                self.forget_stat(frs[1][0])
+                return 0
             else:
                 return -errno.EFAULT   
         except:
             return -errno.ENOENT
 
+    @TagStats.timed('access')
     def access(self, path, mode):
-        logging.info('access: '+path)
+        logging.debug('access: %s', path)
+        if path == '/' + StatsDir:
+            return 0
+        if path == StatsPath:
+            if mode & os.W_OK:
+                return -errno.EACCES
+            return 0
         try:
             frs = self.find_nonfiles_by_path(path)
             if frs[0] == 'dir':
                 return 0
             
             if frs[0] == 'file':
-                if not os.access(self.lldir+self.tdb.files[frs[1][0]].getfullname()
-                                 ,mode):
+                if not self.layout.call(os.access,
+                                        self.tdb.files[frs[1][0]].getfullname(),
+                                        mode):
                     return -errno.EACCES
             else:
                 return -errno.EFAULT
@@ -376,20 +720,71 @@ class TagFS(fuse.Fuse):
         self.lldir = self.root
         if self.lldir[-1] != '/':
             self.lldir += '/'
-        if os.path.exists(self.lldir+TagDB.DefaultMetaDBFile):
-            self.tdb.load_db(self.lldir+TagDB.DefaultMetaDBFile)
+        meta = self.lldir+TagDB.DefaultMetaDBFile
+        journal = self.lldir+TagJournal.DefaultJournalFile
+        if self.engine == 'sqlite':
+            sqlitedb = self.lldir+SQLiteTagDB.DefaultSQLiteDBFile
+            if not os.path.exists(sqlitedb) and os.path.exists(meta):
+                # first mount on sqlite, take over the tag db
+                logging.info('import tag db into %s', sqlitedb)
+                tdb = TagDB.TagDB(logging)
+                tdb.load_db(meta, journal)
+                SQLiteTagDB.import_tagdb(tdb, sqlitedb)
+                tdb.close()
+            self.tdb = SQLiteTagDB.SQLiteTagDB(logging)
+            self.tdb.load_db(sqlitedb)
+        elif self.engine == 'memory':
+            # the snapshot plus whatever the journal has after it
+            self.tdb.load_db(meta, journal)
+        else:
+            raise Exception('Unknown tag db engine: '+self.engine)
+        self.tdb.set_durability(self.durability, self.commit_window,
+                                self.commit_records)
+        self.layout = StoreLayout.load_layout(self.lldir)
+        if self.fanout != None:
+            self.layout.begin(self.fanout)
+        # an unfinished move goes on too
+        self.layout.start_moving(logging)
         os.chdir(self.root)
 
+    def fsdestroy(self):
+        self.fdpool.close()
+        logging.info('unmount: checkpoint tag db')
+        self.tdb.close()
+
     class TagFSFile(object):
 
+        @TagStats.timed('open')
         def __init__(self, path, flags, *mode):
-            logging.info('open: '+path + ' flags: '+str(flags))
+            logging.debug('open: %s flags: %s', path, flags)
             self.tagfs = TagFS.cur_tagfs  
             self.path = path
             self.flags = flags
             self.mode = mode
-            self.direct_io = True
-            self.keep_cache = False
+            self.fdio = self.tagfs.fdio
+            if self.fdio:
+                # go through the page cache, what a read-only open cached
+                # stays valid for the next one
+                self.direct_io = False
+                self.keep_cache = (flags & os.O_ACCMODE) == os.O_RDONLY
+            else:
+                self.direct_io = True
+                self.keep_cache = False
+            # seek and read/write on self.file must not interleave
+            self.iolock = threading.Lock()
+            self.pooled = None
+            if path == StatsPath:
+                if (flags & os.O_ACCMODE) != os.O_RDONLY:
+                    e = OSError()
+                    e.errno = errno.EACCES
+                    raise e
+                # a snapshot, read as it was when opened whatever its size
+                # was at getattr
+                self.filetype = 'stats'
+                self.data = TagStats.stats.report()
+                self.direct_io = True
+                self.keep_cache = False
+                return
             try:
                 # can a directory be opened? Yes, but when reading, errors are there.                
                 f = self.tagfs.find_nonfiles_by_path(path)                
@@ -399,23 +794,25 @@ class TagFS(fuse.Fuse):
                 
                 if f[0] == 'file':
                     self.filetype = 'file'
-                    self.file = os.fdopen(os.open(
-                                   self.tagfs.lldir + self.tagfs.tdb.files[f[1][0]].getfullname(),
-                                   flags, *mode), _flags2mode(flags))
-                    self.fd = self.file.fileno()
+                    self.__open(f[1][0])
             except (TagDB.NoTagException, TagDB.NameConflictionException):
                 e = OSError()
                 e.errno = errno.ENOENT
-                logging.error('open: no tag: '+path+' flags: '+str(flags))
+                logging.debug('open: no tag: %s flags: %s', path, flags)
                 raise e
             except TagDB.NoUniqueTagException:
                 # System error: no unique id for path/file
-                logging.error('System error: no unique id for path/file: path='+path)
+                logging.error('System error: no unique id for path/file: path=%s',
+                              path)
                 e = OSError()
                 e.errno = errno.ENOENT
                 raise e
             except TagDB.NoFileException:
-                logging.info('Create new file')
+                logging.debug('Create new file')
+                if _read_only(path):
+                    e = OSError()
+                    e.errno = errno.EROFS
+                    raise e
                 if flags | os.O_CREAT == flags:
                     ftags_rs = tagfsutils.path2tags(path, 'file')
                     if ftags_rs[0] != 'file':
@@ -428,15 +825,13 @@ class TagFS(fuse.Fuse):
                     import uuid
                     fuuid = uuid.uuid4().hex
                     try:
-                        logging.info('add file: '+fname+' '+str(ftags))
+                        logging.debug('add file: %s %s', fname, ftags)
                         self.tagfs.tdb.add_file(fuuid, fname, ftags)                        
-                        self.file = os.fdopen(os.open(
-                                   self.tagfs.lldir + self.tagfs.tdb.files[fuuid].getfullname(),
-                                   flags, *mode), _flags2mode(flags))
-                        self.fd = self.file.fileno()    
+                        self.__open(fuuid)
                         self.filetype = 'file'                    
                     except TagDB.NoUniqueTagException as ne:
-                        logging.error('Want create a file that conflicts with tags'+ne.msg)
+                        logging.error('Want create a file that conflicts with tags: %s',
+                                      ne.msg)
                         e = OSError()
                         e.errno = errno.EEXIST # (TODO: find a correct errno)
                         raise e
@@ -445,57 +840,156 @@ class TagFS(fuse.Fuse):
                     e.errno = errno.ENOENT
                     raise e
             
+        def __open(self, fuuid):
+            self.fuuid = fuuid
+            if self.flags & FDPool.Unpooled:
+                self.pooled = None
+                self.fd, self.file = self.__open_store()
+                return
+            # the file may be open already, from this handle on seek and
+            # io go under the lock of the pooled file
+            self.pooled = self.tagfs.fdpool.acquire(fuuid, self.flags,
+                                                    self.__open_store)
+            self.fd = self.pooled.fd
+            self.file = self.pooled.file
+            self.iolock = self.pooled.lock
+
+        def __open_store(self):
+            name = self.tagfs.tdb.files[self.fuuid].getfullname()
+            if self.flags & os.O_CREAT:
+                fd = self.tagfs.layout.create(name, self.flags, *self.mode)
+            else:
+                fd = self.tagfs.layout.call(os.open, name, self.flags,
+                                            *self.mode)
+            if self.fdio:
+                # raw fd only, data is not copied through a file buffer
+                return (fd, None)
+            return (fd, os.fdopen(fd, _flags2mode(self.flags)))
+
         def __fail_dir_ops(self):
             if self.filetype == 'dir':
                 e = OSError()
                 e.errno = errno.ENOSYS
                 raise e
 
+        @TagStats.timed('read')
         def read(self, length, offset):
             self.__fail_dir_ops()                
-            self.file.seek(offset)
-            return self.file.read(length)
+            if self.filetype == 'stats':
+                return self.data[offset:offset+length]
+            if self.file == None:
+                if tagfsutils.PositionalIO:
+                    return tagfsutils.pread(self.fd, length, offset)
+                self.iolock.acquire()
+                try:
+                    return tagfsutils.pread(self.fd, length, offset)
+                finally:
+                    self.iolock.release()
+            self.iolock.acquire()
+            try:
+                self.file.seek(offset)
+                return self.file.read(length)
+            finally:
+                self.iolock.release()
 
+        @TagStats.timed('write')
         def write(self, buf, offset):
             self.__fail_dir_ops()   
-            self.file.seek(offset)
-            self.file.write(buf)
+            try:
+                return self.__write(buf, offset)
+            finally:
+                # after the data is in, a stat taken meanwhile is stale
+                self.tagfs.forget_stat(self.fuuid)
+
+        def __write(self, buf, offset):
+            if self.file == None:
+                if tagfsutils.PositionalIO:
+                    return tagfsutils.pwrite(self.fd, buf, offset)
+                self.iolock.acquire()
+                try:
+                    return tagfsutils.pwrite(self.fd, buf, offset)
+                finally:
+                    self.iolock.release()
+            self.iolock.acquire()
+            try:
+                self.file.seek(offset)
+                self.file.write(buf)
+            finally:
+                self.iolock.release()
             return len(buf)
 
+        @TagStats.timed('release')
         def release(self, flags):
-            self.file.close()
+            if self.filetype == 'stats':
+                return
+            if self.pooled != None:
+                # stays open for the next handle
+                if self.file != None:
+                    self._fflush()
+                self.tagfs.fdpool.release(self.pooled)
+            elif self.file == None:
+                os.close(self.fd)
+            else:
+                self.file.close()
+                self.tagfs.forget_stat(self.fuuid)
             if self.flags | os.O_CREAT == self.flags:
-                self.tagfs.tdb.store_db(self.tagfs.lldir+TagDB.DefaultMetaDBFile)
+                self.tagfs.tdb.commit()
 
         def _fflush(self):
             self.__fail_dir_ops()   
+            if self.file == None:
+                return
             if 'w' in self.file.mode or 'a' in self.file.mode:
-                self.file.flush()
+                self.iolock.acquire()
+                try:
+                    self.file.flush()
+                finally:
+                    self.iolock.release()
+                self.tagfs.forget_stat(self.fuuid)
 
+        @TagStats.timed('fsync')
         def fsync(self, isfsyncfile):
             self.__fail_dir_ops()   
+            if self.filetype == 'stats':
+                return
             self._fflush()
             if isfsyncfile and hasattr(os, 'fdatasync'):
                 os.fdatasync(self.fd)
             else:
                 os.fsync(self.fd)
 
+        @TagStats.timed('flush')
         def flush(self):
             self.__fail_dir_ops()   
+            if self.filetype == 'stats':
+                return
             self._fflush()
-            os.close(os.dup(self.fd))
+            if self.pooled == None:
+                os.close(os.dup(self.fd))
             if self.flags | os.O_CREAT == self.flags:
-                self.tagfs.tdb.store_db(self.tagfs.lldir+TagDB.DefaultMetaDBFile)
+                self.tagfs.tdb.commit()
 
+        @TagStats.timed('fgetattr')
         def fgetattr(self):
-            logging.info('fgetattr: '+self.path)
-            if self.filetype == 'dir':
-                return self.cur_tagfs.getattr(self.path) 
+            logging.debug('fgetattr: %s', self.path)
+            if self.filetype != 'file':
+                return self.tagfs.getattr(self.path)
             return os.fstat(self.fd)
 
+        @TagStats.timed('ftruncate')
         def ftruncate(self, len):
             self.__fail_dir_ops()   
-            self.file.truncate(len)
+            try:
+                if self.file == None:
+                    os.ftruncate(self.fd, len)
+                    return
+                self.iolock.acquire()
+                try:
+                    self.file.truncate(len)
+                finally:
+                    self.iolock.release()
+            finally:
+                self.tagfs.forget_stat(self.fuuid)
           
     def main(self, *a, **kw):
 
@@ -511,11 +1005,61 @@ def main():
                  usage=usage,
                  dash_s_do='setsingle')
 
-    server.multithreaded = False
-
     server.parser.add_option(mountopt="root", metavar="PATH", default='~/',
             help="back-store of tag filesystem from under PATH [default: %default]")
+    server.parser.add_option(mountopt="fdio", action="store_true",
+            default=False,
+            help="read/write files with pread/pwrite on the raw fd through " \
+                 "the page cache instead of direct io [default: off]")
+    server.parser.add_option(mountopt="engine", metavar="ENGINE",
+            default='memory',
+            help="tag db engine, memory or sqlite [default: %default]")
+    server.parser.add_option(mountopt="durability", metavar="MODE",
+            default='op',
+            help="when metadata changes are synced to disk: op before " \
+                 "each operation returns, group by a background thread " \
+                 "within commit_window, or unmount [default: %default]")
+    server.parser.add_option(mountopt="commit_window", metavar="SECS",
+            type="float", default=TagDB.CommitWindow,
+            help="most seconds a group commit waits [default: %default]")
+    server.parser.add_option(mountopt="commit_records", metavar="N",
+            type="int", default=TagDB.CommitRecords,
+            help="a group commit is synced at once when N changes wait " \
+                 "[default: %default]")
+    server.parser.add_option(mountopt="fanout", metavar="LEVELS",
+            type="int", default=None,
+            help="spread the back-store files over LEVELS levels of 256 " \
+                 "dirs, 0 keeps them in its root; files are moved in the " \
+                 "background [default: as the back-store is]")
+    server.parser.add_option(mountopt="loglevel", metavar="LEVEL",
+            default=LogLevel,
+            help="log level into " + LOG_FILENAME + ": debug, info, " \
+                 "warning, error or critical [default: %default]")
+    server.parser.add_option(mountopt="statsdump", metavar="SECS",
+            type="float", default=None,
+            help="also write the stats of %s into the log every SECS " \
+                 "seconds [default: off]" % StatsPath)
     server.parse(values=server, errex=1)
+    level = getattr(logging, str(server.loglevel).upper(), None)
+    if not isinstance(level, int):
+        print >> sys.stderr, "unknown log level: " + str(server.loglevel)
+        sys.exit(1)
+    if server.durability not in TagDB.DurabilityModes:
+        print >> sys.stderr, "unknown durability: " + str(server.durability)
+        sys.exit(1)
+    server.loghandler = TagLog.setup(level, LOG_FILENAME)
+    if server.statsdump != None:
+        # dumped whatever the log level is
+        TagStats.stats.dumplog = logging.getLogger('tagfs.stats')
+        TagStats.stats.dumplog.setLevel(logging.INFO)
+        TagStats.stats.dumpevery = server.statsdump
+    if server.fdio:
+        # let the kernel send writes bigger than a page
+        server.fuse_args.add('big_writes')
+    if 'attr_timeout' not in server.fuse_args.optdict:
+        server.fuse_args.add('attr_timeout', str(AttrTimeout))
+    if 'entry_timeout' not in server.fuse_args.optdict:
+        server.fuse_args.add('entry_timeout', str(EntryTimeout))
 
     try:
         if server.fuse_args.mount_expected():
@@ -0,0 +1,135 @@
+# Tag db journal
+
+import os
+import struct
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+import threading
+
+# for default journal file
+DefaultJournalFile = '.tagfs_db.journal'
+
+# every record is prefixed by its pickled length
+_recheader = struct.Struct('<I')
+
+def read_journal(jfile):
+    """
+    Yield (end, (seq, op, args)) for the records of a journal file, end
+    being the file offset right after the record. A torn record at the tail
+    (crash in the middle of an append) ends the journal.
+    """
+    jf = open(jfile, 'rb')
+    end = 0
+    try:
+        while True:
+            hdr = jf.read(_recheader.size)
+            if len(hdr) < _recheader.size:
+                return
+            size = _recheader.unpack(hdr)[0]
+            data = jf.read(size)
+            if len(data) < size:
+                return
+            try:
+                rec = pickle.loads(data)
+            except Exception:
+                return
+            end += _recheader.size + size
+            yield (end, rec)
+    finally:
+        jf.close()
+
+def _write_record(jf, rec):
+    data = pickle.dumps(rec, pickle.HIGHEST_PROTOCOL)
+    jf.write(_recheader.pack(len(data)) + data)
+
+class TagJournal:
+    """
+    Append-only log of TagDB mutations.
+
+    Records are (seq, op, args) tuples, seq increasing by one per record.
+    append() only hands the record to the OS, sync() makes everything
+    appended so far durable with one fsync, so a FUSE operation costs a
+    single fsync however many records it produced. All methods may be
+    called from any thread.
+    """
+
+    def __init__(self, jfile, seq=0, count=0, end=0):
+        """
+        Open jfile for appending after its first count records, which end
+        at offset end. A torn tail behind them is cut off.
+        """
+        self.jfile = jfile
+        self.seq = seq          # seq of the last appended record
+        self.count = count      # records in the journal file
+        self.pending = 0        # records appended but not synced
+        self.lock = threading.Lock()
+        self.jf = open(jfile, 'ab')
+        if os.fstat(self.jf.fileno()).st_size > end:
+            self.jf.truncate(end)
+
+    def append(self, op, args):
+        self.lock.acquire()
+        try:
+            self.seq += 1
+            _write_record(self.jf, (self.seq, op, args))
+            self.count += 1
+            self.pending += 1
+            return self.seq
+        finally:
+            self.lock.release()
+
+    def flush(self):
+        """Hand what is appended to the OS, without waiting for the disk"""
+        self.lock.acquire()
+        try:
+            self.jf.flush()
+        finally:
+            self.lock.release()
+
+    def sync(self):
+        self.lock.acquire()
+        try:
+            if self.pending == 0:
+                return
+            self.jf.flush()
+            os.fsync(self.jf.fileno())
+            self.pending = 0
+        finally:
+            self.lock.release()
+
+    def truncate(self, seq):
+        """
+        Drop records with seq <= seq because a snapshot covers them now.
+        Records appended after the snapshot was taken are kept.
+        """
+        self.lock.acquire()
+        try:
+            self.__truncate(seq)
+        finally:
+            self.lock.release()
+
+    def __truncate(self, seq):
+        self.jf.flush()
+        keep = [r for end, r in read_journal(self.jfile) if r[0] > seq]
+        tmpfile = self.jfile + '.tmp'
+        tf = open(tmpfile, 'wb')
+        for r in keep:
+            _write_record(tf, r)
+        tf.flush()
+        os.fsync(tf.fileno())
+        tf.close()
+        os.rename(tmpfile, self.jfile)
+        self.jf.close()
+        self.jf = open(self.jfile, 'ab')
+        self.count = len(keep)
+        self.pending = 0
+
+    def close(self):
+        self.sync()
+        self.lock.acquire()
+        try:
+            self.jf.close()
+        finally:
+            self.lock.release()
@@ -0,0 +1,116 @@
+# Asynchronous logging
+
+import logging
+import threading
+import time
+from collections import deque
+
+# records waiting for the writer, more are dropped
+QueueSize = 10000
+# seconds the writer sleeps when there is nothing to write
+WriterIdle = 0.05
+
+class QueueHandler(logging.Handler):
+    """
+    Handler putting records on a queue for a writer thread which formats
+    them with target's formatter and writes them into target's stream in
+    batches, one flush per batch, so FUSE handlers never wait for the log
+    file. The message is formatted before queueing, with the arguments as
+    they are at the call. deque appends are atomic, the queue takes no
+    lock. When the writer falls behind by size records, new ones are
+    dropped and counted in dropped.
+    """
+
+    def __init__(self, target, size = QueueSize):
+        logging.Handler.__init__(self)
+        self.target = target
+        self.size = size
+        self.queue = deque()
+        self.dropped = 0
+        self.stopping = False
+        # started by the first record so that it is not lost when fuse
+        # forks
+        self.writer = None
+        self.writerlock = threading.Lock()
+
+    def emit(self, record):
+        try:
+            record.msg = record.getMessage()
+            record.args = None
+            if record.exc_info:
+                record.exc_text = logging.Formatter().formatException(
+                        record.exc_info)
+                record.exc_info = None
+        except Exception:
+            self.handleError(record)
+            return
+        if self.writer == None or not self.writer.isAlive():
+            self.__start_writer()
+        if len(self.queue) >= self.size:
+            self.dropped += 1
+            return
+        self.queue.append(record)
+
+    def __start_writer(self):
+        self.writerlock.acquire()
+        try:
+            if self.writer != None and self.writer.isAlive():
+                return
+            self.writer = threading.Thread(target=self.__write_loop)
+            self.writer.setDaemon(True)
+            self.writer.start()
+        finally:
+            self.writerlock.release()
+
+    def __write_batch(self):
+        lines = []
+        try:
+            while True:
+                record = self.queue.popleft()
+                try:
+                    lines.append(self.target.format(record) + '\n')
+                except Exception:
+                    self.target.handleError(record)
+        except IndexError:
+            pass
+        if len(lines) == 0:
+            return False
+        self.target.acquire()
+        try:
+            self.target.stream.write(''.join(lines))
+            self.target.flush()
+        finally:
+            self.target.release()
+        return True
+
+    def __write_loop(self):
+        while not self.stopping:
+            if not self.__write_batch():
+                time.sleep(WriterIdle)
+
+    def close(self):
+        """Write out what is queued, then close target."""
+        if self.writer != None and self.writer.isAlive():
+            self.stopping = True
+            self.writer.join()
+        self.__write_batch()
+        self.target.close()
+        logging.Handler.close(self)
+
+def setup(level, filename, queued = True):
+    """
+    Log records of level and above into filename, through a writer
+    thread if queued. @return: the handler installed on the root logger
+    """
+    target = logging.FileHandler(filename, 'w')
+    target.setFormatter(logging.Formatter(
+            '%(asctime)s %(levelname)s %(message)s'))
+    handler = target
+    if queued:
+        handler = QueueHandler(target)
+    root = logging.getLogger()
+    for h in root.handlers[:]:
+        root.removeHandler(h)
+    root.addHandler(handler)
+    root.setLevel(level)
+    return handler
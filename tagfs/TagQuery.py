@@ -0,0 +1,67 @@
+# Boolean tag queries
+
+"""
+Paths under /.q/ are boolean queries rather than plain tag paths. Every
+component after .q is a clause and a file has to satisfy all of them:
+
+    tag         files having tag
+    a|b|c       files having any of a, b, c
+    -tag        files not having tag
+    -a|b        files having neither a nor b
+
+So /.q/picture/-raw/ lists the pictures which are not raw ones, and
+/.q/utah|nevada/picture/ the pictures of either state. The last component
+of a path may be the name of a file in the result instead of a clause.
+A query with no positive clause starts from all files.
+"""
+
+# reserved first component of query paths
+QueryDir = '.q'
+
+class QueryException(Exception):
+    def __init__(self, msg, clause):
+        self.msg = msg
+        self.clause = clause
+
+class Clause:
+    def __init__(self, tags, negated):
+        self.tags = tags
+        self.negated = negated
+
+    def __str__(self):
+        return ('-' if self.negated else '') + '|'.join(self.tags)
+
+    def __repr__(self):
+        return 'Clause(' + self.__str__() + ')'
+
+def is_query(qtags):
+    """If tags split from a path are a query"""
+    return len(qtags) != 0 and qtags[0] == QueryDir
+
+def parse_clause(comp):
+    negated = comp.startswith('-')
+    if negated:
+        comp = comp[1:]
+    tags = comp.split('|')
+    if '' in tags:
+        raise QueryException('Empty tag in query clause', comp)
+    return Clause(tags, negated)
+
+def parse_query(comps):
+    """Clauses of the path components following the query dir"""
+    return [parse_clause(comp) for comp in comps]
+
+def plan(clauses, size):
+    """
+    Order clauses for evaluation: positive ones by their estimated number
+    of files, smallest first, so that the running intersection is as
+    small as it can be from the start, then negative ones, largest first
+    as they take out the most. size(tag) is the number of files of a tag,
+    0 for unknown ones; a clause has at most the sum of its tags.
+    @return: (positive clauses, negative clauses)
+    """
+    est = [(sum([size(t) for t in c.tags]), i, c)
+           for i, c in enumerate(clauses)]
+    positives = [c for n, i, c in sorted(est) if not c.negated]
+    negatives = [c for n, i, c in sorted(est, reverse=True) if c.negated]
+    return (positives, negatives)
@@ -0,0 +1,195 @@
+# Operation counters and latency histograms
+
+import time
+import types
+import errno
+import threading
+
+# read-only dir of files showing the state of tagfs itself
+StatsDir = '.tagfs'
+
+# latencies are counted in power of 2 microsecond buckets: bucket b holds
+# the ones below 2**b us
+Buckets = 32
+
+def bucket(secs):
+    """Histogram bucket of a latency of secs, the bits of it in us"""
+    us = int(secs * 1e6)
+    b = 0
+    while us != 0 and b < Buckets - 1:
+        us >>= 1
+        b += 1
+    return b
+
+class OpStats:
+    def __init__(self):
+        self.calls = 0
+        self.secs = 0.0
+        self.max = 0.0
+        self.hist = [0] * Buckets
+        self.errors = {} # errors is {errno=>count}
+
+    def percentile(self, p):
+        """Upper bound in us of the bucket holding the p-th percentile"""
+        want = self.calls * p / 100.0
+        seen = 0
+        for b, n in enumerate(self.hist):
+            seen += n
+            if n != 0 and seen >= want:
+                return 1 << b
+        return 0
+
+class TagStats:
+    """
+    Calls, errors by errno and latency histogram of every timed operation.
+    Recording costs two clock reads and a few dict updates under a lock.
+    Gauges are functions returning (name, value) pairs computed when the
+    stats are shown, e.g. cache hit rates and db size.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ops = {} # ops is {name=>OpStats}
+        self.gauges = []
+        self.begin = time.time()
+        # dump into the log every dumpevery seconds if set, the thread is
+        # started by the first call recorded so that it is not lost when
+        # fuse forks
+        self.dumpevery = None
+        self.dumplog = None
+        self.dumper = None
+
+    def record(self, name, secs, err = None):
+        self.lock.acquire()
+        try:
+            op = self.ops.get(name)
+            if op == None:
+                op = self.ops[name] = OpStats()
+            op.calls += 1
+            op.secs += secs
+            if secs > op.max:
+                op.max = secs
+            op.hist[bucket(secs)] += 1
+            if err != None:
+                op.errors[err] = op.errors.get(err, 0) + 1
+        finally:
+            self.lock.release()
+        if self.dumpevery != None and \
+               (self.dumper == None or not self.dumper.isAlive()):
+            self.__start_dumper()
+
+    def add_gauge(self, gauge):
+        self.gauges.append(gauge)
+
+    def report(self):
+        """The stats as text, what /.tagfs/stats reads"""
+        self.lock.acquire()
+        try:
+            ops = [(name, op.calls, op.secs, op.max, op.hist[:],
+                    op.errors.copy()) for name, op in self.ops.iteritems()]
+        finally:
+            self.lock.release()
+        ops.sort()
+
+        lines = ['uptime %.1f s' % (time.time() - self.begin)]
+        for gauge in self.gauges:
+            try:
+                for name, value in gauge():
+                    lines.append(name + ' ' + str(value))
+            except Exception as e:
+                lines.append('gauge failed: ' + str(e))
+
+        lines.append('')
+        lines.append('%-24s %10s %8s %10s %10s %10s %10s' %
+                     ('op', 'calls', 'errors', 'mean us', 'p50 us', 'p99 us',
+                      'max us'))
+        for name, calls, secs, mx, hist, errors in ops:
+            op = OpStats()
+            op.calls = calls
+            op.hist = hist
+            lines.append('%-24s %10d %8d %10.1f %10d %10d %10.1f' %
+                         (name, calls, sum(errors.values()),
+                          secs * 1e6 / max(calls, 1), op.percentile(50),
+                          op.percentile(99), mx * 1e6))
+
+        lines.append('')
+        lines.append('errors:')
+        for name, calls, secs, mx, hist, errors in ops:
+            for err, n in sorted(errors.items()):
+                lines.append('  %s %s %d' % (name, _errname(err), n))
+
+        lines.append('')
+        lines.append('latency histograms, us upper bound:calls')
+        for name, calls, secs, mx, hist, errors in ops:
+            lines.append('  ' + name + ' ' +
+                         ' '.join(['%d:%d' % (1 << b, n)
+                                   for b, n in enumerate(hist) if n != 0]))
+        return '\n'.join(lines) + '\n'
+
+    def __start_dumper(self):
+        self.lock.acquire()
+        try:
+            if self.dumper != None and self.dumper.isAlive():
+                return
+            self.dumper = threading.Thread(target=self.__dump_loop)
+            self.dumper.setDaemon(True)
+            self.dumper.start()
+        finally:
+            self.lock.release()
+
+    def __dump_loop(self):
+        while self.dumpevery != None:
+            time.sleep(self.dumpevery)
+            try:
+                self.dumplog.info('stats:\n' + self.report())
+            except Exception:
+                pass
+
+def _errname(err):
+    if isinstance(err, int):
+        return errno.errorcode.get(err, str(err))
+    return str(err)
+
+# the stats of this process, what timed() records into
+stats = TagStats()
+
+def timed(name):
+    """
+    Decorator recording calls of a method under name. A negative int
+    returned or an exception raised counts as an error, by errno when it
+    has one. Generators are timed until they are exhausted or closed.
+    """
+    def wrap(func):
+        def timedfunc(*args, **kw):
+            begin = time.time()
+            try:
+                rs = func(*args, **kw)
+            except Exception as e:
+                stats.record(name, time.time() - begin,
+                             getattr(e, 'errno', None) or type(e).__name__)
+                raise
+            if isinstance(rs, types.GeneratorType):
+                return _timed_gen(name, begin, rs)
+            err = None
+            if isinstance(rs, int) and rs < 0:
+                err = -rs
+            stats.record(name, time.time() - begin, err)
+            return rs
+        timedfunc.__name__ = func.__name__
+        timedfunc.__doc__ = func.__doc__
+        return timedfunc
+    return wrap
+
+def _timed_gen(name, begin, gen):
+    err = None
+    try:
+        try:
+            for item in gen:
+                if isinstance(item, int) and item < 0:
+                    err = -item
+                yield item
+        except Exception as e:
+            err = getattr(e, 'errno', None) or type(e).__name__
+            raise
+    finally:
+        stats.record(name, time.time() - begin, err)
@@ -1,5 +1,35 @@
 # Tag filesystem utilities
 
+import os
+from array import array
+from bisect import bisect_left
+import TagQuery
+import TagStats
+
+# Postings are arrays of file ids kept sorted, 4 bytes per id
+PostingType = 'I'
+if array(PostingType).itemsize != 4:
+    PostingType = 'L'
+
+# os.pread/os.pwrite are missing before python 3.3, the fallback moves the
+# fd offset so callers must keep other threads off the fd meanwhile
+PositionalIO = hasattr(os, 'pread')
+
+def pread(fd, length, offset):
+    if PositionalIO:
+        return os.pread(fd, length, offset)
+    os.lseek(fd, offset, os.SEEK_SET)
+    return os.read(fd, length)
+
+def pwrite(fd, buf, offset):
+    if PositionalIO:
+        return os.pwrite(fd, buf, offset)
+    os.lseek(fd, offset, os.SEEK_SET)
+    written = 0
+    while written < len(buf):
+        written += os.write(fd, buf[written:])
+    return written
+
 def path2tags(path, target):
     if len(path) == 0:
         return (target, [])
@@ -22,6 +52,14 @@ def path2tags(path, target):
 
     return (target, tset)
 
+def reserved_names(names):
+    """
+    Those of names which tagfs keeps for dirs of its own, the query and
+    the stats dir, no tag or file can be named so.
+    """
+    return [n for n in names if n == TagQuery.QueryDir
+            or n == TagStats.StatsDir]
+
 def files2file(fs):
     if fs[0] != 'files':
         raise Exception('invalid arguments, a files-result is expected.')
@@ -29,4 +67,132 @@ def files2file(fs):
         if len(f) == 1:
             fs = ('file', f)
             return fs
-    return None
\ No newline at end of file
+    return None
+
+def parse_tag_edit(value):
+    """
+    Parse a value written to the tags xattr: tags separated by '/', either
+    all of them prefixed by + or - to add or remove them, or all bare to
+    set exactly those tags.
+    @return: (exact, addtags, rmtags), addtags being all the tags if exact
+    """
+    items = [t for t in value.split('/') if t != '']
+    marked = [t for t in items if t[0] in '+-']
+    if len(marked) == 0:
+        return (True, items, [])
+    if len(marked) != len(items):
+        raise ValueError('mixed tag edit: ' + value)
+    addtags = [t[1:] for t in items if t[0] == '+']
+    rmtags = [t[1:] for t in items if t[0] == '-']
+    if '' in addtags or '' in rmtags:
+        raise ValueError('empty tag in tag edit: ' + value)
+    return (False, addtags, rmtags)
+
+def reader(func):
+    """Decorator running a method with its object's 'rwlock' held to read."""
+    def locked(self, *args, **kw):
+        self.rwlock.acquire_read()
+        try:
+            return func(self, *args, **kw)
+        finally:
+            self.rwlock.release_read()
+    locked.__name__ = func.__name__
+    locked.__doc__ = func.__doc__
+    return locked
+
+def writer(func):
+    """Decorator running a method with its object's 'rwlock' held to write."""
+    def locked(self, *args, **kw):
+        self.rwlock.acquire_write()
+        try:
+            return func(self, *args, **kw)
+        finally:
+            self.rwlock.release_write()
+    locked.__name__ = func.__name__
+    locked.__doc__ = func.__doc__
+    return locked
+
+def new_posting(fids=()):
+    return array(PostingType, fids)
+
+def posting_add(posting, fid):
+    i = bisect_left(posting, fid)
+    if i == len(posting) or posting[i] != fid:
+        posting.insert(i, fid)
+
+def posting_remove(posting, fid):
+    i = bisect_left(posting, fid)
+    if i < len(posting) and posting[i] == fid:
+        del posting[i]
+
+def in_postings(postings, fid):
+    """If fid is in all of postings"""
+    for posting in postings:
+        i = bisect_left(posting, fid)
+        if i == len(posting) or posting[i] != fid:
+            return False
+    return True
+
+def postings_meet(p, q):
+    """If sorted postings p and q have an id in common"""
+    if len(p) > len(q):
+        p, q = q, p
+    lo = 0
+    n = len(q)
+    for fid in p:
+        lo = bisect_left(q, fid, lo)
+        if lo == n:
+            return False
+        if q[lo] == fid:
+            return True
+    return False
+
+def intersect_postings(postings):
+    """
+    Intersect sorted postings, smallest first. When the running result is
+    much smaller than the next posting, its ids are galloped into it with
+    bisect, so the cost follows the smallest posting rather than the
+    largest one.
+    """
+    postings = sorted(postings, key=len)
+    rs = postings[0]
+    for p in postings[1:]:
+        if len(rs) == 0:
+            break
+        if len(rs) * 8 < len(p):
+            out = new_posting()
+            lo = 0
+            n = len(p)
+            for fid in rs:
+                lo = bisect_left(p, fid, lo)
+                if lo == n:
+                    break
+                if p[lo] == fid:
+                    out.append(fid)
+            rs = out
+        else:
+            rs = new_posting(sorted(set(rs).intersection(p)))
+    return rs
+
+def union_postings(postings):
+    """Ids in any of sorted postings, as a sorted posting"""
+    if len(postings) == 1:
+        return postings[0]
+    fids = set()
+    for p in postings:
+        fids.update(p)
+    return new_posting(sorted(fids))
+
+def subtract_postings(p, q):
+    """Ids of sorted posting p which are not in q"""
+    if len(p) * 8 < len(q):
+        out = new_posting()
+        lo = 0
+        n = len(q)
+        for fid in p:
+            lo = bisect_left(q, fid, lo)
+            if lo == n or q[lo] != fid:
+                out.append(fid)
+        return out
+    qs = set(q)
+    return new_posting([fid for fid in p if fid not in qs])
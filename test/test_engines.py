@@ -0,0 +1,201 @@
+#! /usr/bin/python
+
+"""
+Parity of the tag db engines. The same random mutations are applied to a
+TagDB and to an SQLiteTagDB, after each of them both must have the same
+files and tags and give the same results, errors included, to
+find_by_path and sub_tags. The TagDB is then loaded again from its
+journal, which must give it back as it was.
+
+    python test/test_engines.py [-v]
+"""
+import os
+import sys
+import random
+import shutil
+import logging
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                '..', 'tagfs'))
+import TagDB
+try:
+    import SQLiteTagDB
+except ImportError:
+    SQLiteTagDB = None
+
+# few tags and names, so that same named files and refused changes are
+# common; a name may be a tag too
+Tags = ['a', 'b', 'c', 'd', 'e']
+Names = ['x', 'y', 'z', 'a']
+
+Seeds = 30
+Steps = 60
+
+logger = logging.getLogger('test')
+
+def outcome(func, *args):
+    """What func(*args) gives, or the name of what it raises"""
+    try:
+        return ('ok', func(*args))
+    except Exception as e:
+        return (type(e).__name__,)
+
+def files(db):
+    return sorted([(f.fuuid, f.fname, f.tags) for f in db.files.itervalues()])
+
+def found(db, path, target):
+    rs = outcome(db.find_by_path, path, target)
+    if rs[0] != 'ok':
+        return rs
+    rs = rs[1]
+    if rs[0] in ('dir', 'files'):
+        # file ids, and so the order of the files, are the engine's own
+        return (rs[0], sorted(rs[1]))
+    return rs
+
+def random_path(rnd):
+    path = '/' + ''.join([t + '/' for t in
+                          rnd.sample(Tags, rnd.randint(0, 3))])
+    if rnd.random() < 0.5:
+        return path
+    return path + rnd.choice(Names + Tags)
+
+class Mutator:
+    """Random mutations, the same ones for every engine run with seed"""
+
+    def __init__(self, seed):
+        self.rnd = random.Random(seed)
+        self.n = 0
+
+    def fuuid(self):
+        self.n += 1
+        return '%032x' % self.n
+
+    def tags(self, k):
+        return self.rnd.sample(Tags, self.rnd.randint(0, k))
+
+    def __call__(self, db):
+        """@return: what the mutation gave on db, as outcome does"""
+        rnd = self.rnd
+        fuuids = [f[0] for f in files(db)]
+        op = rnd.randint(0, 11)
+        if op <= 1 or len(fuuids) == 0:
+            return outcome(db.add_file, self.fuuid(), rnd.choice(Names),
+                           self.tags(3))
+        f = db.files[rnd.choice(fuuids)]
+        if op == 2:
+            return outcome(db.add_file_tags, f.fuuid, self.tags(2))
+        elif op == 3:
+            rm = rnd.sample(list(f.tags) + ['/', 'q'],
+                            rnd.randint(0, len(f.tags)))
+            return outcome(db.change_file_tags, f.fuuid, rm, self.tags(2))
+        elif op == 4:
+            path = '/' + ''.join([t + '/' for t in f.tags
+                                  if rnd.random() < 0.7]) + f.fname
+            return outcome(db.rm_file_tags_by_path, f.fuuid, path)
+        elif op == 5:
+            return outcome(db.rm_file, f.fuuid)
+        elif op == 6:
+            return outcome(db.rename_file, f.fuuid, rnd.choice(Names))
+        elif op == 7:
+            path = '/' + rnd.choice(Tags + ['q', 'r']) + '/'
+            if rnd.random() < 0.5:
+                return outcome(db.add_tags_by_path, path)
+            return outcome(db.rm_tags_by_path, path)
+        elif op == 8:
+            batch = [(self.fuuid(), rnd.choice(Names),
+                      self.tags(3) + rnd.sample(['n1', 'n2'],
+                                                rnd.randint(0, 1)))
+                     for i in range(rnd.randint(1, 3))]
+            return outcome(db.add_files, batch)
+        elif op == 9:
+            batch = [(g, rnd.sample(list(db.files[g].tags),
+                                    rnd.randint(0, len(db.files[g].tags))),
+                      self.tags(2) + rnd.sample(['n1', 'n2'],
+                                                rnd.randint(0, 1)))
+                     for g in rnd.sample(fuuids,
+                                         rnd.randint(1, min(3, len(fuuids))))]
+            return outcome(db.change_files_tags, batch)
+        elif op == 10:
+            return outcome(db.rename_tag, rnd.choice(Tags),
+                           rnd.choice(Tags + ['n1', 'x']))
+        rs = outcome(db.rm_tag, rnd.choice(Tags))
+        if rs[0] == 'ok':
+            rs = ('ok', sorted([g.fuuid for g in rs[1]]))
+        return rs
+
+class EngineParityTest(unittest.TestCase):
+    longMessage = True
+
+    def setUp(self):
+        if SQLiteTagDB == None:
+            self.skipTest('sqlite3 is not available')
+        self.dir = tempfile.mkdtemp(prefix='tagfs-test-')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, True)
+
+    def assertSame(self, mem, sql, rnd, what):
+        self.assertEqual(files(mem), files(sql), what)
+        self.assertEqual(sorted(mem.tags.keys()), sorted(sql.tags.keys()),
+                         what)
+        for i in range(6):
+            path = random_path(rnd)
+            for target in ('dir', 'file', 'unsure'):
+                if target == 'file' and path[-1] == '/':
+                    continue
+                self.assertEqual(found(mem, path, target),
+                                 found(sql, path, target),
+                                 '%s: %s as %s' % (what, path, target))
+        qtags = rnd.sample(Tags, rnd.randint(1, 2))
+        subs = [outcome(db.sub_tags, qtags) for db in (mem, sql)]
+        subs = [s[0] == 'ok' and sorted(s[1]) or s for s in subs]
+        self.assertEqual(subs[0], subs[1], '%s: sub tags of %s'
+                         % (what, qtags))
+
+    def run_seed(self, seed):
+        d = os.path.join(self.dir, str(seed))
+        os.mkdir(d)
+        dbfile = os.path.join(d, 'db')
+        jfile = os.path.join(d, 'journal')
+        mem = TagDB.TagDB(logger)
+        mem.load_db(dbfile, jfile)
+        sql = SQLiteTagDB.SQLiteTagDB(logger, os.path.join(d, 'sqlite'))
+        sql.set_durability('unmount')
+        try:
+            mutators = [Mutator(seed), Mutator(seed)]
+            rnd = random.Random(-seed)
+            for step in range(Steps):
+                state = mutators[0].rnd.getstate()
+                rs = mutators[0](mem)
+                mutators[1].rnd.setstate(state)
+                what = 'seed %d step %d' % (seed, step)
+                self.assertEqual(rs, mutators[1](sql), what)
+                # change_file_tags may leave a file without any tag, not
+                # even '/', in both engines; check_index counts it as
+                # missing from '/'
+                self.assertEqual([p for p in mem.check_index()
+                                  if not p.startswith('posting of / ')],
+                                 [], what)
+                self.assertSame(mem, sql, rnd, what)
+
+            mem.commit()
+            replayed = TagDB.TagDB(logger)
+            replayed.load_db(dbfile, jfile)
+            self.assertEqual(files(replayed), files(mem), 'seed %d' % seed)
+            self.assertEqual(sorted(replayed.tags.keys()),
+                             sorted(mem.tags.keys()), 'seed %d' % seed)
+            replayed.journal.close()
+        finally:
+            mem.close()
+            sql.close()
+
+    def test_parity(self):
+        for seed in range(Seeds):
+            self.run_seed(seed)
+
+if __name__ == '__main__':
+    logging.basicConfig(level = logging.CRITICAL)
+    unittest.main()
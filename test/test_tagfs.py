@@ -0,0 +1,92 @@
+#! /usr/bin/python
+
+"""
+TagFS operations called directly, without mounting, on a back-store in a
+temporary dir, with each tag db engine. Needs python-fuse to import
+TagFS, the tests are skipped without it.
+
+    python test/test_tagfs.py [-v]
+"""
+import os
+import sys
+import errno
+import shutil
+import logging
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                '..', 'tagfs'))
+try:
+    import TagFS
+except ImportError:
+    TagFS = None
+
+Engines = ('memory', 'sqlite')
+
+class RenameTagTest(unittest.TestCase):
+
+    def setUp(self):
+        if TagFS == None:
+            self.skipTest('fuse is not available')
+        self.dir = tempfile.mkdtemp(prefix='tagfs-test-')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, True)
+
+    def mount(self, engine):
+        fs = TagFS.TagFS()
+        fs.root = os.path.join(self.dir, engine)
+        os.mkdir(fs.root)
+        fs.engine = engine
+        fs.fsinit()
+        fs.tdb.add_files([('%032x' % 1, 'x', ['a']),
+                          ('%032x' % 2, 'y', ['a', 'b']),
+                          ('%032x' % 3, 'z', ['b'])])
+        return fs
+
+    def tags(self, fs, n):
+        return fs.tdb.files['%032x' % n].tags
+
+    def test_rename_to_new_tag(self):
+        for engine in Engines:
+            fs = self.mount(engine)
+            try:
+                self.assertEqual(fs.rename('/a', '/c'), 0, engine)
+                self.assertFalse('a' in fs.tdb.tags, engine)
+                self.assertEqual(self.tags(fs, 1), ('c',), engine)
+                self.assertEqual(self.tags(fs, 2), ('c', 'b'), engine)
+                self.assertEqual(fs.tdb.find_by_path('/c/x', 'file'),
+                                 ('file', ('%032x' % 1,)), engine)
+            finally:
+                fs.fsdestroy()
+
+    def test_merge_into_tag(self):
+        for engine in Engines:
+            fs = self.mount(engine)
+            try:
+                self.assertEqual(fs.rename('/a', '/b'), 0, engine)
+                self.assertFalse('a' in fs.tdb.tags, engine)
+                for n in (1, 2, 3):
+                    self.assertEqual(self.tags(fs, n), ('b',), engine)
+            finally:
+                fs.fsdestroy()
+
+    def test_refused(self):
+        for engine in Engines:
+            fs = self.mount(engine)
+            try:
+                # /b/x and /a/x would both be x in b
+                fs.tdb.add_file('%032x' % 4, 'x', ['b'])
+                self.assertEqual(fs.rename('/a', '/b'), -errno.EEXIST, engine)
+                self.assertEqual(self.tags(fs, 1), ('a',), engine)
+                self.assertEqual(fs.rename('/nosuch', '/c'), -errno.ENOENT,
+                                 engine)
+                self.assertEqual(fs.rename('/a/b', '/c'), -errno.ENOSYS,
+                                 engine)
+            finally:
+                fs.fsdestroy()
+
+if __name__ == '__main__':
+    logging.basicConfig(level = logging.CRITICAL)
+    unittest.main()